@@ -1,7 +1,7 @@
 import numpy as np
 import pandas as pd
 
-from sfrmaker.routing import find_path, make_graph
+from sfrmaker.routing import find_path, make_graph, RoutingGraph
 
 
 def valid_rnos(rnos):
@@ -155,17 +155,20 @@ def routing_is_circular(fromid, toid):
         e.g. COMIDS, segments, or rnos
     toid : list or 1D array
         routing connections
+
+    Returns
+    -------
+    cycles : list of lists
+        Sequence of ids in each circular routing path
+        (e.g. [[1, 2, 3]] if 1 routes to 2, 2 to 3, and 3 back to 1).
+        An empty list (which evaluates to False) if the routing
+        isn't circular.
     """
     fromid = np.atleast_1d(fromid)
     toid = np.atleast_1d(toid)
 
-    graph = make_graph(fromid, toid, one_to_many=False)
-    paths = {fid: find_path(graph, fid) for fid in graph.keys()}
-    # a fromid should not appear more than once in its sequence
-    for k, v in paths.items():
-        if v.count(k) > 1:
-            return True
-    return False
+    graph = RoutingGraph(fromid, toid)
+    return [graph.ids[cycle].tolist() for cycle in graph.get_cycles()]
 
 
 def same_sfr_numbering(reach_data1, reach_data2):
@@ -3,7 +3,23 @@ import time
 
 import numpy as np
 
-from sfrmaker.routing import get_nextupsegs, get_upsegs, make_graph
+from sfrmaker.routing import RoutingGraph
+
+
+def _grouped_cumulative_min(values, groups):
+    """Cumulative minimum of values within each group,
+    where groups are contiguous runs of the same value.
+    """
+    values = values.copy()
+    shift = 1
+    while shift < len(values):
+        same_group = groups[shift:] == groups[:-shift]
+        if not np.any(same_group):
+            break
+        shifted = np.minimum(values[shift:], values[:-shift])
+        values[shift:] = np.where(same_group, shifted, values[shift:])
+        shift *= 2
+    return values
 
 
 def smooth_elevations(fromids, toids, elevations, start_elevations=None):  # elevup, elevdn):
@@ -26,76 +42,69 @@ def smooth_elevations(fromids, toids, elevations, start_elevations=None):  # ele
     Elevations : dict or tuple
         Dictionary of smoothed edge elevations,
         or smoothed end elevations, start elevations
+
+    Notes
+    -----
+    Each edge (end) elevation is reset to the minimum elevation
+    at or upstream of the edge. These are computed with a running
+    minimum, in a single sweep from the headwaters to the outlets.
+    With start_elevations, the start elevation of each edge is also reset
+    to the minimum end elevation of the edges routing to it, and each edge
+    end elevation is limited by the start elevation of its downstream edge.
     """
-    # make forward and reverse dictionaries with routing info
-    graph = dict(zip(fromids, toids))
-    assert 0 in set(graph.values()), 'No outlets in routing network!'
-    graph_r = make_graph(toids, fromids)
+    routing = RoutingGraph(fromids, toids)
+    toindex = routing.toindex
+    fromindex = routing.get_index(np.array(fromids))
+    # outlets are the listed ids that route to 0
+    # (ids that only appear in toids aren't outlets)
+    outlets = routing.outlets[routing.listed[routing.outlets]]
+    assert len(outlets) > 0, 'No outlets in routing network!'
 
-    # make dictionaries of segment end elevations
-    elevations = dict(zip(fromids, elevations))
+    # arrays of segment end (and start) elevations
+    # (nodes that only appear in toids are nan)
+    elevmin = np.full(len(routing), np.nan)
+    elevmin[fromindex] = elevations
     if start_elevations is not None:
-        elevmax = dict(zip(fromids, start_elevations))
-
-    def get_upseg_levels(seg):
-        """Traverse routing network, returning a list of segments
-        at each level upstream from the outlets. (level 0 route to seg;
-        segments in level 1 route to a segment in level 0, etc.)
+        elevmax = np.full(len(routing), np.nan)
+        elevmax[fromindex] = start_elevations
 
-        Parameters:
-        -----------
-        seg : int
-            Starting segment number
+    print('\nSmoothing elevations...')
+    ta = time.time()
+    # get the nodes at each level upstream of the outlets (level 0);
+    # segments that don't route to 0 are left as-is
+    segment_levels = routing.get_levels(start=outlets)
+    order = np.concatenate(segment_levels)
 
-        Returns
-        -------
-        all_upsegs : list
-            List with list of segments at each level
-        """
-        upsegs = graph_r[seg].copy()
-        all_upsegs = [upsegs]
-        for i in range(len(fromids)):
-            upsegs = get_nextupsegs(graph_r, upsegs)
-            if len(upsegs) > 0:
-                all_upsegs.append(upsegs)
-            else:
-                break
-        return all_upsegs
+    # minimum current elevation upstream of each node,
+    # accumulated going downstream from the headwaters
+    elevmin_s = elevmin.copy()
+    for level in segment_levels[:0:-1]:
+        np.minimum.at(elevmin_s, toindex[level], elevmin_s[level])
+    new_elevmin = elevmin.copy()
+    new_elevmin[order] = elevmin_s[order]
 
-    def reset_elevations(seg):
-        """Reset segment elevations above (upsegs) and below (outseg) a node.
-        """
-        oseg = graph[seg]
-        all_upsegs = np.array(list(get_upsegs(graph_r, seg)) + [seg])  # all segments upstream of node
-        elevmin_s = np.min([elevations[s] for s in all_upsegs])  # minimum current elevation upstream of node
-        oldmin_s = elevations[seg]
-        elevs = [elevmin_s, oldmin_s]
-        if oseg > 0:  # if segment is not an outlet,
-            if start_elevations is not None:
-                elevs.append(elevmax[oseg]) # outseg start elevation (already updated)
-        # set segment end elevation as min of
-        # upstream elevations, current elevation, outseg start elevation
-        elevations[seg] = np.min(elevs)
-        # if the node is not an outlet, reset the outseg max if the current min is lower
-        if oseg > 0:
-            if start_elevations is not None:
-                next_reach_elev = elevmax[oseg]
-                elevmax[graph[seg]] = np.min([elevmin_s, next_reach_elev])
-            else:
-                next_reach_elev = elevations[oseg]
-                elevations[graph[seg]] = np.min([elevmin_s, next_reach_elev])
+    if start_elevations is not None:
+        # outseg start elevations are reset to the minimum upstream elevation
+        # of each segment routing to them, one segment at a time;
+        # each segment end is limited by the outseg start elevation at that point
+        # (including reductions by any segments at the same confluence
+        # that were processed before it). The results depend on the order
+        # of the segments at each confluence, which is the order that they
+        # were listed in fromids (the order of the upstream connections
+        # in the routing graph)
+        has_outseg = order[toindex[order] >= 0]
+        outseg = toindex[has_outseg]
+        sort = np.argsort(outseg, kind='stable')
+        has_outseg, outseg = has_outseg[sort], outseg[sort]
+        confluence_min = _grouped_cumulative_min(elevmin_s[has_outseg], outseg)
+        new_elevmin[has_outseg] = np.minimum(confluence_min, elevmax[outseg])
 
-    print('\nSmoothing elevations...')
-    ta = time.time()
-    # get list of segments at each level, starting with 0 (outlet)
-    segment_levels = get_upseg_levels(0)
-    # at each level, reset all of the segment elevations as necessary
-    for level in segment_levels:
-        for s in level:
-            if 0 in level:
-                j=2
-            reset_elevations(s)
+        new_elevmax = elevmax.copy()
+        np.minimum.at(new_elevmax, outseg, elevmin_s[has_outseg])
     print("finished in {:.2f}s".format(time.time() - ta))
+
+    elevations = dict(zip(fromids, new_elevmin[fromindex]))
     if start_elevations is not None:
+        elevmax = dict(zip(fromids, new_elevmax[fromindex]))
         return elevations, elevmax
     return elevations
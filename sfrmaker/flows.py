@@ -6,7 +6,7 @@ import numpy as np
 import pandas as pd
 from shapely.geometry import box
 import flopy
-from sfrmaker.routing import find_path, make_graph
+from sfrmaker.routing import find_path, make_graph, RoutingGraph, SubtreeIndex
 from gisutils import shp2df
 from mfexport.budget_output import read_sfr_output
 from .fileio import read_tables
@@ -383,12 +383,14 @@ def add_to_perioddata(sfrdata, data, flowline_routing=None,
 
     # check for duplicate inflows in same path
     if variable == 'inflow' and one_inflow_per_path:
-        line_ids = set(data['line_id_in_model'])
+        subtree_index = SubtreeIndex(RoutingGraph.from_dict(flowline_routing))
+        line_ids = np.array([lid for lid in set(data['line_id_in_model'])
+                             if lid in subtree_index.graph])
         drop = set()
         dropped_line_info_file = 'dropped_inflows_locations.csv'
         for lid in line_ids:
-            path = find_path(flowline_routing, start=lid)
-            duplicated = set(path[1:]).intersection(line_ids)
+            # other line_ids that lid is upstream of
+            duplicated = set(line_ids[subtree_index.is_upstream(lid, line_ids)].tolist())
             if len(duplicated) > 0:
                 drop.add(lid)
                 txt = ('warning: {}: {} is upstream '
@@ -6,17 +6,124 @@ import time
 import traceback
 import fiona
 import numpy as np
+import pandas as pd
 import pyproj
-from shapely.geometry import shape, Polygon, box
+import shapely
+from shapely.geometry import shape, MultiPolygon, Polygon, box
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
 from shapely.ops import unary_union
 import gisutils
-from gisutils import df2shp, shp2df, project, get_shapefile_crs, get_authority_crs
+from gisutils import df2shp, shp2df, get_shapefile_crs, get_authority_crs
+from gisutils import project as _gisutils_project
 import sfrmaker
 
 if version.parse(gisutils.__version__) < version.parse('0.2.2'):
     warnings.warn('Automatic reprojection functionality requires gis-utils >= 0.2.2'
                   '\nPlease pip install --upgrade gis-utils')
 
+# bulk STRtree queries with a predicate require shapely >= 2.0
+shapely2 = version.parse(shapely.__version__) >= version.parse('2.0')
+
+
+# pyproj Transformers keyed by (source CRS, destination CRS) WKT,
+# so that repeated reprojections within a session don't pay the setup cost
+_transformers = {}
+
+
+def get_transformer(crs1, crs2):
+    """Get a cached :class:`pyproj.Transformer` between two coordinate
+    reference systems (with x, y axis order).
+
+    Parameters
+    ----------
+    crs1 : obj
+        Source coordinate reference system. Any input accepted by
+        :meth:`pyproj.crs.CRS.from_user_input`.
+    crs2 : obj
+        Destination coordinate reference system.
+
+    Returns
+    -------
+    transformer : pyproj.Transformer
+    """
+    crs1 = pyproj.CRS.from_user_input(crs1)
+    crs2 = pyproj.CRS.from_user_input(crs2)
+    key = (crs1.to_wkt(), crs2.to_wkt())
+    transformer = _transformers.get(key)
+    if transformer is None:
+        transformer = pyproj.Transformer.from_crs(crs1, crs2, always_xy=True)
+        _transformers[key] = transformer
+    return transformer
+
+
+def _transform_geometries(transformer, geoms):
+    """Reproject an array of shapely geometries in bulk,
+    by transforming all of their coordinates at once."""
+
+    def transform_xy(coords):
+        xyz = transformer.transform(*coords.T, errcheck=True)
+        return np.column_stack(xyz)
+
+    geoms = np.asarray(geoms, dtype=object)
+    has_z = shapely.has_z(geoms)
+    if not has_z.any():
+        return shapely.transform(geoms, transform_xy)
+    # keep the z coordinates for any 3D geometries
+    result = np.empty(len(geoms), dtype=object)
+    result[~has_z] = shapely.transform(geoms[~has_z], transform_xy)
+    result[has_z] = shapely.transform(geoms[has_z], transform_xy, include_z=True)
+    return result
+
+
+def _project(transformer, geom):
+    # (x, y) tuple of scalars or sequences
+    if isinstance(geom, tuple):
+        return transformer.transform(*geom, errcheck=True)
+    if isinstance(geom, BaseGeometry):
+        return _transform_geometries(transformer, [geom])[0]
+    geom = list(geom)
+    # sequence of (x, y) tuples
+    if len(geom) > 0 and isinstance(geom[0], tuple):
+        a = np.array(geom)
+        return transformer.transform(a[:, 0], a[:, 1], errcheck=True)
+    return list(_transform_geometries(transformer, geom))
+
+
+def project(geom, crs1, crs2):
+    """Reproject shapely geometry object(s) or scalar coordinates
+    to a new coordinate reference system. Drop-in replacement for
+    :func:`gisutils.project` that reuses cached transformers
+    and transforms collections of geometries in bulk.
+
+    Parameters
+    ----------
+    geom : shapely geometry object, sequence of shapely geometry objects,
+        sequence of (x, y) tuples, or (x, y) tuple.
+    crs1 : obj
+        Source coordinate reference system. Any input accepted by
+        :meth:`pyproj.crs.CRS.from_user_input`.
+    crs2 : obj
+        Destination coordinate reference system.
+
+    Returns
+    -------
+    reprojected : same type as geom (sequences of geometries
+        are returned as lists)
+    """
+    if not shapely2:
+        return _gisutils_project(geom, crs1, crs2)
+    transformer = get_transformer(crs1, crs2)
+    try:
+        reprojected = _project(transformer, geom)
+    except pyproj.ProjError:
+        # in the case of a network error,
+        # try using environmental variables for SSL certificate
+        # https://pyproj4.github.io/pyproj/stable/api/network.html
+        pyproj.network.set_ca_bundle_path(False)
+        reprojected = _project(transformer, geom)
+    return reprojected
+
 
 def get_crs(prjfile=None, epsg=None, proj_str=None, crs=None):
     if crs is not None:
@@ -71,16 +178,151 @@ def export_reach_data(reach_data, grid, filename,
     assert isinstance(grid, sfrmaker.grid.Grid), "grid needs to be an sfrmaker.Grid instance"
     assert np.array_equal(grid.df.node.values, np.arange(grid.size))
     assert np.array_equal(grid.df.node.values, grid.df.index.values)
-    polygons = grid.df.loc[rd.node, 'geometry'].values
+    polygons = grid.get_cell_polygons(rd.node)
     if geomtype.lower() == 'polygon':
         rd['geometry'] = polygons
     elif geomtype.lower() == 'point':
-        rd['geometry'] = [p.centroid for p in polygons]
+        rd['geometry'] = shapely.points(get_centroids(polygons)) if shapely2 \
+            else [p.centroid for p in polygons]
     else:
         raise ValueError('Unrecognized geomtype "{}"'.format(geomtype))
     df2shp(rd, filename, crs=grid.crs)
 
 
+def geometry_array(geoms):
+    """Get a sequence of shapely geometries (list, numpy array
+    or DataFrame geometry column) as a 1D numpy object array, which
+    the vectorized shapely 2 functions operate on directly.
+    """
+    if isinstance(geoms, pd.Series):
+        geoms = geoms.values
+    if isinstance(geoms, np.ndarray) and geoms.dtype == object:
+        return geoms
+    array = np.empty(len(geoms), dtype=object)
+    array[:] = list(geoms)
+    return array
+
+
+def get_lengths(geoms):
+    """Lengths of a sequence of shapely geometries, as a numpy array."""
+    geoms = geometry_array(geoms)
+    if shapely2:
+        return shapely.length(geoms)
+    return np.array([g.length for g in geoms], dtype=float)
+
+
+def get_centroids(geoms):
+    """Centroids of a sequence of shapely geometries,
+    as an (n, 2) array of x, y coordinates."""
+    geoms = geometry_array(geoms)
+    if shapely2:
+        return shapely.get_coordinates(shapely.centroid(geoms))
+    return np.array([g.centroid.coords[0][:2] for g in geoms], dtype=float).reshape(-1, 2)
+
+
+def get_buffers(geoms, distance, **kwargs):
+    """Buffer a sequence of shapely geometries.
+
+    Parameters
+    ----------
+    geoms : sequence of shapely geometries
+    distance : float or sequence of floats
+    **kwargs : keyword arguments to shapely buffer (e.g. cap_style)
+
+    Returns
+    -------
+    buffers : 1D numpy object array of Polygons
+    """
+    geoms = geometry_array(geoms)
+    if shapely2:
+        return shapely.buffer(geoms, distance, **kwargs)
+    distance = np.broadcast_to(distance, len(geoms))
+    return geometry_array([g.buffer(d, **kwargs) for g, d in zip(geoms, distance)])
+
+
+def get_bounds(geoms):
+    """Bounding boxes of a sequence of shapely geometries,
+    as an (n, 4) array of (xmin, ymin, xmax, ymax). Bounds of
+    empty geometries are NaN."""
+    geoms = geometry_array(geoms)
+    if shapely2:
+        return shapely.bounds(geoms)
+    return np.array([g.bounds if not g.is_empty else (np.nan,) * 4
+                     for g in geoms], dtype=float).reshape(-1, 4)
+
+
+def build_strtree_index(geom):
+    """Builds a shapely STRtree index. Useful for multiple intersections
+    with same index. Unlike :func:`build_rtree_index`, the tree is
+    bulk-loaded from all geometries at once.
+
+    Parameters
+    ==========
+    geom : list
+        list of shapely geometry objects
+    Returns
+        idx : shapely.strtree.STRtree instance
+    """
+    print('\nBuilding spatial index...')
+    ta = time.time()
+    idx = STRtree(list(geom))
+    print("finished in {:.2f}s".format(time.time() - ta))
+    return idx
+
+
+def intersect_strtree(geom1, geom2, index=None):
+    """Intersect features in geom1 with those in geom2, returning
+    all intersecting pairs at once.
+
+    Parameters:
+    ----------
+    geom1 : list
+        list of shapely geometry objects
+    geom2 : list
+        list of shapely geometry objects to be intersected with features in geom1
+    index : shapely.strtree.STRtree, optional
+        STRtree built from geom1 (e.g. :py:attr:`Grid.spatial_index`),
+        if one has already been created.
+
+    Returns:
+    -------
+    geom2_inds, geom1_inds : 1D integer arrays of equal length
+        Each position is one intersecting pair, consisting of
+        an index into geom2 and an index into geom1. Pairs are
+        sorted by geom2 index, then by geom1 index.
+    """
+    if not isinstance(index, STRtree):
+        index = build_strtree_index(geom1)
+    print('\nIntersecting {} features...'.format(len(geom2)))
+    ta = time.time()
+    if shapely2:
+        geom2_inds, geom1_inds = index.query(list(geom2), predicate='intersects')
+    # shapely < 2; query each feature in geom2 against the tree,
+    # then test each candidate for intersection
+    else:
+        geom1_lookup = {id(g): i for i, g in enumerate(geom1)}
+        geom2_inds, geom1_inds = [], []
+        for i, g in enumerate(geom2):
+            inds = [geom1_lookup[id(c)] for c in index.query(g)
+                    if c.intersects(g)]
+            geom2_inds += [i] * len(inds)
+            geom1_inds += inds
+    geom2_inds = np.asarray(geom2_inds, dtype=int)
+    geom1_inds = np.asarray(geom1_inds, dtype=int)
+    order = np.lexsort((geom1_inds, geom2_inds))
+    print("finished in {:.2f}s".format(time.time() - ta))
+    return geom2_inds[order], geom1_inds[order]
+
+
+def group_intersections(geom2_inds, geom1_inds, n):
+    """Convert intersecting pairs returned by :func:`intersect_strtree`
+    to a list of lists, with one list of geom1 indices
+    for each of the n features in geom2.
+    """
+    breaks = np.searchsorted(geom2_inds, np.arange(1, n))
+    return [inds.tolist() for inds in np.split(geom1_inds, breaks)]
+
+
 def intersect_rtree(geom1, geom2, index=None):
     """Intersect features in geom1 with those in geom2. For each feature in geom2, return a list of
      the indices of the intersecting features in geom1.
@@ -91,30 +333,22 @@ def intersect_rtree(geom1, geom2, index=None):
         list of shapely geometry objects
     geom2 : list
         list of shapely polygon objects to be intersected with features in geom1
-    index :
-        use an index that has already been created
+    index : shapely.strtree.STRtree, optional
+        use an index that has already been created. Other index
+        types (e.g. from :func:`build_rtree_index`) are ignored.
 
     Returns:
     -------
     A list of the same length as geom2; containing for each feature in geom2,
     a list of indicies of intersecting geometries in geom1.
+
+    Notes
+    -----
+    This is a wrapper around :func:`intersect_strtree`,
+    which does all of the intersections in a single query.
     """
-    if index is None:
-        idx = build_rtree_index(geom1)
-    else:
-        idx = index
-    isfr = []
-    print('\nIntersecting {} features...'.format(len(geom2)))
-    ta = time.time()
-    for pind, poly in enumerate(geom2):
-        print('\r{}'.format(pind + 1), end='')
-        # test for intersection with bounding box of each polygon feature in geom2 using spatial index
-        inds = [i for i in idx.intersection(poly.bounds)]
-        # test each feature inside the bounding box for intersection with the polygon geometry
-        inds = [i for i in inds if geom1[i].intersects(poly)]
-        isfr.append(inds)
-    print("\nfinished in {:.2f}s".format(time.time() - ta))
-    return isfr
+    geom2_inds, geom1_inds = intersect_strtree(geom1, geom2, index=index)
+    return group_intersections(geom2_inds, geom1_inds, len(geom2))
 
 
 def intersect(geom1, geom2):
@@ -147,6 +381,110 @@ def intersect(geom1, geom2):
     return isfr
 
 
+def dissolve_cells(polygons):
+    """Dissolve model cell polygons that share vertices and edges
+    (e.g. from a DISV grid) into their outer boundary. Edges that are
+    shared by two cells are canceled, and the remaining boundary edges
+    are chained into rings. Much faster than :func:`shapely.ops.unary_union`
+    for large numbers of cells.
+
+    Parameters
+    ----------
+    polygons : sequence of shapely Polygons
+        Cells to dissolve.
+
+    Returns
+    -------
+    dissolved : shapely Polygon or MultiPolygon
+
+    Notes
+    -----
+    Falls back to :func:`shapely.ops.unary_union` if the cells don't
+    share their vertices exactly (for example, if a larger cell borders
+    two smaller cells along one of its edges, without a vertex at the junction),
+    or with shapely < 2.
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    if not shapely2 or len(polygons) == 0:
+        return unary_union(polygons)
+    print('Dissolving {:,d} cells...'.format(len(polygons)))
+    ta = time.time()
+    coords, ring = shapely.get_coordinates(shapely.get_exterior_ring(polygons),
+                                           return_index=True)
+    # number vertices by their (exact) coordinates
+    vertices, vertex = np.unique(coords, axis=0, return_inverse=True)
+    vertex = np.ravel(vertex)
+
+    # edges between consecutive vertices in each cell ring
+    # (rings are closed, so this includes the edge back to the start)
+    in_ring = ring[:-1] == ring[1:]
+    u, v = vertex[:-1][in_ring], vertex[1:][in_ring]
+    edge_ring = ring[:-1][in_ring]
+    # orient all of the cell rings counter-clockwise
+    x0, y0 = vertices[u].T
+    x1, y1 = vertices[v].T
+    signed_area = np.bincount(edge_ring, weights=x0 * y1 - x1 * y0, minlength=len(polygons))
+    clockwise = signed_area[edge_ring] < 0
+    u, v = np.where(clockwise, v, u), np.where(clockwise, u, v)
+    keep = u != v
+    u, v = u[keep], v[keep]
+
+    # cancel interior edges, which are shared by two cells
+    # (in opposite directions); the rest are on the boundary
+    _, edge, counts = np.unique(np.minimum(u, v) * len(vertices) + np.maximum(u, v),
+                                return_inverse=True, return_counts=True)
+    boundary = counts[np.ravel(edge)] == 1
+    u, v = u[boundary], v[boundary]
+
+    # chain the boundary edges into rings
+    order = np.argsort(u, kind='mergesort')
+    u, v = u[order], v[order]
+    next_edge = np.searchsorted(u, np.arange(len(vertices)))
+    used = np.zeros(len(u), dtype=bool)
+    rings = []
+    for start in range(len(u)):
+        if used[start]:
+            continue
+        current = start
+        ring_vertices = [u[start]]
+        while True:
+            used[current] = True
+            ring_vertices.append(v[current])
+            if v[current] == ring_vertices[0]:
+                break
+            # next unused edge leaving the end of this one
+            current = next_edge[v[current]]
+            while current < len(u) and used[current]:
+                current += 1
+            if current == len(u) or u[current] != ring_vertices[-1]:
+                return unary_union(polygons)
+        rings.append(vertices[ring_vertices])
+
+    # counter-clockwise rings are exteriors; clockwise rings are holes
+    rings = [Polygon(r) for r in rings]
+    exteriors = [r for r in rings if r.exterior.is_ccw]
+    holes = [r for r in rings if not r.exterior.is_ccw]
+    interiors = [[] for _ in exteriors]
+    for hole in holes:
+        containing = [i for i, e in enumerate(exteriors)
+                      if e.area > hole.area and e.covers(hole)]
+        if len(containing) == 0:
+            return unary_union(polygons)
+        # holes go in the smallest containing exterior
+        # (in case of islands of active cells inside of holes)
+        i = min(containing, key=lambda i: exteriors[i].area)
+        interiors[i].append(hole.exterior.coords)
+    dissolved = [Polygon(e.exterior.coords, holes=h) for e, h in zip(exteriors, interiors)]
+    dissolved = dissolved[0] if len(dissolved) == 1 else MultiPolygon(dissolved)
+
+    # check the result
+    if not dissolved.is_valid or \
+            not np.isclose(dissolved.area, shapely.area(polygons).sum(), rtol=1e-6):
+        return unary_union(polygons)
+    print("finished in {:.2f}s".format(time.time() - ta))
+    return dissolved
+
+
 def parse_units_from_proj_str(proj_str):
     units = None
     from pyproj import CRS
@@ -3,6 +3,7 @@ Module for working with model grids. For examples of how to easily set
 up a StructuredGrid instance, see :ref:`Basic usage of SFRmaker in a scripting context`.
 """
 
+import hashlib
 import os
 import warnings
 
@@ -10,13 +11,14 @@ import fiona
 import flopy
 import numpy as np
 import pandas as pd
+import shapely
 from rasterio import Affine
 from rasterio import features
-from shapely.geometry import Polygon, shape
+from shapely.geometry import LineString, MultiPolygon, Polygon, shape
 from shapely.ops import unary_union
 from gisutils import shp2df, df2shp, get_shapefile_crs
 from .gis import get_crs, read_polygon_feature, \
-    build_rtree_index, intersect
+    build_strtree_index, intersect_strtree, dissolve_cells, shapely2
 
 fm = flopy.modflow
 
@@ -110,7 +112,7 @@ class Grid:
         if self._bounds is None:
             allX = []  # all x coordinates
             allY = []  # all y coordinatess
-            geoms = self.df.geometry.tolist()  # cell polygons
+            geoms = self.get_cell_polygons()
             for g in geoms:
                 gx, gy = g.exterior.coords.xy
                 allX += gx
@@ -126,9 +128,9 @@ class Grid:
 
     @property
     def spatial_index(self):
-        """Rtree index for intersecting features with model grid."""
+        """STRtree index for intersecting features with model grid."""
         if self._idx is None:
-            self._idx = build_rtree_index(self.df.geometry.tolist())
+            self._idx = build_strtree_index(self.get_cell_polygons())
         return self._idx
 
     @property
@@ -178,21 +180,37 @@ class Grid:
     def _set_isfr_from_active_area(self):
         """Intersect model grid cells with active area polygon,
         assign isfr = 1 to cells that intersect."""
-        # intersections = intersect_rtree(self.df.geometry.tolist(),
-        #                                [self.active_area],
-        #                                index=self.spatial_index)
         print('setting isfr values...')
-        intersections = intersect(self.df.geometry.tolist(),
-                                  [self.active_area])
+        _, intersections = intersect_strtree(self.get_cell_polygons(),
+                                             [self.active_area],
+                                             index=self.spatial_index)
         self.df.sort_values(by='node', inplace=True)
         self.df['isfr'] = 0
-        self.df.loc[np.squeeze(intersections), 'isfr'] = 1
+        self.df.loc[intersections, 'isfr'] = 1
 
     def create_active_area_polygon_from_isfr(self):
         """The StructuredGrid and UnstructuredGrid classes
         have their own ways of doing this."""
         return
 
+    def get_cell_polygons(self, nodes=None):
+        """Get shapely Polygons for the model cells.
+
+        Parameters
+        ----------
+        nodes : sequence of ints, optional
+            Node numbers of the cells to get Polygons for.
+            By default, None, in which case Polygons are returned
+            for all cells, in the order of the :attr:`df`.
+
+        Returns
+        -------
+        polygons : 1D array of shapely Polygons
+        """
+        if nodes is None:
+            return self.df['geometry'].values
+        return self.df.loc[nodes, 'geometry'].values
+
     def get_node(self, k, i, j):
         return k * self.nrow * self.ncol + i * self.ncol + j
 
@@ -206,7 +224,11 @@ class Grid:
         df2shp(df, outshp, crs=self.crs)
 
     def write_grid_shapefile(self, outshp='grid.shp'):
-        df2shp(self.df, outshp, crs=self.crs)
+        df = self.df
+        if 'geometry' not in df.columns:
+            df = df.copy()
+            df['geometry'] = self.get_cell_polygons()
+        df2shp(df, outshp, crs=self.crs)
 
 
 class StructuredGrid(Grid):
@@ -246,6 +268,18 @@ class StructuredGrid(Grid):
         Grid rotation angle in degrees, counter-clockwise
         about the origin, by default 0. Only used for creating
         the :attr:`transform` attribute, by default None
+    delr : sequence of floats, optional
+        Cell spacings along the rows (column widths), for grids
+        that are rectilinear but not uniform. Along with xul, yul and rotation,
+        used for intersecting lines with the grid (see :meth:`walk_line`),
+        by default None
+    delc : sequence of floats, optional
+        Cell spacings along the columns (row heights), by default None
+    vertices : tuple of 2D arrays, optional
+        (xvertices, yvertices) arrays of cell corner coordinates,
+        of shape (nrow + 1, ncol + 1). If the df doesn't have a geometry column,
+        cell Polygons are only created from the vertices as they are needed
+        (see :meth:`get_cell_polygons`), by default None
     uniform : bool, optional
         Optional flag indicating the grid is uniform, 
         by default None
@@ -279,7 +313,7 @@ class StructuredGrid(Grid):
 
     def __init__(self, df,
                  xul=None, yul=None, dx=None, dy=None, rotation=0.,
-                 uniform=None,
+                 delr=None, delc=None, vertices=None, uniform=None,
                  model_units='undefined', crs_units=None,
                  bounds=None, active_area=None,
                  epsg=None, proj_str=None, prjfile=None, **kwargs):
@@ -300,6 +334,13 @@ class StructuredGrid(Grid):
         self.dx = dx
         self.dy = dy
 
+        # rectilinear structured grid parameters
+        self.delr = delr
+        self.delc = delc
+
+        # cell corners, for creating cell polygons as needed
+        self._vertices = vertices
+
         self.nlay = df.k.max() + 1
         self.nrow = df.i.max() + 1
         self.ncol = df.j.max() + 1
@@ -315,7 +356,7 @@ class StructuredGrid(Grid):
     def uniform(self):
         """Check if cells are uniform by comparing their areas."""
         if self._uniform is None:
-            areas = [g.area for g in self.df.geometry]
+            areas = [g.area for g in self.get_cell_polygons()]
             self._uniform = np.allclose(areas, np.mean(areas), rtol=0.01)
         return self._uniform
 
@@ -330,8 +371,87 @@ class StructuredGrid(Grid):
                     print('This method requires a uniform grid and '
                           'specification of xul, yul, dx, dy, and rotation.')
                     return
-            return Affine(self.dx, 0., self.xul,
-                          0., -self.dy, self.yul) * Affine.rotation(self.rotation)
+            # scale to cell size (with rows increasing downward),
+            # then rotate counter-clockwise about the upper left corner
+            return Affine.translation(self.xul, self.yul) * \
+                   Affine.rotation(self.rotation) * \
+                   Affine.scale(self.dx, -self.dy)
+
+    def _set_isfr_from_active_area(self):
+        """Rasterize the active area polygon to the model grid,
+        assign isfr = 1 to cells that it touches. Non-uniform grids
+        are rasterized in row and column index space, from the :attr:`edges`
+        (see :func:`to_grid_index_space`). Falls back to intersecting
+        the cell polygons (:meth:`Grid._set_isfr_from_active_area`)
+        if the grid edges aren't known.
+        """
+        transform = self.transform
+        active_area = self.active_area
+        if transform is None:
+            if self.edges is None:
+                return super()._set_isfr_from_active_area()
+            active_area = to_grid_index_space(active_area, self.xul, self.yul,
+                                              self.rotation, *self.edges)
+            transform = Affine.identity()
+        print('setting isfr values...')
+        isfr = features.rasterize([active_area], out_shape=(self.nrow, self.ncol),
+                                  transform=transform, all_touched=True,
+                                  fill=0, default_value=1, dtype=np.int32)
+        self.df.sort_values(by='node', inplace=True)
+        self.df['isfr'] = isfr.ravel()[self.df['node'].values]
+
+    @property
+    def edges(self):
+        """Locations of the column and row edges, as distances from the
+        upper left corner along the (rotated) rows and columns. None if the
+        grid origin or cell spacing isn't known.
+        """
+        if self.xul is None or self.yul is None:
+            return
+        delr, delc = self.delr, self.delc
+        if delr is None and self.dx is not None:
+            delr = np.ones(self.ncol) * self.dx
+        if delc is None and self.dy is not None:
+            delc = np.ones(self.nrow) * self.dy
+        if delr is None or delc is None:
+            return
+        col_edges = np.append(0., np.cumsum(delr))
+        row_edges = np.append(0., np.cumsum(delc))
+        return col_edges, row_edges
+
+    def walk_line(self, part):
+        """Intersect a LineString with the grid by walking along it,
+        splitting it at each row or column edge that it crosses. Only
+        works if the :attr:`edges` are known; cell polygons aren't used.
+        See :func:`walk_line`.
+        """
+        return walk_line(part, self.xul, self.yul, self.rotation, *self.edges)
+
+    def locate_points(self, x, y):
+        """Get the node numbers of the cells containing points,
+        from the grid :attr:`edges` (cell polygons aren't used).
+
+        Parameters
+        ----------
+        x, y : arrays of point coordinates
+            In the grid's coordinate reference system.
+
+        Returns
+        -------
+        nodes : array of ints, with the same shape as x and y
+            Node numbers of the cells containing the points;
+            -1 for points outside of the grid.
+        """
+        col_edges, row_edges = self.edges
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        theta = np.radians(self.rotation or 0.)
+        u = (x - self.xul) * np.cos(theta) + (y - self.yul) * np.sin(theta)
+        v = (x - self.xul) * np.sin(theta) - (y - self.yul) * np.cos(theta)
+        j = np.searchsorted(col_edges, u, side='right') - 1
+        i = np.searchsorted(row_edges, v, side='right') - 1
+        inside = (i >= 0) & (i < self.nrow) & (j >= 0) & (j < self.ncol)
+        return np.where(inside, i * self.ncol + j, -1)
 
     def create_active_area_polygon_from_isfr(self):
         """Convert 2D numpy array representing active area where
@@ -348,7 +468,31 @@ class StructuredGrid(Grid):
             areas = [s.area for s in shapes]
             self._active_area = shapes[np.argmax(areas)]
         else:
-            self._active_area = unary_union(self.df.loc[self.df.isfr == 1, 'geometry'])
+            self._active_area = unary_union(
+                self.get_cell_polygons(self.df.loc[self.df.isfr == 1, 'node']))
+
+    def get_cell_polygons(self, nodes=None):
+        """Get shapely Polygons for the model cells. If the :attr:`df`
+        doesn't have a geometry column (see :meth:`from_modelgrid`),
+        the Polygons are created from the cell vertices.
+
+        Parameters
+        ----------
+        nodes : sequence of ints, optional
+            Node numbers of the cells to get Polygons for.
+            By default, None, in which case Polygons are returned
+            for all cells, in the order of the :attr:`df`.
+
+        Returns
+        -------
+        polygons : 1D array of shapely Polygons
+        """
+        if 'geometry' in self.df.columns or self._vertices is None:
+            return super().get_cell_polygons(nodes)
+        if nodes is None:
+            nodes = self.df['node'].values
+        i, j = np.divmod(np.asarray(nodes, dtype=int), self.ncol)
+        return cell_polygons_from_vertices(*self._vertices, i, j)
 
     @classmethod
     def from_json(cls, jsonfile, active_area=None, isfr=None,
@@ -366,17 +510,28 @@ class StructuredGrid(Grid):
 
     @classmethod
     def from_modelgrid(cls, mg=None, active_area=None, isfr=None,
-                       crs=None, epsg=None, proj_str=None, prjfile=None):
+                       crs=None, epsg=None, proj_str=None, prjfile=None,
+                       lazy_polygons=False):
         """Create StructureGrid class instance from a
-        flopy.discretization.StructuredGrid instance."""
+        flopy.discretization.StructuredGrid instance.
+
+        Parameters
+        ----------
+        lazy_polygons : bool, optional
+            If True, the :attr:`df` is created without a geometry column,
+            and cell Polygons are only created as they are needed,
+            for the cells that need them (see :meth:`get_cell_polygons`).
+            This saves time and memory for large grids. By default, False.
+        """
         i, j = np.indices((mg.nrow, mg.ncol))
-        vertices = mg._cell_vert_list(i.ravel(), j.ravel())
-        polygons = [Polygon(v) for v in vertices]
-        df = pd.DataFrame({'node': range(0, len(vertices)),
-                           'i': sorted(list(range(mg.nrow)) * mg.ncol),
-                           'j': list(range(mg.ncol)) * mg.nrow,
-                           'geometry': polygons
-                           }, columns=['node', 'i', 'j', 'geometry'])
+        i, j = i.ravel(), j.ravel()
+        vertices = mg.xvertices, mg.yvertices
+        df = pd.DataFrame({'node': np.arange(mg.nrow * mg.ncol),
+                           'i': i,
+                           'j': j,
+                           }, columns=['node', 'i', 'j'])
+        if not lazy_polygons:
+            df['geometry'] = cell_polygons_from_vertices(*vertices, i, j)
         if epsg is None:
             epsg = mg.epsg
         crs = get_crs(prjfile=prjfile, epsg=epsg, proj_str=mg.proj4, crs=crs)
@@ -410,6 +565,7 @@ class StructuredGrid(Grid):
         return cls.from_dataframe(df, uniform=uniform,
                                   xul=xul, yul=yul, dx=dx, dy=dy,
                                   rotation=mg.angrot,
+                                  delr=mg.delr, delc=mg.delc, vertices=vertices,
                                   bounds=bounds, active_area=active_area,
                                   crs=crs)
 
@@ -443,7 +599,7 @@ class StructuredGrid(Grid):
                        active_area=None,
                        crs=None, epsg=None, proj_str=None, prjfile=None, **kwargs):
 
-        assert geometry_column in df.columns, \
+        assert geometry_column in df.columns or kwargs.get('vertices') is not None, \
             "No feature geometries found in dataframe column '{}'".format(geometry_column)
 
         assert icol in df.columns, "No icol='{}' not found".format(icol)
@@ -487,6 +643,187 @@ class StructuredGrid(Grid):
                    crs=crs, **kwargs)
 
 
+def cell_polygons_from_vertices(xvertices, yvertices, i, j):
+    """Create shapely Polygons for structured grid cells,
+    in a single vectorized call (with shapely >= 2).
+
+    Parameters
+    ----------
+    xvertices, yvertices : 2D arrays
+        Cell corner coordinates, of shape (nrow + 1, ncol + 1)
+        (e.g. :attr:`flopy.discretization.StructuredGrid.xvertices`).
+    i, j : 1D arrays
+        Row and column locations of the cells.
+
+    Returns
+    -------
+    polygons : 1D array of shapely Polygons
+    """
+    # corners in the same order as flopy's StructuredGrid._cell_vert_list
+    rows = np.stack([i, i + 1, i + 1, i, i], axis=-1)
+    cols = np.stack([j, j, j + 1, j + 1, j], axis=-1)
+    coords = np.stack([xvertices[rows, cols], yvertices[rows, cols]], axis=-1)
+    if shapely2:
+        return shapely.polygons(coords)
+    polygons = np.empty(len(coords), dtype=object)
+    polygons[:] = [Polygon(c) for c in coords]
+    return polygons
+
+
+def _edge_index(u, edges):
+    """Convert distances along the rows or columns of a grid to fractional
+    column or row indices (linear within each cell, and extended
+    beyond the grid with the widths of the first and last cells)."""
+    index = np.interp(u, edges, np.arange(len(edges), dtype=float))
+    below = u < edges[0]
+    index[below] = (u[below] - edges[0]) / (edges[1] - edges[0])
+    above = u > edges[-1]
+    index[above] = len(edges) - 1 + (u[above] - edges[-1]) / (edges[-1] - edges[-2])
+    return index
+
+
+def _ring_to_grid_index_space(coords, xul, yul, rotation, col_edges, row_edges):
+    """Densify a ring of coordinates at each row and column edge that it crosses,
+    and convert the coordinates to fractional (column, row) indices.
+    Because the conversion is linear within each cell, straight segments
+    between the edge crossings stay straight."""
+    x, y = np.array(coords)[:, :2].T
+    theta = np.radians(rotation or 0.)
+    u = (x - xul) * np.cos(theta) + (y - yul) * np.sin(theta)
+    v = (x - xul) * np.sin(theta) - (y - yul) * np.cos(theta)
+    nseg = len(u) - 1
+    segments = [np.arange(nseg)]
+    positions = [np.zeros(nseg)]
+    for values, edges in (u, col_edges), (v, row_edges):
+        v0, v1 = values[:-1], values[1:]
+        # edges strictly between the start and end of each segment
+        start = np.searchsorted(edges, np.minimum(v0, v1), side='right')
+        count = np.maximum(np.searchsorted(edges, np.maximum(v0, v1), side='left') - start, 0)
+        seg = np.repeat(np.arange(nseg), count)
+        offsets = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        crossings = edges[np.repeat(start, count) + offsets]
+        segments.append(seg)
+        positions.append((crossings - v0[seg]) / (v1 - v0)[seg])
+    seg = np.concatenate(segments)
+    t = np.concatenate(positions)
+    order = np.lexsort((t, seg))
+    seg, t = seg[order], t[order]
+    u = np.append(u[seg] + t * (u[1:] - u[:-1])[seg], u[-1])
+    v = np.append(v[seg] + t * (v[1:] - v[:-1])[seg], v[-1])
+    return np.column_stack([_edge_index(u, col_edges), _edge_index(v, row_edges)])
+
+
+def to_grid_index_space(polygon, xul, yul, rotation, col_edges, row_edges):
+    """Convert a Polygon or MultiPolygon to fractional (column, row) index
+    coordinates for a rectilinear (and possibly rotated) structured grid,
+    so that it can be rasterized to the grid with an identity transform,
+    without making the cell polygons.
+
+    Parameters
+    ----------
+    polygon : Polygon or MultiPolygon
+    xul, yul : float
+        Upper left corner of the grid.
+    rotation : float
+        Grid rotation angle in degrees, counter-clockwise
+        about the upper left corner.
+    col_edges, row_edges : 1D arrays
+        Locations of the column and row edges, as distances from the
+        upper left corner along the (rotated) rows and columns
+        (see :attr:`StructuredGrid.edges`).
+
+    Returns
+    -------
+    polygon : Polygon or MultiPolygon
+    """
+    args = xul, yul, rotation, col_edges, row_edges
+    if polygon.geom_type == 'MultiPolygon':
+        return MultiPolygon([to_grid_index_space(p, *args) for p in polygon.geoms])
+    return Polygon(_ring_to_grid_index_space(polygon.exterior.coords, *args),
+                   [_ring_to_grid_index_space(ring.coords, *args)
+                    for ring in polygon.interiors])
+
+
+def walk_line(part, xul, yul, rotation, col_edges, row_edges):
+    """Intersect a LineString with a rectilinear (and possibly rotated)
+    structured grid by walking along it, splitting it at each row or column
+    edge that it crosses.
+
+    Parameters
+    ----------
+    part: LineString
+        Shapely LineString object (or a part of a MultiLineString)
+    xul, yul : float
+        Upper left corner of the grid.
+    rotation : float
+        Grid rotation angle in degrees, counter-clockwise
+        about the upper left corner.
+    col_edges, row_edges : 1D arrays
+        Locations of the column and row edges, as distances from the
+        upper left corner along the (rotated) rows and columns
+        (see :attr:`StructuredGrid.edges`).
+
+    Returns
+    -------
+    ordered_reach_geoms: list of LineStrings
+        List of LineString objects representing the SFR reaches for the segment,
+        in order along the LineString. Consecutive fragments in the same cell
+        are combined into a single reach.
+    ordered_node_numbers: list of ints
+        List of model cells containing the SFR reaches for the segment
+    """
+    x, y = np.array(part.coords)[:, :2].T
+    vertices = np.arange(len(x))
+
+    # transform the vertices to distances from the upper left corner
+    # along the rows (u) and columns (v)
+    theta = np.radians(rotation or 0.)
+    u = (x - xul) * np.cos(theta) + (y - yul) * np.sin(theta)
+    v = (x - xul) * np.sin(theta) - (y - yul) * np.cos(theta)
+
+    # locate each vertex and edge crossing by its position along the line
+    # (line segment number + fraction of that segment)
+    positions = [vertices.astype(float)]
+    for w, edges in (u, col_edges), (v, row_edges):
+        w0, w1 = w[:-1], w[1:]
+        first = np.searchsorted(edges, np.minimum(w0, w1), side='right')
+        last = np.searchsorted(edges, np.maximum(w0, w1), side='left')
+        ncrossings = np.maximum(last - first, 0)
+        segment = np.repeat(np.arange(len(w0)), ncrossings)
+        nth = np.arange(ncrossings.sum()) - np.repeat(np.cumsum(ncrossings) - ncrossings,
+                                                      ncrossings)
+        crossed = edges[first[segment] + nth]
+        positions.append(segment + (crossed - w0[segment]) / (w1[segment] - w0[segment]))
+    positions = np.unique(np.concatenate(positions))
+
+    # locate the cell containing each fragment between consecutive positions;
+    # drop zero-length fragments (e.g. from duplicate vertices)
+    px = np.interp(positions, vertices, x)
+    py = np.interp(positions, vertices, y)
+    midpoints = 0.5 * (positions[:-1] + positions[1:])
+    j = np.searchsorted(col_edges, np.interp(midpoints, vertices, u), side='right') - 1
+    i = np.searchsorted(row_edges, np.interp(midpoints, vertices, v), side='right') - 1
+    nrow, ncol = len(row_edges) - 1, len(col_edges) - 1
+    nodes = np.where((i >= 0) & (i < nrow) & (j >= 0) & (j < ncol),
+                     i * ncol + j, -1)
+    starts = np.flatnonzero(np.hypot(np.diff(px), np.diff(py)) > 0)
+    nodes = nodes[starts]
+
+    # combine consecutive fragments within the same cell into reaches
+    ordered_reach_geoms = []
+    ordered_node_numbers = []
+    if len(nodes) == 0:
+        return ordered_reach_geoms, ordered_node_numbers
+    breaks = np.flatnonzero(np.diff(nodes) != 0) + 1
+    for first, last in zip(np.append(0, breaks), np.append(breaks, len(nodes))):
+        if nodes[first] < 0:
+            continue
+        coords = np.append(starts[first], starts[first:last] + 1)
+        ordered_reach_geoms.append(LineString(list(zip(px[coords], py[coords]))))
+        ordered_node_numbers.append(int(nodes[first]))
+    return ordered_reach_geoms, ordered_node_numbers
+
+
 class UnstructuredGrid(Grid):
     """Class representing an unstructured model grid."""
     _structured = False
@@ -502,18 +839,23 @@ class UnstructuredGrid(Grid):
         assert 'node' in df.columns, \
             "DataFrame df must have a 'node' column for identifying model cells."
 
+        # (isfr hash, polygon) from the last call to create_active_area_polygon_from_isfr
+        self._active_area_cache = None
+
         self._set_active_area(active_area)
 
     def create_active_area_polygon_from_isfr(self):
-        """Create active area polygon from union of cells where isfr=1.
+        """Create active area polygon from union of cells where isfr=1,
+        by dissolving the cell edges (see :func:`~sfrmaker.gis.dissolve_cells`).
+        The result is cached, and reused until the isfr values change.
         """
-        print('Creating active area polygon from shapely.ops.unary_union '
-              'of cells with isfr=1. '
-              'This will take a while for large grids. To avoid this step,'
-              'supply a shapefile or shapely polygon of the SFR domain when'
-              'instantiating the grid objec.')
-        geoms = self.df.geometry.values[self.df.isfr == 1]
-        self._active_area = unary_union(geoms)
+        isfr = self.df.isfr.values == 1
+        key = hashlib.sha1(np.packbits(isfr).tobytes()).hexdigest()
+        if self._active_area_cache is None or self._active_area_cache[0] != key:
+            print('Creating active area polygon from cells with isfr=1...')
+            geoms = self.df.geometry.values[isfr]
+            self._active_area_cache = key, dissolve_cells(geoms)
+        self._active_area = self._active_area_cache[1]
 
     @classmethod
     def from_dataframe(cls, df=None,
@@ -3,20 +3,21 @@ import time
 
 import numpy as np
 import pandas as pd
+import shapely
 from shapely.geometry import box
 import flopy
-from gisutils import shp2df, df2shp, project, get_authority_crs
+from gisutils import shp2df, df2shp, get_authority_crs
 import sfrmaker
-from sfrmaker.routing import pick_toids, find_path, make_graph, renumber_segments
+from sfrmaker.routing import pick_toids, make_graph, renumber_segments, RoutingGraph, PathIndex, \
+    SubtreeIndex
 from sfrmaker.checks import routing_is_circular, is_to_one
-from sfrmaker.gis import read_polygon_feature, get_bbox, get_crs
+from sfrmaker.gis import read_polygon_feature, get_bbox, get_crs, project, get_lengths, shapely2
 from sfrmaker.grid import StructuredGrid
 from sfrmaker.nhdplus_utils import load_nhdplus_v2, get_prj_file
 from sfrmaker.sfrdata import SFRData
 from sfrmaker.units import convert_length_units, get_length_units
 from sfrmaker.utils import (width_from_arbolate_sum, arbolate_sum)
 from sfrmaker.reaches import consolidate_reach_conductances, interpolate_to_reaches, setup_reach_data
-from sfrmaker.routing import get_previous_ids_in_subset
 
 
 class Lines:
@@ -76,7 +77,9 @@ class Lines:
         self._geometry_length_units = None
 
         self._routing = None  # dictionary of routing connections
+        self._routing_graph = None  # RoutingGraph instance
         self._paths = None  # routing sequence from each segment to outlet
+        self._subtree_index = None  # upstream subtree of each line
 
         # dictionary of elevations at the upstream ends of flowlines
         self.elevup = dict(zip(self.df.id, self.df.elevup))
@@ -119,21 +122,55 @@ class Lines:
                     toid = [[l] if np.isscalar(l) else l for l in toid]
                     to_one = is_to_one(toid)
                 toid = np.squeeze(list(toid))
-                routing = make_graph(self.df.id.values, toid,
-                                     one_to_many=not to_one)
-                if not to_one:
+                if to_one:
+                    fromid = self.df.id.values.astype(int)
+                    toid = toid.astype(int)
+                    # each id can only route to one toid
+                    pairs = np.unique(np.column_stack([fromid, toid]), axis=0)
+                    ids, counts = np.unique(pairs[:, 0], return_counts=True)
+                    if np.any(counts > 1):
+                        k = ids[counts > 1][0]
+                        raise AssertionError("one_to_many=False but node {} connects to {}".format(
+                            k, set(pairs[pairs[:, 0] == k, 1].tolist())))
+                    graph = RoutingGraph(fromid, toid)
+                    routing = graph.to_dict(listed_only=True)
+                else:
+                    routing = make_graph(self.df.id.values, toid,
+                                         one_to_many=True)
                     routing = pick_toids(routing, self.elevup)
             else:
                 routing = {self.df.id.values[0]: 0}
             self._routing = routing
+            self._routing_graph = None
         return self._routing
 
+    @property
+    def routing_graph(self):
+        """:class:`~sfrmaker.routing.RoutingGraph` representation
+        of :attr:`Lines.routing`.
+        """
+        routing = self.routing
+        if self._routing_graph is None:
+            self._routing_graph = RoutingGraph.from_dict(routing)
+        return self._routing_graph
+
+    @property
+    def subtree_index(self):
+        """:class:`~sfrmaker.routing.SubtreeIndex` of the lines
+        upstream of each line in :attr:`Lines.routing`.
+        Rebuilt when the routing changes.
+        """
+        graph = self.routing_graph
+        if self._subtree_index is None or self._subtree_index.graph is not graph:
+            self._subtree_index = SubtreeIndex(graph)
+        return self._subtree_index
+
     @property
     def paths(self):
-        """Dictionary of paths, where each value is a list
-        of downstream lines constituting a flow path to an outlet
-        for a given line (key).
-        """        
+        """Dictionary-like :class:`~sfrmaker.routing.PathIndex` of paths,
+        where each value is a list of downstream lines constituting
+        a flow path to an outlet for a given line (key).
+        """
         if self._paths is None:
             self._set_paths()
             return self._paths
@@ -143,8 +180,7 @@ class Lines:
         return self._paths
 
     def _set_paths(self):
-        routing = self.routing
-        self._paths = {seg: find_path(routing, seg) for seg in routing.keys()}
+        self._paths = PathIndex(self.routing_graph)
 
     def _routing_changed(self):
         # check to see if routing in segment data was changed
@@ -206,30 +242,41 @@ class Lines:
         else:
             feature_s = feature.buffer(0)  # in case feature is invalid, might fix
 
-        lines = df.geometry.tolist()
+        lines = df.geometry.values
         print('starting lines: {:,d}'.format(len(lines)))
-        # isn = np.array([g.intersection(feature_s) for g in lines])
-        # df['geometry'] = isn
-        # drop = np.array([g.is_empty for g in isn])
-        # df = df.loc[~drop]
-        intersects = [g.intersects(feature_s) for g in lines]
+        if shapely2:
+            # prepare the features once, for fast vectorized predicates
+            shapely.prepare(feature_s)
+            shapely.prepare(feature)
+            intersects = shapely.intersects(feature_s, lines)
+            # lines that are entirely inside of the feature don't need to be clipped
+            contained = shapely.contains_properly(feature, lines)
+        else:
+            intersects = np.array([g.intersects(feature_s) for g in lines], dtype=bool)
+            contained = np.zeros(len(lines), dtype=bool)
         if not np.any(intersects):
-            print('No lines in active area. Check CRS.')
-            quit()
-
-        df = df.loc[intersects]
-        df['geometry'] = [g.intersection(feature) for g in df.geometry]
-        drop = np.array([g.is_empty for g in df.geometry.tolist()])
-        if len(drop) > 0:
-            df = df.loc[~drop]
+            raise ValueError('No lines in active area. Check CRS.')
+
+        clip = intersects & ~contained
+        print('clipping {:,d} lines that cross the active area boundary...'.format(clip.sum()))
+        geoms = lines.copy()
+        if shapely2:
+            geoms[clip] = shapely.intersection(lines[clip], feature)
+            empty = shapely.is_empty(geoms)
+        else:
+            geoms[clip] = [g.intersection(feature) for g in lines[clip]]
+            empty = np.array([g.is_empty for g in geoms], dtype=bool)
+        df['geometry'] = geoms
+        keep = intersects & ~empty
+        df = df.loc[keep]
         print('remaining lines: {:,d}'.format(len(df)))
+        print("finished in {:.2f}s\n".format(time.time() - ta))
         if inplace:
             self.df = df
         else:
             return df
-        print("finished in {:.2f}s\n".format(time.time() - ta))
 
-    def intersect(self, grid, size_thresh=1e5):
+    def intersect(self, grid, size_thresh=1e5, method=None, n_workers=None):
         """Intersect linework with a model grid.
 
         Parameters
@@ -237,10 +284,26 @@ class Lines:
         grid : instance of sfrmaker.grid
             Must have a valid Coordinate Reference System (CRS).
         size_thresh : int
-            Determines whether spatial indexing will be used. If
-            number of grid cells x number of flowlines > size_thresh,
-            a spatial index (rtree package) will be used to speed
-            up the intersections.
+            Not used; retained for backwards compatibility. A
+            bulk-loaded STRtree spatial index (:py:attr:`Grid.spatial_index`)
+            is always used for the intersections.
+        method : str, {'grid walk', 'strtree'}, optional
+            'grid walk' walks each line through the rows and columns
+            that it crosses (see :meth:`StructuredGrid.walk_line`),
+            without using the cell polygons; this requires a
+            :class:`StructuredGrid` with known :attr:`~StructuredGrid.edges`.
+            'strtree' intersects the lines with the cell polygons.
+            By default, None, in which case 'grid walk' is used if possible.
+            The two methods give the same reaches, except for lines
+            that run exactly along a row or column edge:
+            'grid walk' assigns these to one cell (the cell below,
+            or to the right of the edge), while 'strtree' (the method used
+            by versions of SFRmaker before 'grid walk' was added)
+            creates duplicate reaches in the cells on both sides of the edge.
+        n_workers : int, optional
+            Number of processes to use for creating reaches from the
+            intersected flowlines (see :func:`~sfrmaker.reaches.setup_reach_data`).
+            By default, None (a single process).
 
         Returns
         -------
@@ -248,31 +311,39 @@ class Lines:
             DataFrame containing intersected reaches with grid cell information
             and original linework IDs.
         """
-        from .gis import intersect, intersect_rtree
+        from .gis import intersect_strtree, group_intersections
 
         # to_crs the flowlines if they aren't in same CRS as grid
         if self.crs != grid.crs:
             self.to_crs(grid.crs)
 
-        grid_polygons = grid.df.geometry.tolist()
         stream_linework = self.df.geometry.tolist()
         id_list = self.df.id.tolist()
 
-        ncells, nlines = len(grid_polygons), len(stream_linework)
+        ncells, nlines = grid.size, len(stream_linework)
         print("\nIntersecting {:,d} flowlines with {:,d} grid cells...".format(nlines, ncells))
-        # building the spatial index takes a while
-        # only use spatial index if number of tests exceeds size_thresh
-        size = ncells * nlines
-        # don't spend time on a spatial index if it isn't created and problem is small
-        if size < size_thresh and grid._idx is None:
-            grid_intersections = intersect(grid_polygons, stream_linework)
+        walkable = isinstance(grid, StructuredGrid) and grid.edges is not None
+        if method is None:
+            method = 'grid walk' if walkable else 'strtree'
+        if method == 'grid walk':
+            if not walkable:
+                raise ValueError("method='grid walk' requires a StructuredGrid with "
+                                 "xul, yul, rotation and row/column spacings.")
+            # create preliminary reaches directly from the grid rows and columns
+            reach_data = setup_reach_data(stream_linework, id_list,
+                                          None, None, grid=grid, n_workers=n_workers)
+        elif method == 'strtree':
+            grid_polygons = grid.get_cell_polygons().tolist()
+            line_inds, cell_inds = intersect_strtree(grid_polygons, stream_linework,
+                                                     index=grid.spatial_index)
+            grid_intersections = group_intersections(line_inds, cell_inds, nlines)
+
+            # create preliminary reaches
+            reach_data = setup_reach_data(stream_linework, id_list,
+                                          grid_intersections, grid_polygons, tol=.001,
+                                          n_workers=n_workers)
         else:
-            idx = grid.spatial_index
-            grid_intersections = intersect_rtree(grid_polygons, stream_linework, index=idx)
-
-        # create preliminary reaches
-        reach_data = setup_reach_data(stream_linework, id_list,
-                                      grid_intersections, grid_polygons, tol=.001)
+            raise ValueError("Unrecognized method: {}".format(method))
 
         column_order = ['node', 'k', 'i', 'j', 'rno',
                         'ireach', 'iseg', 'line_id', 'name', 'geometry']
@@ -631,6 +702,7 @@ class Lines:
                consolidate_conductance=False, one_reach_per_cell=False,
                add_outlets=None,
                package_name=None,
+               n_workers=None,
                **kwargs):
         """Create a streamflow routing dataset from the information
         in sfrmaker.lines class instance and a supplied sfrmaker.grid class instance.
@@ -639,7 +711,10 @@ class Lines:
         ----------
         grid : sfrmaker.grid or flopy.discretization.StructuredGrid
             Numerica model grid instance. Required unless an attached model
-            has a valid modelgrid attribute.
+            has a valid modelgrid attribute. The flowlines are intersected
+            with structured grids by walking through the rows and columns
+            (method='grid walk' in :meth:`Lines.intersect`; see there for
+            how this differs from intersecting the cell polygons).
         active_area : shapely Polygon, list of shapely Polygons, or shapefile path; optional
             Shapely Polygons must be in same CRS as input flowlines; shapefile
             features will be reprojected if their crs is different.
@@ -688,6 +763,10 @@ class Lines:
             prevent double-counting of flow. By default, None
         package_name : str
             Base name for writing sfr output.
+        n_workers : int, optional
+            Number of processes to use for intersecting the flowlines
+            with the model grid (see :meth:`Lines.intersect`).
+            By default, None (a single process).
         kwargs : keyword arguments to :class:`SFRData`
 
         Returns
@@ -758,23 +837,25 @@ class Lines:
                         for i in self.df.id.tolist()]
 
         # intersect lines with model grid to get preliminary reaches
-        rd = self.intersect(grid)
+        rd = self.intersect(grid, n_workers=n_workers)
 
         # length of intersected line fragments (in model units)
-        rd['rchlen'] = np.array([g.length for g in rd.geometry]) * gis_mult
+        rd['rchlen'] = get_lengths(rd.geometry) * gis_mult
 
         # estimate widths if they aren't supplied
         if self.df.width1.sum() == 0:
             print("Computing widths...")
 
             # compute arbolate sums for original LineStrings if they weren't provided
-            if 'asum2' not in self.df.columns:
-                raise NotImplementedError('Check length unit conversions before using this option.')
+            # (from the LineString lengths, in meters)
+            compute_asums = 'asum2' not in self.df.columns or self.df['asum2'].sum() == 0
+            if compute_asums:
                 asums = arbolate_sum(self.df.id,
                                      dict(zip(self.df.id,
-                                              np.array([g.length for g in self.df.geometry]) * convert_length_units(self.geometry_length_units, 'meters')
+                                              get_lengths(self.df.geometry) * convert_length_units(self.geometry_length_units, 'meters')
                                               )),
                                      self.routing)
+                self.df['asum2'] = [asums[id] for id in self.df.id]
             else:
                 #asums = dict(zip(self.df.id, 
                 #                 self.df.asum2 * convert_length_units(self.attr_length_units, 
@@ -783,9 +864,12 @@ class Lines:
                                                                       'meters')
 
             # populate starting asums (asum1)
-            if 'asum1' not in self.df.columns:
+            if 'asum1' in self.df.columns and not compute_asums:
+                self.df['asum1'] = self.df['asum1'] * convert_length_units(self.attr_length_units,
+                                                                           'meters')
+            else:
                 length_conversion = convert_length_units(self.geometry_length_units, 'meters')
-                line_lengths = [g.length * length_conversion for g in self.df.geometry]
+                line_lengths = get_lengths(self.df.geometry) * length_conversion
                 self.df['asum1'] = self.df['asum2'] - line_lengths
                 
             #routing_r = {v: k for k, v in self.routing.items() if v != 0}
@@ -794,7 +878,7 @@ class Lines:
 
             # compute arbolate sum at reach midpoints (in meters)
             lengths = rd[['line_id', 'ireach', 'geometry']].copy()
-            lengths['rchlen'] = np.array([g.length for g in lengths.geometry]) * convert_length_units(self.geometry_length_units, 'meters')
+            lengths['rchlen'] = get_lengths(lengths.geometry) * convert_length_units(self.geometry_length_units, 'meters')
             groups = lengths.groupby('line_id')  # fragments grouped by parent line
 
             reach_cumsums = []
@@ -822,13 +906,13 @@ class Lines:
                                             a=width_from_asum_a_param,
                                             b=width_from_asum_b_param,
                                             minimum_width=minimum_reach_width,
-                                            input_units=self.attr_length_units,
+                                            input_units='meters',
                                             output_units=model_length_units)
             self.df['width2'] = width_from_arbolate_sum(self.df.asum2.values,
                                                         a=width_from_asum_a_param,
                                                         b=width_from_asum_b_param,
                                                         minimum_width=minimum_reach_width,
-                                                        input_units=self.attr_length_units,
+                                                        input_units='meters',
                                                         output_units=model_length_units)
 
         # interpolate linestring end widths to intersected reaches
@@ -850,7 +934,7 @@ class Lines:
         # set minimum reach length based on cell size
         thresh = 0.05  # fraction of cell length (based on square root of area)
         if minimum_reach_length is None:
-            cellgeoms = grid.df.loc[rd.node.values, 'geometry']
+            cellgeoms = grid.get_cell_polygons(rd.node.values)
             mean_area = np.mean([g.area for g in cellgeoms])
             minimum_reach_length = np.sqrt(mean_area) * thresh * gis_mult
 
@@ -878,13 +962,16 @@ class Lines:
         # when id and toid columns are changed in self.df
         # but only rd (reach_data) has been changed
         new_routing = {}
-        paths = self.paths.copy()
+        paths = self.paths
+        remaining = set(remaining_ids)
         # for each segment
         for k in remaining_ids:
             # interate through successive downstream segments
-            for s in paths[k][1:]:
+            path = paths.iter_path(k)
+            next(path)
+            for s in path:
                 # assign the first segment that still exists as the outseg
-                if s in remaining_ids:
+                if s in remaining:
                     new_routing[k] = s
                     break
             # if no segments are left downstream, assign outlet
@@ -904,7 +991,7 @@ class Lines:
                 else:
                     outlet_id = int(outlet_id)
                     outlet_toid = 0
-                valid_outlet_ids = get_previous_ids_in_subset(rd.line_id, self.routing, outlet_id)
+                valid_outlet_ids = self.subtree_index.get_previous_in_subset(rd.line_id, outlet_id)
                 loc = rd.line_id.isin(valid_outlet_ids)
                 rd.loc[loc, 'toid'] = outlet_toid
                 for valid_outlet_id in valid_outlet_ids:
@@ -937,7 +1024,8 @@ class Lines:
         sd.sort_values(by='nseg', inplace=True)
 
         # verify that no segments route to themselves
-        assert not routing_is_circular(sd.nseg, sd.outseg)
+        cycles = routing_is_circular(sd.nseg, sd.outseg)
+        assert not cycles, "Circular routing in segments: {}".format(cycles)
 
         # (elevup dict was created above)
         elevup = self.elevup
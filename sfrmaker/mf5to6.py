@@ -7,6 +7,7 @@ import numpy as np
 import pandas as pd
 import sfrmaker
 from sfrmaker.reaches import interpolate_to_reaches
+from sfrmaker.routing import RoutingGraph
 
 
 class Mf6SFR:
@@ -133,11 +134,9 @@ class Mf6SFR:
     @property
     def graph_r(self):
         if self._graph_r is None:
-            outreaches = np.unique(self.rd.outreach)
-            self._graph_r = {o: self.rd.rno[self.rd.outreach == o].tolist()
-                             for o in outreaches}
-            self.outlets = self._graph_r[0]
-            del self._graph_r[0]
+            graph = RoutingGraph(self.rd.rno, self.rd.outreach)
+            self._graph_r = graph.reverse_dict()
+            self.outlets = self._graph_r.pop(0, [])
         return self._graph_r
 
     @property
@@ -8,16 +8,19 @@ import pandas as pd
 import fiona
 import rasterio
 from shapely.geometry import shape, MultiLineString, box
-from rasterstats import zonal_stats
 from gisutils import get_shapefile_crs
-from sfrmaker.gis import (shp2df, df2shp, project, intersect_rtree,
-                          get_bbox, read_polygon_feature, get_shapefile_crs,
+from sfrmaker.gis import (shp2df, df2shp, project, intersect_strtree, get_buffers,
+                          group_intersections, get_bbox,
+                          read_polygon_feature, get_shapefile_crs,
                           get_authority_crs,
                           get_crs)
+from sfrmaker.checks import routing_is_circular
 from sfrmaker.elevations import smooth_elevations
 from sfrmaker.logger import Logger
+from sfrmaker.rasters import (tiled_zonal_stats, get_geometry_hashes, ZonalStatsCache,
+                              get_raster_tiles, raster_mosaic)
 from sfrmaker.nhdplus_utils import get_nhdplus_v2_filepaths, get_prj_file
-from sfrmaker.routing import find_path, make_graph
+from sfrmaker.routing import find_path, make_graph, RoutingGraph
 from sfrmaker.units import convert_length_units
 from sfrmaker.utils import width_from_arbolate_sum, arbolate_sum
 
@@ -296,6 +299,7 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
                        output_length_units='meters',
                        logger=None, outfolder='output/',
                        project_epsg=None, flowline_crs=None, dest_crs=None,
+                       n_workers=None, cache_dir=None
                        ):
     """Preprocess NHDPlus data to a single DataFrame of flowlines
     that each route to no more than one flowline, with width, elevation
@@ -318,8 +322,11 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
     elevslope_file : str
         Path to NHDPlus elevslope database (.dbf file). May or maybe not have been
         preprocessed by :func:`~sfrmaker.preprocessing.cull_flowlines`
-    demfile : str
-        Path to DEM raster for project area.
+    demfile : str, list of strings, or folder
+        Path to DEM raster for project area, or a list or folder of DEM tiles.
+        Multiple tiles are sampled through a virtual mosaic
+        (see :func:`~sfrmaker.rasters.raster_mosaic`), which is kept in
+        ``cache_dir``, if specified.
     dem_length_units : str, any length unit; e.g. {'m', 'meters', 'ft', etc.}
         Length units of values in ``demfile``. By default, 'meters'.
     active_area : str, optional
@@ -387,6 +394,18 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
         Output Coordinate reference system. Same input types
         as ``flowline_crs``.
         By default, epsg:5070
+    n_workers : int, optional
+        Number of processes for running zonal statistics on the
+        flowline buffers in parallel, one DEM tile at a time
+        (see :func:`sfrmaker.rasters.tiled_zonal_stats`).
+        By default, None (no parallelization).
+    cache_dir : str, optional
+        Folder for caching the zonal statistics on disk
+        (see :class:`sfrmaker.rasters.ZonalStatsCache`). Statistics for
+        flowline buffers that were already sampled from the same (unchanged)
+        DEM with the same settings are reused, so that only new or changed
+        flowlines are sampled. Unlike ``run_zonal_statistics=False``, no
+        ``flowline_elevations_file`` is needed. By default, None (no caching).
 
     Returns
     -------
@@ -455,8 +474,8 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
                   pf_file,
                   elevslope_file,
                   ]
-    if run_zonal_statistics:
-        files_list.append(demfile)
+    if run_zonal_statistics and demfile is not None:
+        files_list += get_raster_tiles(demfile)
     if narwidth_shapefile is not None:
         if waterbody_shapefiles is None:
             raise ValueError("NARWidth option ")
@@ -522,21 +541,24 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
     # option to reuse shapefile from previous run instead of re-running zonal statistics
     # which can take an hour for large problems
     if run_zonal_statistics:
-        assert Path(demfile).exists(), \
+        assert demfile is not None, \
             "If run_zonal_statistics=True (default), a demfile is needed."
+        dem_tiles = get_raster_tiles(demfile)
         # draw buffers
-        flbuffers = [g.buffer(buffersize_meters, cap_style=2)  # 2 (flat cap) very important!
-                     for g in fl.geometry]
+        flbuffers = get_buffers(fl.geometry, buffersize_meters,
+                                cap_style=2).tolist()  # 2 (flat cap) very important!
 
         # Create buffer around flowlines with flat cap, so that ends are flush with ends of lines
         # compute zonal statistics on buffer
         logger.log('Creating buffers and running zonal statistics')
         logger.log_package_version('rasterstats')
         logger.statement('buffersize: {} m'.format(buffersize_meters), log_time=False)
-        logger.log_file_and_date_modified(demfile, prefix='DEM file: ')
+        for f in dem_tiles:
+            logger.log_file_and_date_modified(f, prefix='DEM file: ')
 
         # if DEM has different crs, project buffer polygons to DEM crs
-        with rasterio.open(demfile) as src:
+        # (get the crs from the first tile, if there are multiple DEM tiles)
+        with rasterio.open(dem_tiles[0]) as src:
             meta = src.meta
             dem_crs = get_authority_crs(meta['crs'])
             dem_res = src.res[0]
@@ -545,24 +567,41 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
             flbuffers_pr = project(flbuffers, project_crs, dem_crs)
 
         # run zonal statistics on buffers
-        # this step takes at least ~ 20 min for the full 1-mi MERAS model
+        # (by DEM tile, in parallel if n_workers > 1)
         # with large cell sizes, count all cells that are touched by each buffer
         # (not just the cell centers that are intersected)
         all_touched = False
         if buffersize_meters < dem_res:
             all_touched = True
-        results = zonal_stats(flbuffers_pr,
-                              demfile,
-                              stats=['min', 'mean', 'std',
-                                     'percentile_1', 'percentile_10',
-                                     'percentile_20', 'percentile_80'],
-                              all_touched=all_touched)
-        #results = {'mean': np.zeros(len(fl)),
-        #           'min': np.zeros(len(fl)),
-        #           'percentile_10': np.zeros(len(fl)),
-        #           'percentile_20': np.zeros(len(fl)),
-        #           'percentile_80': np.zeros(len(fl))}
-        df = pd.DataFrame(results)
+        stats = ['min', 'mean', 'std',
+                 'percentile_1', 'percentile_10',
+                 'percentile_20', 'percentile_80']
+        df = pd.DataFrame(np.nan, index=np.arange(len(fl)), columns=stats)
+        to_sample = np.ones(len(fl), dtype=bool)
+
+        # reuse statistics for any buffers that were already sampled from the same DEM
+        if cache_dir is not None:
+            keys = get_geometry_hashes(flbuffers)
+            cache = ZonalStatsCache(cache_dir, demfile, stats,
+                                    all_touched=all_touched, crs=project_crs)
+            cached, found = cache.get(keys)
+            df.loc[found] = cached.loc[found].values
+            to_sample = ~found
+            logger.statement('reusing cached zonal statistics for {:,d} of {:,d} '
+                             'flowlines in {}'.format(found.sum(), len(found), cache.filename))
+        if to_sample.any():
+            # sample multiple DEM tiles through a virtual mosaic
+            with raster_mosaic(demfile, out_dir=cache_dir) as dem:
+                results = tiled_zonal_stats([g for g, sample in zip(flbuffers_pr, to_sample)
+                                             if sample],
+                                            dem,
+                                            stats=stats,
+                                            all_touched=all_touched,
+                                            n_workers=n_workers)
+            sampled = pd.DataFrame(results, columns=stats).astype(float)
+            df.loc[to_sample] = sampled.values
+            if cache_dir is not None:
+                cache.update(keys[to_sample], sampled)
 
         # warn if there are more than 10% nan values
         n_nan = df.isna().any(axis=1).sum()
@@ -613,10 +652,7 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
     flcc['LevelPathI'] = pfvaa.loc[flcc.index, 'LevelPathI']
     flcc['nhd_asum'] = pfvaa.loc[flcc.index, 'ArbolateSu']
 
-    # dictionary with routing info by COMID
-    graph = make_graph(pf.FROMCOMID.values, pf.TOCOMID.values)
     in_model = set(fl.COMID)
-    graph = {k: v for k, v in graph.items() if k in in_model}
 
     # use the 10th percentile from zonal_statistics for setting end elevation of each flowline
     # (hopefully distinguishes flowlines that run along channels vs.
@@ -637,50 +673,13 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
         txt += '{} --> {}\n'.format(k, v)
 
     logger.statement(txt)
-    # dictionary of values for selecting main channel at diversions
-    valid_comids = set(flcc.index)
-    div_elevs = dict(zip(flcc.COMID, flcc[elevcol]))
-    tocomids = {}
-    diversionminorcomids = set()
-    for k, v in graph.items():
-
-        # limit distributaries to those still in the dataset
-        v = v.intersection(valid_comids)
-
-        # known connections have to be handled first
-        if k in known_connections.keys():
-            # primary dist.
-            tocomids[k] = known_connections[k]
-            # update minorcomids with minor distribs.
-            diversionminorcomids.update(v.difference({tocomids[k]}))
-        # comid routes to only one comid
-        # (likely most common case)
-        elif len(v) == 1:
-            tocomids[k] = v.pop()
-        # comid is an outlet
-        elif len(v) == 0:
-            tocomids[k] = 0
-        # comid routes to multiple comids (diversion)
-        else:
-            # downstream elevations
-            tocomids_c = list(v)
-            dnelevs = [div_elevs.get(toid, 99999) for toid in tocomids_c]
-            # downstream elevations unique to 2 decimal places
-            unique_dnelevs = set(np.round(dnelevs, 2))
-            # primary distributary
-            # if any of the downstream values are nans, or they are all the same
-            # keep the NHD main channel
-            if any(np.isnan(dnelevs)) or len(unique_dnelevs) == 1:
-                # Divergence == 1 is the main stemp, Divergence == 2 is minor
-                # (see NHDPlus v2 User's Guide)
-                info = flcc.loc[tocomids_c, 'Divergence'].sort_values()
-                assert info.values[0] == 1
-                tocomids[k] = info.index[0]
-                #tocomids[k] = flcc.loc[tocomids_c, 'Divergence'].sort_values().index[0]
-            else:
-                tocomids[k] = np.array(tocomids_c)[np.nanargmin(dnelevs)]
-            # secondary distributaries
-            diversionminorcomids.update(v.difference({tocomids[k]}))
+    in_model_pf = pf.loc[pf.FROMCOMID.isin(in_model)]
+    tocomids, diversionminorcomids = \
+        select_primary_distributaries(in_model_pf.FROMCOMID.values,
+                                      in_model_pf.TOCOMID.values,
+                                      elevations=flcc[elevcol],
+                                      divergence=flcc['Divergence'],
+                                      known_connections=known_connections)
 
     # update the routing graphs
     # set tocomids to zero if there's no flowline
@@ -760,7 +759,7 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
     asum_calc.update(new_minor_distrib_asums)
     # recompute arbolate sums at and downstream of places where it decreases
     # decreases are caused by routing connections that were not in NHDPlus
-    fixed_invalid_asums = fix_invalid_asums(asum_calc, fl_lengths, graph, graph_r)
+    fixed_invalid_asums = fix_invalid_asums(asum_calc, fl_lengths, graph)
     asum_calc.update(fixed_invalid_asums)
     flcc['asum_calc'] = [asum_calc[c] for c in flcc.index]
     logger.log('Recomputing arbolate sums')
@@ -966,13 +965,14 @@ def sample_NARWidth(flowlines, narwidth_shapefile, waterbodies,
 
     # draw buffers around flowlines
     buffdist = 1000  # m
-    buffers = [g.buffer(buffdist) for g in flowlines.geometry]
+    buffers = get_buffers(flowlines.geometry, buffdist)
     flbuff = flowlines.copy()
     flbuff['geometry'] = buffers
     df2shp(flbuff, '{}/flowlines_edited_buffers_{}.shp'.format(outpath, buffdist), epsg=flowlines_epsg)
 
     # determine which narwidth segments intersect the flowline buffers
-    results = intersect_rtree(nw.geometry.tolist(), flbuff.geometry.tolist())
+    flbuff_inds, nw_inds = intersect_strtree(nw.geometry.tolist(), flbuff.geometry.tolist())
+    results = group_intersections(flbuff_inds, nw.index.values[nw_inds], len(flbuff))
 
     # weed out tribs that might have picked up narwidths for main stem
     asum_thresh = 500  # threshold for evaluating whether flowline is a minor distributary
@@ -1129,6 +1129,12 @@ def edit_flowlines(flowlines, config_file,
                 raise KeyError("{} not in {}; can't re-route to {}".format(k, flowlines, v))
             logger.statement('rerouted {} to {}'.format(k, v))
 
+    # report any circular routing resulting from the edits
+    cycles = routing_is_circular(df[id_column].values, df[toid_column].values)
+    if len(cycles) > 0:
+        logger.warn('circular routing in edited flowlines:\n{}'.format(
+            textwrap.fill(str(cycles), 100)))
+
     # verify that all to comids besides 0 are in id column
     # actually apparently don't have to do this because
     # there are already many toids not in the preprocessed flowlines
@@ -1142,6 +1148,83 @@ def edit_flowlines(flowlines, config_file,
     return df
 
 
+def select_primary_distributaries(fromcomids, tocomids, elevations, divergence,
+                                  known_connections=None):
+    """Reduce routing connections to one per line, by selecting the
+    primary distributary at each divergence. The primary distributary
+    is the one with the lowest elevation, unless any of the elevations
+    are nan, or they are all the same (to 2 decimal places), in which
+    case the NHDPlus main stem (Divergence == 1) is selected.
+
+    Parameters
+    ----------
+    fromcomids : 1D array
+        Line identifiers (e.g. from the FROMCOMID column in PlusFlow).
+    tocomids : 1D array
+        Downstream connections for fromcomids (e.g. the TOCOMID column
+        in PlusFlow). A line can be listed more than once in fromcomids,
+        with a different tocomid for each distributary.
+    elevations : pandas Series
+        Elevations (e.g. end elevations sampled from a DEM) for each line,
+        indexed by line identifier. Connections to lines that aren't
+        in elevations are ignored.
+    divergence : pandas Series
+        NHDPlus Divergence codes (1 for main stem, 2 for minor distributary)
+        for each line, indexed by line identifier.
+    known_connections : dict, optional
+        Connections {fromcomid: tocomid} to use regardless of the elevations.
+
+    Returns
+    -------
+    tocomids : dict
+        Downstream connection {fromcomid: tocomid} for each line;
+        0 for lines that don't connect to any lines in elevations.
+    minor_distributaries : set
+        Lines that are connected to by a line that routes elsewhere.
+    """
+    if known_connections is None:
+        known_connections = {}
+    connections = pd.DataFrame({'fromcomid': np.array(fromcomids).astype(int),
+                                'tocomid': np.array(tocomids).astype(int)})
+    connections.drop_duplicates(inplace=True)
+    fromcomids = connections.fromcomid.unique()
+
+    # limit distributaries to those still in the dataset
+    connections = connections.loc[connections.tocomid.isin(elevations.index)].copy()
+    connections['elevation'] = elevations.loc[connections.tocomid].values
+    connections['divergence'] = divergence.loc[connections.tocomid].values
+    connections['isnan'] = connections.elevation.isna()
+    connections['rounded'] = connections.elevation.round(2)
+    by_fromcomid = connections.groupby('fromcomid')
+    is_divergence = by_fromcomid.tocomid.transform('size') > 1
+    # keep the NHD main channel if any of the downstream values are nans,
+    # or they are all the same
+    use_main_stem = by_fromcomid.isnan.transform('any') | \
+        (by_fromcomid.rounded.transform('nunique') == 1)
+    connections['sort_value'] = np.where(use_main_stem, connections.divergence,
+                                         connections.elevation)
+    # (ties go to the main stem, and then the first connection listed)
+    primary = connections.sort_values(by=['fromcomid', 'sort_value', 'divergence'],
+                                      kind='mergesort')
+    primary = primary.drop_duplicates(subset='fromcomid')
+    main_stem = primary.loc[(use_main_stem & is_divergence).loc[primary.index] &
+                            ~primary.fromcomid.isin(known_connections.keys())]
+    # Divergence == 1 is the main stem, Divergence == 2 is minor
+    # (see NHDPlus v2 User's Guide)
+    assert np.all(main_stem.divergence == 1)
+
+    tocomids = dict.fromkeys(fromcomids.tolist(), 0)
+    tocomids.update(zip(primary.fromcomid.tolist(), primary.tocomid.tolist()))
+    # known connections take precedence
+    tocomids.update({k: v for k, v in known_connections.items() if k in tocomids})
+
+    # secondary distributaries
+    primary_tocomids = connections.fromcomid.map(tocomids)
+    minor_distributaries = set(connections.loc[connections.tocomid != primary_tocomids,
+                                               'tocomid'].tolist())
+    return tocomids, minor_distributaries
+
+
 def recompute_asums_for_minor_distribs(minor_distrib_comids, fl_lengths, graph, graph_r):
     """Reset arbolate sums for minor distributaries and
     downstream segments in their path, to the next confluence.
@@ -1156,31 +1239,41 @@ def recompute_asums_for_minor_distribs(minor_distrib_comids, fl_lengths, graph,
         in same units as asums.
     graph : dict
         Dictionary of downstream routing connections {fromcomid: tocomid}
-    graph_r : dict
-        Dictionary of upstream routing connections {tocomid: {fromcomid1, fromcomid2,...}}
+    graph_r : dict, optional
+        Not used; retained for backwards compatibility. Upstream routing
+        connections are determined from graph.
 
     Returns
     -------
     new_asums : dict
         Dictionary of recomputed arbolate sums {comid: asum value}
     """
-    new_asums = {}
-    for c in minor_distrib_comids:
-        path = find_path(graph, c)
-        asum_c = 0  # current asum
-        # for each comid going downstream
-        for cp in path:
-            tribs = graph_r[cp]
-            # end condition is an outlet or confluence
-            if cp == 0 or len(tribs) > 1:
-                break
-            # increment the asum by the current length
-            asum_c += fl_lengths[cp]
-            new_asums[cp] = asum_c
+    # lines that can be part of a path from a minor distributary
+    # (that aren't outlets or confluences)
+    n_tribs = {k: len(graph_r.get(k, ())) for k in graph.keys()}
+    minor_distrib_comids = {c for c in minor_distrib_comids
+                            if n_tribs.get(c, 2) <= 1}
+    fromids = [k for k, n in n_tribs.items() if n <= 1]
+    # each path starts at a minor distributary
+    # and continues until the next confluence or outlet
+    toids = [graph[k] if n_tribs.get(graph[k], 2) == 1 and
+             graph[k] not in minor_distrib_comids else 0 for k in fromids]
+    if len(fromids) == 0:
+        return {}
+    paths = RoutingGraph(fromids, toids)
+    lengths = np.array([fl_lengths[id] for id in paths.ids.tolist()])
+
+    # accumulate lengths down each path, in a single pass
+    asums = paths.accumulate(lengths)
+    # only include paths starting at a minor distributary
+    is_minor_path = paths.accumulate(np.isin(paths.ids, list(minor_distrib_comids)),
+                                     func=np.maximum) > 0
+    new_asums = dict(zip(paths.ids[is_minor_path].tolist(),
+                         asums[is_minor_path].tolist()))
     return new_asums
 
 
-def fix_invalid_asums(asums, fl_lengths, graph, graph_r):
+def fix_invalid_asums(asums, fl_lengths, graph, graph_r=None):
     """Recompute arbolate sum at any places in the network
     where it decreases going downstream, and then for all lines
     downstream of those locations. Decreases may be caused by
@@ -1196,8 +1289,9 @@ def fix_invalid_asums(asums, fl_lengths, graph, graph_r):
         in same units as asums.
     graph : dict
         Dictionary of downstream routing connections {fromcomid: tocomid}
-    graph_r : dict
-        Dictionary of upstream routing connections {tocomid: {fromcomid1, fromcomid2,...}}
+    graph_r : dict, optional
+        Not used; retained for backwards compatibility. Upstream routing
+        connections are determined from graph.
 
     Returns
     -------
@@ -1213,40 +1307,39 @@ def fix_invalid_asums(asums, fl_lengths, graph, graph_r):
     drainages (if the tribs are distributaries coming from the same divergence,
     there asums will reflect the same upstream drainage, and therefore would
     be duplicative if summed).
+
+    The lines are processed in a single pass in topological order
+    (from the headwaters to the outlets, as determined from graph),
+    so that increases in arbolate sum are only carried downstream once.
+    The order of the lines in asums doesn't matter. Previous versions of this
+    function corrected the lines in the order of asums, and only gave
+    the same results if asums was in topological order (upstream lines first).
     """
     new_asums = asums.copy()
-    for comid, asum in new_asums.items():
-
-        # get the asum at the line start
-        # (tribs themselves might be distributaries,
-        # so might reflect some of the same upstream drainage,
-        # in which case summing the asums would be invalid)
-        tribs = graph_r[comid]
-        max_trib_asum = 0.
-        if len(tribs) > 0:
-            max_trib_asum = np.max([new_asums[trib] for trib in tribs])
-
-        # expected asum is the highest trib asum + line length
-        expected_asum = max_trib_asum + fl_lengths[comid]
-
-        # if the asum is less than expected
-        # assume a break in asum continuity
-        if expected_asum > asum:
-            path = find_path(graph, comid)
-
-            # set the current asum to the max of the tribs + it's line length
-            # (current asum is at end of line)
-            asum_c = expected_asum  # current asum
-            new_asums[comid] = asum_c
-
-            # increment each downstream line by the increase in asum
-            increment = asum_c - asum
-            # for each comid going downstream
-            for cp in path[1:]:
-                # end condition is an outlet
-                if cp == 0:
-                    break
-                old_asum = new_asums[cp]
-                asum_c = old_asum + increment
-                new_asums[cp] = asum_c
+    # lines routing to lines that aren't in asums are treated as outlets
+    toids = [graph.get(k, 0) if graph.get(k, 0) in asums else 0 for k in asums]
+    routing = RoutingGraph(list(asums.keys()), toids)
+    asum = np.array([asums[id] for id in routing.ids.tolist()], dtype=float)
+    lengths = np.array([fl_lengths[id] for id in routing.ids.tolist()], dtype=float)
+
+    # in a single pass from the headwaters to the outlets:
+    # the asum at each line is the maximum of its original asum
+    # plus any increases to asums upstream, and the expected asum
+    # (highest trib asum + line length)
+    # (tribs themselves might be distributaries,
+    # so might reflect some of the same upstream drainage,
+    # in which case summing the asums would be invalid)
+    new_asum = asum.copy()
+    increment = np.zeros(len(routing))
+    max_trib_asum = np.full(len(routing), -np.inf)
+    for level in routing.get_levels()[::-1]:
+        expected_asum = np.where(np.isinf(max_trib_asum[level]), 0.,
+                                 max_trib_asum[level]) + lengths[level]
+        new_asum[level] = np.maximum(asum[level] + increment[level], expected_asum)
+        routes_downstream = routing.toindex[level] >= 0
+        level = level[routes_downstream]
+        toindex = routing.toindex[level]
+        np.add.at(increment, toindex, new_asum[level] - asum[level])
+        np.maximum.at(max_trib_asum, toindex, new_asum[level])
+    new_asums.update(zip(routing.ids.tolist(), new_asum.tolist()))
     return new_asums
\ No newline at end of file
@@ -0,0 +1,833 @@
+"""Methods for sampling rasters (for example, DEMs) at large numbers
+of features, with grouped NumPy reductions or tiled (and optionally
+parallel) calls to rasterstats.zonal_stats.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+from pathlib import Path
+import tempfile
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+from rasterstats import zonal_stats
+from gisutils import get_authority_crs
+from sfrmaker.gis import (geometry_array, get_bounds, get_lengths,
+                          get_transformer, shapely2)
+
+valid_stats = {'min', 'max', 'mean', 'count', 'sum', 'std', 'median'}
+
+
+def parse_stats(stats):
+    """Get a list of statistic names from a string or sequence
+    of strings, using the same names as rasterstats.zonal_stats
+    (e.g. 'min', 'mean', 'percentile_10').
+    """
+    if isinstance(stats, str):
+        stats = stats.split()
+    stats = list(stats)
+    for stat in stats:
+        if stat.startswith('percentile_'):
+            q = float(stat.split('_')[1])
+            if not 0 <= q <= 100:
+                raise ValueError('Invalid percentile: {}'.format(stat))
+        elif stat not in valid_stats:
+            raise ValueError('Unsupported statistic: {}. Valid statistics are: {} '
+                             'and percentile_<q>'.format(stat, ', '.join(sorted(valid_stats))))
+    return stats
+
+
+class GroupedStats:
+    """Accumulate statistics for groups of raster values,
+    one block of values at a time.
+
+    Parameters
+    ----------
+    n : int
+        Number of groups. Values are labeled by their group
+        number (0 to n-1).
+    stats : str or sequence of strings
+        Statistics to compute (see :func:`parse_stats`).
+    """
+    def __init__(self, n, stats='min'):
+        self.n = n
+        self.stats = parse_stats(stats)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.sum = np.zeros(n)
+        # running means and sums of squared deviations from the means,
+        # merged block by block (Chan et al., 1979), for the standard deviations
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+        # percentiles need all of the values for each group
+        self._keep_values = any(s == 'median' or s.startswith('percentile_')
+                                for s in self.stats)
+        self._labels = []
+        self._values = []
+
+    def add(self, labels, values):
+        """Add a block of values.
+
+        Parameters
+        ----------
+        labels : 1D array of ints
+            Group number for each value.
+        values : 1D array of floats
+        """
+        if len(labels) == 0:
+            return
+        labels = np.asarray(labels, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+        block_count = np.bincount(labels, minlength=self.n)
+        block_sum = np.bincount(labels, weights=values, minlength=self.n)
+        block_mean = block_sum / np.maximum(block_count, 1)
+        block_m2 = np.bincount(labels, weights=(values - block_mean[labels])**2,
+                               minlength=self.n)
+        count = self.count + block_count
+        delta = block_mean - self.mean
+        fraction = block_count / np.maximum(count, 1)
+        self.m2 += block_m2 + delta**2 * self.count * fraction
+        self.mean += delta * fraction
+        self.count = count
+        self.sum += block_sum
+        order = np.argsort(labels, kind='stable')
+        sorted_labels = labels[order]
+        sorted_values = values[order]
+        starts = np.flatnonzero(np.append(True, np.diff(sorted_labels) != 0))
+        groups = sorted_labels[starts]
+        self.min[groups] = np.minimum(self.min[groups],
+                                      np.minimum.reduceat(sorted_values, starts))
+        self.max[groups] = np.maximum(self.max[groups],
+                                      np.maximum.reduceat(sorted_values, starts))
+        if self._keep_values:
+            self._labels.append(labels)
+            self._values.append(values)
+
+    def _percentiles(self, qs):
+        """Percentiles of each group, with linear interpolation
+        (as in numpy.percentile)."""
+        results = {}
+        if len(self._labels) > 0:
+            labels = np.concatenate(self._labels)
+            values = np.concatenate(self._values)
+        else:
+            labels = np.array([], dtype=np.int64)
+            values = np.array([])
+        values = values[np.lexsort((values, labels))]
+        starts = np.cumsum(self.count) - self.count
+        has_values = self.count > 0
+        for q in qs:
+            position = (np.maximum(self.count, 1) - 1) * q / 100
+            lower = np.floor(position).astype(np.int64)
+            upper = np.minimum(lower + 1, np.maximum(self.count - 1, 0))
+            fraction = position - lower
+            result = np.full(self.n, np.nan)
+            lo = values[(starts + lower)[has_values]]
+            hi = values[(starts + upper)[has_values]]
+            result[has_values] = lo + (hi - lo) * fraction[has_values]
+            results[q] = result
+        return results
+
+    def results(self):
+        """Get the statistics for each group.
+
+        Returns
+        -------
+        results : dict of 1D arrays, keyed by statistic name
+            Statistics for groups without any values are NaN
+            (or 0, for 'count').
+        """
+        has_values = self.count > 0
+        count = np.maximum(self.count, 1)
+        computed = {'min': self.min,
+                    'max': self.max,
+                    'mean': self.sum / count,
+                    'sum': self.sum,
+                    'std': np.sqrt(self.m2 / count),
+                    }
+        qs = {s: 50. if s == 'median' else float(s.split('_')[1])
+              for s in self.stats
+              if s == 'median' or s.startswith('percentile_')}
+        percentiles = self._percentiles(set(qs.values())) if qs else {}
+        results = {}
+        for stat in self.stats:
+            if stat == 'count':
+                results[stat] = self.count.copy()
+                continue
+            elif stat in qs:
+                values = percentiles[qs[stat]]
+            else:
+                values = computed[stat].astype(float)
+            results[stat] = np.where(has_values, values, np.nan)
+        return results
+
+
+def _read_windows(src, bounds, max_pixels=2**22):
+    """Generate strips of rows (rasterio windows) covering a bounding box
+    in a raster, with no more than max_pixels pixels in each strip."""
+    full = Window(0, 0, src.width, src.height)
+    window = from_bounds(*bounds, transform=src.transform)
+    window = window.round_offsets(op='floor').round_lengths(op='ceil')
+    # pad by one pixel, to avoid missing edge pixels from round-off
+    col_off, row_off = int(window.col_off) - 1, int(window.row_off) - 1
+    col_end = min(col_off + int(window.width) + 2, full.width)
+    row_end = min(row_off + int(window.height) + 2, full.height)
+    col_off, row_off = max(col_off, 0), max(row_off, 0)
+    if col_end <= col_off or row_end <= row_off:
+        return
+    width = col_end - col_off
+    nrows = max(1, max_pixels // width)
+    for row in range(row_off, row_end, nrows):
+        yield Window(col_off, row, width, min(nrows, row_end - row))
+
+
+def _pixel_centers(transform, window):
+    """x, y coordinates of the pixel centers in a raster window."""
+    cols = np.arange(window.col_off, window.col_off + window.width) + 0.5
+    rows = np.arange(window.row_off, window.row_off + window.height) + 0.5
+    cols, rows = np.meshgrid(cols, rows)
+    x = transform.a * cols + transform.b * rows + transform.c
+    y = transform.d * cols + transform.e * rows + transform.f
+    return x, y
+
+
+def cell_zonal_stats(raster, grid, nodes, stats='min', crs=None,
+                     max_pixels=2**22):
+    """Compute zonal statistics for structured grid cells.
+    Instead of rasterizing a polygon for each cell (as in
+    rasterstats.zonal_stats), each raster pixel is labeled with the
+    node number of the cell containing its center, and values are
+    reduced by node, reading the raster in strips of rows.
+    Each cell is sampled only once, regardless of how many
+    times it is repeated in nodes.
+
+    Parameters
+    ----------
+    raster : str
+        Path to a raster dataset (band 1 is sampled).
+    grid : sfrmaker.StructuredGrid instance
+        Must have :attr:`StructuredGrid.edges` (e.g. a grid
+        created with :meth:`StructuredGrid.from_modelgrid`).
+    nodes : sequence of ints
+        Node numbers of cells to sample.
+    stats : str or sequence of strings
+        Statistics to compute ('min', 'max', 'mean', 'count', 'sum', 'std',
+        'median' or 'percentile_<q>'), by default 'min'.
+    crs : obj, optional
+        Coordinate reference system of the grid, if it is different
+        from the grid's crs attribute. If the raster is in a different CRS,
+        the pixel centers are reprojected to the grid CRS.
+    max_pixels : int
+        Maximum number of pixels to read at once, by default 2**22.
+
+    Returns
+    -------
+    results : DataFrame
+        Statistics (columns) for each unique node (index). Statistics
+        for cells without any valid pixels are NaN (or 0, for 'count').
+    """
+    if grid.edges is None:
+        raise ValueError('cell_zonal_stats requires a StructuredGrid '
+                         'with known edges (xul, yul, delr and delc).')
+    stats = parse_stats(stats)
+    unique_nodes = np.unique(np.asarray(nodes, dtype=int))
+    # lookup of positions in unique_nodes, by node number
+    # (the extra last position maps nodes outside of the grid (-1) to -1)
+    positions = np.full(grid.nrow * grid.ncol + 1, -1)
+    positions[unique_nodes] = np.arange(len(unique_nodes))
+
+    grid_crs = get_authority_crs(crs if crs is not None else grid.crs)
+    cell_bounds = get_bounds(grid.get_cell_polygons(unique_nodes))
+    bounds = (np.nanmin(cell_bounds[:, 0]), np.nanmin(cell_bounds[:, 1]),
+              np.nanmax(cell_bounds[:, 2]), np.nanmax(cell_bounds[:, 3]))
+
+    accumulator = GroupedStats(len(unique_nodes), stats)
+    with rasterio.open(raster) as src:
+        transformer = None
+        if src.crs is not None and grid_crs is not None:
+            raster_crs = get_authority_crs(src.crs)
+            if raster_crs != grid_crs:
+                bounds = transform_bounds(grid_crs, raster_crs, *bounds, densify_pts=21)
+                transformer = get_transformer(raster_crs, grid_crs)
+        for window in _read_windows(src, bounds, max_pixels=max_pixels):
+            data = src.read(1, window=window, masked=True)
+            x, y = _pixel_centers(src.transform, window)
+            if transformer is not None:
+                x, y = transformer.transform(x, y)
+            labels = positions[grid.locate_points(x, y)]
+            values = data.data.astype(float)
+            values[np.ma.getmaskarray(data)] = np.nan
+            valid = (labels >= 0) & np.isfinite(values)
+            accumulator.add(labels[valid], values[valid])
+    return pd.DataFrame(accumulator.results(), index=unique_nodes)
+
+
+def _feature_windows(src, bounds):
+    """Pixel row and column ranges (row_off, col_off, row_end, col_end)
+    covering the bounding boxes of features, padded by one pixel."""
+    inverse = ~src.transform
+    corners = [inverse * (bounds[:, x], bounds[:, y])
+               for x, y in ((0, 1), (0, 3), (2, 1), (2, 3))]
+    cols = np.array([c[0] for c in corners])
+    rows = np.array([c[1] for c in corners])
+    return (np.floor(rows.min(axis=0)) - 1, np.floor(cols.min(axis=0)) - 1,
+            np.ceil(rows.max(axis=0)) + 1, np.ceil(cols.max(axis=0)) + 1)
+
+
+def _zonal_stats_tile(raster, features, window, stats, all_touched):
+    """Run rasterstats.zonal_stats on features within a window of a raster,
+    after reading the window into memory. If window is None,
+    the features are sampled from the raster file."""
+    if window is None:
+        return zonal_stats(features, raster, stats=stats, all_touched=all_touched)
+    with rasterio.open(raster) as src:
+        # pixels outside of the raster are filled in the same way
+        # as in a (boundless) read by rasterstats
+        data = src.read(1, window=window, boundless=True)
+        transform = src.window_transform(window)
+        nodata = src.nodata
+    return zonal_stats(features, data, affine=transform, nodata=nodata,
+                       stats=stats, all_touched=all_touched)
+
+
+def tiled_zonal_stats(features, raster, stats='min', all_touched=False,
+                      n_workers=None, tile_size=2048):
+    """Run rasterstats.zonal_stats on features in a raster, one tile
+    (square block of pixels) at a time. Features are grouped by the tile
+    containing the center of their bounding box, and each group of features
+    is sampled from a single in-memory read of the raster window
+    that covers it, optionally in parallel. Results are the same as
+    running rasterstats.zonal_stats on the raster file.
+
+    Parameters
+    ----------
+    features : sequence of shapely geometries
+        In the same coordinate reference system as the raster.
+    raster : str
+        Path to a raster dataset (band 1 is sampled).
+    stats : str or sequence of strings
+        Statistics to compute, as in rasterstats.zonal_stats;
+        by default, 'min'.
+    all_touched : bool
+        Option to include all pixels touched by each feature,
+        instead of only the pixels with centers inside the feature.
+        By default, False.
+    n_workers : int, optional
+        Number of processes for sampling tiles in parallel. Each process
+        opens the raster (read-only) separately. By default, None
+        (tiles are sampled in the current process).
+    tile_size : int
+        Width and height of the tiles, in pixels. By default, 2048.
+
+    Returns
+    -------
+    results : list of dicts
+        Statistics for each feature, in the same order as features.
+    """
+    features = list(features)
+    results = [None] * len(features)
+    if len(features) == 0:
+        return results
+    bounds = get_bounds(features)
+    with rasterio.open(raster) as src:
+        width = src.width
+        row_off, col_off, row_end, col_end = _feature_windows(src, bounds)
+    center_rows = np.nan_to_num(0.5 * (row_off + row_end))
+    center_cols = np.nan_to_num(0.5 * (col_off + col_end))
+    tiles = (np.floor(center_rows / tile_size).astype(np.int64) * (width // tile_size + 1) +
+             np.floor(center_cols / tile_size).astype(np.int64))
+    order = np.argsort(tiles, kind='stable')
+    starts = np.flatnonzero(np.append(True, np.diff(tiles[order]) != 0))
+    groups = np.split(order, starts[1:])
+
+    tasks = []
+    for group in groups:
+        window = None
+        if np.isfinite(row_off[group]).any():
+            r0, c0 = np.nanmin(row_off[group]), np.nanmin(col_off[group])
+            r1, c1 = np.nanmax(row_end[group]), np.nanmax(col_end[group])
+            window = Window(int(c0), int(r0), int(c1 - c0), int(r1 - r0))
+        tasks.append((group, [features[i] for i in group], window))
+
+    print('running rasterstats.zonal_stats on {:,d} features in {:,d} tiles...'.format(
+        len(features), len(tasks)))
+    if n_workers is not None and n_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_zonal_stats_tile, raster, geoms, window,
+                                       stats, all_touched)
+                       for group, geoms, window in tasks]
+            tile_results = [future.result() for future in futures]
+    else:
+        tile_results = [_zonal_stats_tile(raster, geoms, window, stats, all_touched)
+                        for group, geoms, window in tasks]
+    for (group, geoms, window), tile_result in zip(tasks, tile_results):
+        for i, result in zip(group, tile_result):
+            results[i] = result
+    return results
+
+
+def densify_lines(lines, spacing):
+    """Get points at even intervals along LineStrings,
+    including the start and end of each line.
+
+    Parameters
+    ----------
+    lines : sequence of shapely LineStrings
+    spacing : float
+        Maximum distance between points along each line.
+
+    Returns
+    -------
+    x, y : 1D arrays of point coordinates
+        (NaN for empty lines)
+    line_index : 1D array of ints
+        Position of the line (in lines) that each point is on.
+    """
+    lines = geometry_array(lines)
+    lengths = get_lengths(lines)
+    npoints = np.ceil(lengths / spacing).astype(np.int64) + 1
+    line_index = np.repeat(np.arange(len(lines)), npoints)
+    nth = np.arange(npoints.sum()) - np.repeat(np.cumsum(npoints) - npoints, npoints)
+    fractions = nth / np.maximum(npoints[line_index] - 1, 1)
+    if shapely2:
+        points = shapely.line_interpolate_point(lines[line_index], fractions,
+                                                normalized=True)
+        x, y = np.full((2, len(points)), np.nan)
+        empty = shapely.is_empty(points)
+        x[~empty], y[~empty] = shapely.get_coordinates(points[~empty]).T
+    else:
+        points = [lines[i].interpolate(f, normalized=True)
+                  for i, f in zip(line_index, fractions)]
+        x = np.array([p.x if not p.is_empty else np.nan for p in points])
+        y = np.array([p.y if not p.is_empty else np.nan for p in points])
+    return x, y, line_index
+
+
+def _pixel_size(src, transformer=None):
+    """Size of a raster pixel (the square root of the pixel area),
+    measured at the center of the raster. If a transformer (from another
+    CRS to the raster CRS) is supplied, the size is in the units of the
+    other CRS."""
+    size = np.sqrt(src.res[0] * src.res[1])
+    if transformer is None:
+        return size
+    # transform the sides of the center pixel to the other CRS
+    x0, y0 = src.xy(src.height // 2, src.width // 2)
+    x = np.array([x0, x0 + src.res[0], x0])
+    y = np.array([y0, y0, y0 + src.res[1]])
+    x, y = transformer.transform(x, y, direction='INVERSE')
+    dx = np.hypot(x[1] - x[0], y[1] - y[0])
+    dy = np.hypot(x[2] - x[0], y[2] - y[0])
+    return np.sqrt(dx * dy)
+
+
+def line_point_stats(raster, lines, stats='min', spacing=None, crs=None,
+                     tile_size=1024):
+    """Compute statistics of raster values sampled at points along
+    LineStrings, as a cheaper alternative to zonal statistics on buffer
+    polygons when the raster resolution is much finer than the lines.
+    Points are sampled with the raster's affine transform, reading each
+    tile of the raster (rounded to whole blocks) that has points only once.
+
+    Parameters
+    ----------
+    raster : str
+        Path to a raster dataset (band 1 is sampled).
+    lines : sequence of shapely LineStrings
+    stats : str or sequence of strings
+        Statistics to compute ('min', 'max', 'mean', 'count', 'sum', 'std',
+        'median' or 'percentile_<q>'), by default 'min'.
+    spacing : float, optional
+        Distance between the sampled points along each line, in the
+        units of the line coordinates. By default, None, in which case the
+        raster resolution is used (converted to the units of the line
+        coordinates if the lines are in a different CRS).
+    crs : obj, optional
+        Coordinate reference system of the lines, if they are in a different
+        CRS from the raster. Any input accepted by
+        :meth:`pyproj.crs.CRS.from_user_input`.
+    tile_size : int
+        Approximate width and height of the raster windows that are read
+        at once, in pixels. By default, 1024.
+
+    Returns
+    -------
+    results : DataFrame
+        Statistics (columns) for each line (rows, in the same order as lines).
+        Statistics for lines without any valid raster values are NaN
+        (or 0, for 'count').
+    """
+    stats = parse_stats(stats)
+    lines = geometry_array(lines)
+    accumulator = GroupedStats(len(lines), stats)
+    with rasterio.open(raster) as src:
+        transformer = None
+        if crs is not None and src.crs is not None:
+            raster_crs = get_authority_crs(src.crs)
+            crs = get_authority_crs(crs)
+            if raster_crs != crs:
+                transformer = get_transformer(crs, raster_crs)
+        if spacing is None:
+            spacing = _pixel_size(src, transformer)
+        x, y, line_index = densify_lines(lines, spacing)
+        if transformer is not None:
+            x, y = transformer.transform(x, y)
+
+        # locate the points in the raster
+        finite = np.isfinite(x) & np.isfinite(y)
+        cols, rows = ~src.transform * (x[finite], y[finite])
+        rows = np.floor(rows).astype(np.int64)
+        cols = np.floor(cols).astype(np.int64)
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+        rows, cols = rows[inside], cols[inside]
+        line_index = line_index[finite][inside]
+
+        # read the raster in tiles of whole blocks
+        block_height, block_width = src.block_shapes[0]
+        tile_height = block_height * int(np.ceil(tile_size / block_height))
+        tile_width = block_width * int(np.ceil(tile_size / block_width))
+        ntile_cols = src.width // tile_width + 1
+        tiles = (rows // tile_height) * ntile_cols + cols // tile_width
+        order = np.argsort(tiles, kind='stable')
+        starts = np.flatnonzero(np.append(True, np.diff(tiles[order]) != 0))
+        for group in np.split(order, starts[1:]):
+            if len(group) == 0:
+                continue
+            row_off = (rows[group[0]] // tile_height) * tile_height
+            col_off = (cols[group[0]] // tile_width) * tile_width
+            window = Window(col_off, row_off,
+                            min(tile_width, src.width - col_off),
+                            min(tile_height, src.height - row_off))
+            data = src.read(1, window=window, masked=True)
+            values = data.data[rows[group] - row_off, cols[group] - col_off].astype(float)
+            masked = np.ma.getmaskarray(data)[rows[group] - row_off, cols[group] - col_off]
+            valid = ~masked & np.isfinite(values)
+            accumulator.add(line_index[group][valid], values[valid])
+    return pd.DataFrame(accumulator.results())
+
+
+def get_geometry_hashes(geoms):
+    """Get content hashes (SHA-1 hex digests of the well-known binary)
+    for a sequence of shapely geometries.
+
+    Returns
+    -------
+    hashes : 1D array of strings
+    """
+    geoms = geometry_array(geoms)
+    if shapely2:
+        wkbs = shapely.to_wkb(geoms)
+    else:
+        wkbs = [g.wkb for g in geoms]
+    return np.array([hashlib.sha1(wkb).hexdigest() for wkb in wkbs])
+
+
+def get_raster_identity(raster):
+    """Identify a raster file by its absolute path, size and
+    modification time, so that changes to the file can be detected
+    without reading it. For multiple raster tiles (a list of files or
+    a folder; see :func:`get_raster_tiles`), a list of the tile identities
+    is returned."""
+    tiles = get_raster_tiles(raster)
+    identities = []
+    for tile in tiles:
+        stat = os.stat(tile)
+        identities.append({'path': os.path.abspath(tile),
+                           'size': stat.st_size,
+                           'mtime': stat.st_mtime_ns})
+    if isinstance(raster, (str, Path)) and not Path(raster).is_dir():
+        return identities[0]
+    return identities
+
+
+class ZonalStatsCache:
+    """On-disk cache of zonal statistics sampled from a raster,
+    by feature. Cached statistics are stored in a CSV file in
+    ``cache_dir`` for each combination of raster file (identified by its
+    path, size and modification time), statistics and sampling settings,
+    with a row of statistics for each feature, keyed by a hash
+    of the feature geometry (see :func:`get_geometry_hashes`).
+
+    Parameters
+    ----------
+    cache_dir : str or pathlike
+        Folder for the cache files. Created if it doesn't exist.
+    raster : str, list of strings, or folder
+        Raster dataset being sampled, or multiple raster tiles
+        (see :func:`get_raster_tiles`).
+    stats : sequence of strings
+        Statistics being computed.
+    **settings : keyword arguments
+        Any other settings that affect the sampled values (for example,
+        buffer distance or sampling method). Values must be
+        JSON-serializable, or have a string representation that
+        identifies them.
+    """
+    def __init__(self, cache_dir, raster, stats, **settings):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.stats = list(stats)
+        namespace = {'raster': get_raster_identity(raster),
+                     'stats': self.stats,
+                     'settings': settings}
+        namespace = json.dumps(namespace, sort_keys=True, default=str)
+        name = hashlib.sha1(namespace.encode()).hexdigest()[:16]
+        self.filename = self.cache_dir / 'zonal_stats_{}.csv'.format(name)
+        if self.filename.exists():
+            self._table = pd.read_csv(self.filename, index_col='key',
+                                      float_precision='round_trip')
+        else:
+            self._table = pd.DataFrame(columns=self.stats, dtype=float)
+            self._table.index.name = 'key'
+
+    def get(self, keys):
+        """Get cached statistics.
+
+        Parameters
+        ----------
+        keys : sequence of strings
+            Feature geometry hashes.
+
+        Returns
+        -------
+        cached : DataFrame
+            Statistics for each key (row), in the order of keys
+            (with a range index). Rows for keys that aren't cached are NaN.
+        found : 1D boolean array
+            True for keys that are cached.
+        """
+        keys = np.asarray(keys)
+        found = np.isin(keys, self._table.index.values)
+        cached = self._table.reindex(keys)[self.stats].reset_index(drop=True)
+        return cached, found
+
+    def update(self, keys, results):
+        """Add statistics to the cache and write the cache file.
+
+        Parameters
+        ----------
+        keys : sequence of strings
+            Feature geometry hashes.
+        results : DataFrame or sequence of dicts
+            Statistics for each key.
+        """
+        results = pd.DataFrame(list(results) if not isinstance(results, pd.DataFrame)
+                               else results)
+        results = results.reindex(columns=self.stats).astype(float)
+        results.index = pd.Index(keys, name='key')
+        results = results.loc[~results.index.duplicated()]
+        table = pd.concat([self._table.loc[~self._table.index.isin(results.index)],
+                           results])
+        # write to a temporary file and then move it into place,
+        # so that an interrupted write never leaves a truncated cache file
+        fd, tmp_file = tempfile.mkstemp(suffix='.csv', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'w', newline='') as dest:
+                table.to_csv(dest)
+            os.replace(tmp_file, self.filename)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        self._table = table
+
+
+raster_extensions = {'.tif', '.tiff', '.img', '.asc', '.vrt'}
+
+# GDAL data type names for the rasterio (numpy) data types
+gdal_data_types = {'uint8': 'Byte', 'int8': 'Int8',
+                   'uint16': 'UInt16', 'int16': 'Int16',
+                   'uint32': 'UInt32', 'int32': 'Int32',
+                   'float32': 'Float32', 'float64': 'Float64'}
+
+
+def get_raster_tiles(raster):
+    """Get a list of raster files, from a single raster file,
+    a list of raster files, or a folder of raster files (with extensions
+    of .tif, .tiff, .img, .asc or .vrt).
+    """
+    if isinstance(raster, (str, Path)):
+        if Path(raster).is_dir():
+            tiles = sorted(str(f) for f in Path(raster).iterdir()
+                           if f.suffix.lower() in raster_extensions)
+            if len(tiles) == 0:
+                raise ValueError('No raster files found in {}'.format(raster))
+            return tiles
+        return [str(raster)]
+    tiles = [str(f) for f in raster]
+    if len(tiles) == 0:
+        raise ValueError('No raster files specified.')
+    return tiles
+
+
+def get_tile_index(raster):
+    """Get an index of the bounds and properties of raster tiles,
+    from their headers.
+
+    Parameters
+    ----------
+    raster : str, list of strings, or folder
+        See :func:`get_raster_tiles`.
+
+    Returns
+    -------
+    tile_index : DataFrame
+        One row per tile, with the tile filename, bounds (left, bottom,
+        right, top), size (width, height), affine transform, CRS, nodata value,
+        data type and block shape.
+    """
+    records = []
+    for tile in get_raster_tiles(raster):
+        with rasterio.open(tile) as src:
+            records.append({'filename': os.path.abspath(tile),
+                            'left': src.bounds.left, 'bottom': src.bounds.bottom,
+                            'right': src.bounds.right, 'top': src.bounds.top,
+                            'width': src.width, 'height': src.height,
+                            'transform': src.transform, 'crs': src.crs,
+                            'nodata': src.nodata, 'dtype': src.dtypes[0],
+                            'block_shape': src.block_shapes[0]})
+    return pd.DataFrame(records)
+
+
+def build_raster_mosaic(raster, vrt_file=None, out_dir=None):
+    """Build a virtual mosaic (GDAL VRT file) of raster tiles, so that
+    multiple tiles can be sampled as if they were a single raster, without
+    merging them. The VRT only references the tiles; reads from it only
+    open the tiles that they overlap. Where tiles overlap, values from
+    the first tile are used (as in :func:`rasterio.merge.merge`).
+
+    Parameters
+    ----------
+    raster : str, list of strings, or folder
+        Raster tiles (see :func:`get_raster_tiles`). Tiles must have the
+        same CRS and pixel size, and be aligned to the same (unrotated)
+        pixel grid. If a single raster file is specified,
+        it is returned as is.
+    vrt_file : str, optional
+        Path for the VRT file.
+    out_dir : str or pathlike, optional
+        Folder for the VRT file, if ``vrt_file`` isn't specified. The VRT file
+        is named based on the tile file identities (see :func:`get_raster_identity`),
+        and reused if it already exists. Either ``vrt_file`` or ``out_dir``
+        is required for multiple tiles; see :func:`raster_mosaic`
+        for writing the VRT file to a temporary folder.
+
+    Returns
+    -------
+    raster_path : str
+        Path to the VRT file (or the single raster file).
+    """
+    tiles = get_raster_tiles(raster)
+    if len(tiles) == 1:
+        return tiles[0]
+    if vrt_file is None:
+        if out_dir is None:
+            raise ValueError('Either vrt_file or out_dir is needed '
+                             'to build a mosaic of multiple raster tiles.')
+        identity = json.dumps(get_raster_identity(tiles), sort_keys=True)
+        name = hashlib.sha1(identity.encode()).hexdigest()[:16]
+        vrt_file = Path(out_dir, 'mosaic_{}.vrt'.format(name))
+        if vrt_file.exists():
+            return str(vrt_file)
+    vrt_file = Path(vrt_file)
+    vrt_file.parent.mkdir(parents=True, exist_ok=True)
+
+    index = get_tile_index(tiles)
+    transform = index['transform'].values[0]
+    crs = index['crs'].values[0]
+    for tile in index.itertuples():
+        if tile.crs != crs:
+            raise ValueError('Raster tiles must have the same CRS: {}'.format(tile.filename))
+        t = tile.transform
+        if t.b != 0 or t.d != 0:
+            raise ValueError('Rotated raster tiles are not supported: {}'.format(tile.filename))
+        if not np.allclose((t.a, t.e), (transform.a, transform.e), rtol=1e-9):
+            raise ValueError('Raster tiles must have the same pixel size: {}'.format(tile.filename))
+    xres, yres = transform.a, -transform.e
+    left, top = float(index['left'].min()), float(index['top'].max())
+    col_offs = (index['left'].values - left) / xres
+    row_offs = (top - index['top'].values) / yres
+    if not (np.allclose(col_offs, np.round(col_offs), atol=1e-6) and
+            np.allclose(row_offs, np.round(row_offs), atol=1e-6)):
+        raise ValueError('Raster tiles must be aligned to the same pixel grid.')
+    col_offs = np.round(col_offs).astype(int)
+    row_offs = np.round(row_offs).astype(int)
+    width = int((col_offs + index['width'].values).max())
+    height = int((row_offs + index['height'].values).max())
+    nodata = index['nodata'].values[0]
+    data_type = gdal_data_types[index['dtype'].values[0]]
+
+    lines = ['<VRTDataset rasterXSize="{}" rasterYSize="{}">'.format(width, height)]
+    if crs is not None:
+        lines.append('  <SRS>{}</SRS>'.format(escape(crs.to_wkt())))
+    lines.append('  <GeoTransform>{:.17g}, {:.17g}, 0.0, {:.17g}, 0.0, {:.17g}</GeoTransform>'.format(
+        left, float(xres), top, -float(yres)))
+    lines.append('  <VRTRasterBand dataType="{}" band="1">'.format(data_type))
+    if nodata is not None:
+        lines.append('    <NoDataValue>{:.17g}</NoDataValue>'.format(float(nodata)))
+    # later sources are drawn on top; reverse the tiles so that the first one is on top
+    for i in reversed(range(len(index))):
+        tile = index.iloc[i]
+        block_height, block_width = tile['block_shape']
+        lines += ['    <ComplexSource>',
+                  '      <SourceFilename relativeToVRT="0">{}</SourceFilename>'.format(
+                      escape(tile['filename'])),
+                  '      <SourceBand>1</SourceBand>',
+                  ('      <SourceProperties RasterXSize="{}" RasterYSize="{}" DataType="{}" '
+                   'BlockXSize="{}" BlockYSize="{}" />').format(
+                      tile['width'], tile['height'], gdal_data_types[tile['dtype']],
+                      block_width, block_height),
+                  '      <SrcRect xOff="0" yOff="0" xSize="{}" ySize="{}" />'.format(
+                      tile['width'], tile['height']),
+                  '      <DstRect xOff="{}" yOff="{}" xSize="{}" ySize="{}" />'.format(
+                      col_offs[i], row_offs[i], tile['width'], tile['height'])]
+        if tile['nodata'] is not None and np.isfinite(tile['nodata']):
+            lines.append('      <NODATA>{:.17g}</NODATA>'.format(float(tile['nodata'])))
+        lines.append('    </ComplexSource>')
+    lines += ['  </VRTRasterBand>', '</VRTDataset>']
+    # write to a temporary file and then move it into place,
+    # so that concurrent builds never read a partially written VRT
+    fd, tmp_file = tempfile.mkstemp(suffix='.vrt', dir=vrt_file.parent)
+    try:
+        with os.fdopen(fd, 'w') as dest:
+            dest.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, vrt_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    print('wrote virtual mosaic of {} raster tiles to {}'.format(len(index), vrt_file))
+    return str(vrt_file)
+
+
+@contextmanager
+def raster_mosaic(raster, out_dir=None):
+    """Context manager that yields a single raster path for one or more
+    raster tiles (see :func:`build_raster_mosaic`).
+
+    Parameters
+    ----------
+    raster : str, list of strings, or folder
+        Raster file, or raster tiles (see :func:`get_raster_tiles`).
+    out_dir : str or pathlike, optional
+        Folder for keeping the VRT file for multiple tiles, so that it can be
+        reused. By default, None, in which case the VRT file is written to a
+        temporary folder that is removed on exit.
+
+    Yields
+    ------
+    raster_path : str
+        Path to the VRT file (or the single raster file).
+    """
+    if len(get_raster_tiles(raster)) == 1 or out_dir is not None:
+        yield build_raster_mosaic(raster, out_dir=out_dir)
+    else:
+        with tempfile.TemporaryDirectory(prefix='sfrmaker_mosaic_') as tmpdir:
+            yield build_raster_mosaic(raster, out_dir=tmpdir)
+
@@ -1,9 +1,13 @@
-import operator
+import itertools
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
+import shapely
 from shapely.geometry import Point
+from sfrmaker.gis import get_bounds, shapely2
+from sfrmaker.grid import walk_line
 
 
 def consolidate_reach_conductances(rd, keep_only_dominant=False):
@@ -109,7 +113,7 @@ def interpolate_to_reaches(reach_data, segment_data,
 
 
 def setup_reach_data(flowline_geoms, fl_comids, grid_intersections,
-                     grid_geoms, tol=0.01):
+                     grid_geoms, tol=0.01, grid=None, n_workers=None):
     """Create prelimnary stream reaches from lists of grid cell intersections
     for each flowline.
 
@@ -131,6 +135,16 @@ def setup_reach_data(flowline_geoms, fl_comids, grid_intersections,
         not occur to reaches beyond this distance. This number should be small,
         because the ends of consecutive reaches should be touching if they were
         created via intersection with the model grid. (default 0.01)
+    grid : sfrmaker.StructuredGrid instance, optional
+        Option to create the reaches by walking each flowline through a
+        structured grid with known :attr:`~sfrmaker.StructuredGrid.edges`
+        (see :meth:`~sfrmaker.StructuredGrid.walk_line`), in which case
+        grid_intersections and grid_geoms aren't used. By default, None.
+    n_workers : int, optional
+        Number of processes to use for creating the reaches. The flowlines
+        are split into spatially coherent chunks, which are processed in a
+        process pool. Each chunk is only sent the grid cell polygons
+        that it intersects. By default, None (a single process).
 
     Returns
     -------
@@ -146,6 +160,9 @@ def setup_reach_data(flowline_geoms, fl_comids, grid_intersections,
         geometry : LineString
             LineString representing the intersected reach.
     """
+    if n_workers is not None and n_workers > 1 and len(flowline_geoms) > 1:
+        return _setup_reach_data_parallel(flowline_geoms, fl_comids, grid_intersections,
+                                          grid_geoms, tol=tol, grid=grid, n_workers=n_workers)
     print("\nSetting up reach data... (may take a few minutes for large grids)")
     ta = time.time()
     fl_segments = np.arange(1, len(flowline_geoms) + 1)
@@ -155,11 +172,17 @@ def setup_reach_data(flowline_geoms, fl_comids, grid_intersections,
     geometry = []
     comids = []
 
+    if grid is not None:
+        def _create_reaches(part, *args, **kwargs):
+            return grid.walk_line(part)
+    else:
+        _create_reaches = create_reaches
+
     for i in range(len(flowline_geoms)):
         segment_geom = flowline_geoms[i]
-        segment_nodes = grid_intersections[i]
+        segment_nodes = grid_intersections[i] if grid is None else None
         if segment_geom.type != 'MultiLineString' and segment_geom.type != 'GeometryCollection':
-            ordered_reach_geoms, ordered_node_numbers = create_reaches(segment_geom, segment_nodes, grid_geoms, tol=tol)
+            ordered_reach_geoms, ordered_node_numbers = _create_reaches(segment_geom, segment_nodes, grid_geoms, tol=tol)
             reach += list(np.arange(len(ordered_reach_geoms)) + 1)
             geometry += ordered_reach_geoms
             node += ordered_node_numbers
@@ -168,7 +191,7 @@ def setup_reach_data(flowline_geoms, fl_comids, grid_intersections,
         else:
             start_reach = 0
             for j, part in enumerate(list(segment_geom.geoms)):
-                geoms, node_numbers = create_reaches(part, segment_nodes, grid_geoms)
+                geoms, node_numbers = _create_reaches(part, segment_nodes, grid_geoms)
                 if j > 0:
                     start_reach = reach[-1]
                 reach += list(np.arange(start_reach, start_reach + len(geoms)) + 1)
@@ -188,10 +211,83 @@ def setup_reach_data(flowline_geoms, fl_comids, grid_intersections,
     return m1
 
 
+class _GridWalker:
+    """Picklable stand-in for a :class:`~sfrmaker.StructuredGrid`,
+    with only the information needed by :func:`~sfrmaker.grid.walk_line`.
+    """
+    def __init__(self, grid):
+        self.args = (grid.xul, grid.yul, grid.rotation) + tuple(grid.edges)
+
+    def walk_line(self, part):
+        return walk_line(part, *self.args)
+
+
+def _spatial_chunks(geoms, n_chunks):
+    """Split geometries into spatially coherent chunks, by sorting
+    the centers of their bounding boxes along a Z-order (Morton) curve.
+
+    Returns
+    -------
+    chunks : list of 1D arrays
+        Positions of the geometries in each chunk.
+    """
+    bounds = np.nan_to_num(get_bounds(geoms))
+    xy = 0.5 * (bounds[:, :2] + bounds[:, 2:])
+    extent = np.maximum(xy.max(axis=0) - xy.min(axis=0), 1e-12)
+    scaled = ((xy - xy.min(axis=0)) / extent * 1023).astype(np.int64)
+    code = np.zeros(len(xy), dtype=np.int64)
+    for bit in range(10):
+        code |= ((scaled[:, 0] >> bit) & 1) << (2 * bit)
+        code |= ((scaled[:, 1] >> bit) & 1) << (2 * bit + 1)
+    order = np.argsort(code, kind='mergesort')
+    return [chunk for chunk in np.array_split(order, min(n_chunks, len(geoms)))
+            if len(chunk) > 0]
+
+
+def _setup_reach_data_chunk(args):
+    return setup_reach_data(*args)
+
+
+def _setup_reach_data_parallel(flowline_geoms, fl_comids, grid_intersections,
+                               grid_geoms, tol=0.01, grid=None, n_workers=2):
+    """Run :func:`setup_reach_data` on spatially coherent chunks of the
+    flowlines in a process pool, and then merge the results in segment order.
+    """
+    print("\nSetting up reach data with {} processes...".format(n_workers))
+    ta = time.time()
+    # several chunks per process, so that processes aren't left idle
+    # waiting on chunks with long or complex flowlines
+    chunks = _spatial_chunks(flowline_geoms, n_workers * 4)
+    if grid is not None:
+        grid = _GridWalker(grid)
+    tasks = []
+    for inds in chunks:
+        chunk_intersections, chunk_geoms = None, None
+        if grid is None:
+            chunk_intersections = [grid_intersections[i] for i in inds]
+            nodes = set(itertools.chain.from_iterable(chunk_intersections))
+            chunk_geoms = {n: grid_geoms[n] for n in nodes}
+        tasks.append(([flowline_geoms[i] for i in inds],
+                      [fl_comids[i] for i in inds],
+                      chunk_intersections, chunk_geoms, tol, grid))
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        results = list(pool.map(_setup_reach_data_chunk, tasks))
+
+    # convert the segment numbers in each chunk back to flowline positions
+    for inds, m1 in zip(chunks, results):
+        m1['iseg'] = inds[m1['iseg'].values.astype(int) - 1] + 1
+    m1 = pd.concat(results)
+    m1.sort_values(by=['iseg', 'ireach'], inplace=True)
+    m1.reset_index(drop=True, inplace=True)
+    m1['rno'] = np.arange(len(m1)) + 1
+    print("finished in {:.2f}s\n".format(time.time() - ta))
+    return m1
+
+
 def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
     """Creates SFR reaches for a segment by ordering model cells
     intersected by a LineString part. Reaches within a part are
-    ordered by proximity.
+    ordered by their positions along the part.
 
     Parameters
     ----------
@@ -202,10 +298,7 @@ def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
     grid_geoms: list of Polygons
         List of shapely Polygon objects for the model grid cells, sorted by node number
     tol : float
-        Maximum distance for identifying a connecting reach. Routing will
-        not occur to reaches beyond this distance. This number should be small,
-        because the ends of consecutive reaches should be touching if they were
-        created via intersection with the model grid. (default 0.01)
+        Not used; retained for backwards compatibility.
 
     Returns
     -------
@@ -213,6 +306,15 @@ def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
         List of LineString objects representing the SFR reaches for the segment.
     ordered_node_numbers: list of ints
         List of model cells containing the SFR reaches for the segment
+
+    Notes
+    -----
+    Each reach is located by projecting its midpoint onto *part*
+    (linear referencing). Midpoints are used instead of start points,
+    because a start point that is shared with another reach
+    (e.g. at a cell corner, or where the line touches itself) can
+    project to more than one position. Any ties are broken by the
+    position of the upstream end of the reach, and then by node number.
     """
     reach_nodes = {}
     reach_geoms = {}
@@ -236,27 +338,22 @@ def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
             reach_geoms.update({n + nn: gg for nn, gg in enumerate(geoms)})
             n += len(geoms)
 
-    # make point features for start and end of flowline part
-    start = Point(part.coords[0])
-    end = Point(part.coords[-1])
-
-    ordered_reach_geoms = []
-    ordered_node_numbers = []
-    current_reach = start
-    nreaches = len(reach_geoms)  # length before entries are popped
-
-    # for each flowline part (reach)
-    for i in range(nreaches):
-        # find the next flowline part (reach) that touches the current reach
-        dist = {j: g.distance(current_reach) for j, g in reach_geoms.items()}
-        dist_sorted = sorted(dist.items(), key=operator.itemgetter(1))
-        r = dist_sorted[0][0]
-        next_reach = reach_geoms.pop(r)
-        ordered_reach_geoms.append(next_reach)
-        ordered_node_numbers.append(reach_nodes[r])
-        current_reach = next_reach
-
-        if current_reach.touches(end.buffer(tol)) and len(ordered_node_numbers) == nreaches:
-            break
-    assert len(ordered_node_numbers) == nreaches  # new list of ordered node numbers must include all flowline parts
-    return ordered_reach_geoms, ordered_node_numbers
\ No newline at end of file
+    geoms = list(reach_geoms.values())
+    nodes = np.array(list(reach_nodes.values()), dtype=int)
+    if len(geoms) == 0:
+        return [], []
+
+    # distances along the flowline part to the start, end and midpoint of each reach
+    points = [Point(g.coords[0]) for g in geoms] + \
+             [Point(g.coords[-1]) for g in geoms] + \
+             [g.interpolate(0.5, normalized=True) for g in geoms]
+    if shapely2:
+        distances = shapely.line_locate_point(part, points)
+    else:
+        distances = np.array([part.project(p) for p in points])
+    start_dist, end_dist, mid_dist = np.reshape(distances, (3, -1))
+
+    order = np.lexsort((nodes, np.minimum(start_dist, end_dist), mid_dist))
+    ordered_reach_geoms = [geoms[i] for i in order]
+    ordered_node_numbers = nodes[order].tolist()
+    return ordered_reach_geoms, ordered_node_numbers
@@ -1,3 +1,4 @@
+from collections.abc import Mapping
 import time
 
 import numpy as np
@@ -222,6 +223,666 @@ def make_reverse_graph(graph):
     return graph_r
 
 
+class RoutingGraph:
+    """Compact, array-based representation of a one-to-one
+    (or many-to-one) routing network.
+
+    Identifiers (COMIDs, segments, rnos, etc.) are mapped to dense,
+    zero-based node indices (positions in :attr:`RoutingGraph.ids`).
+    Downstream connections are stored as an integer array of node
+    indices, and upstream connections in compressed sparse row (CSR)
+    format (an array of offsets into an array of upstream node indices).
+    This avoids the per-node hashing and set copying associated with
+    dictionary-based graphs on large networks.
+
+    Parameters
+    ----------
+    fromids : list or 1D array
+        Sequence of from nodes. If a value is listed more than
+        once, the last connection listed is used (as with ``dict(zip())``).
+    toids : list or 1D array
+        Sequence of to nodes (downstream connections) for fromids.
+        Values that aren't listed in fromids (besides the outlet value)
+        are included in the graph as outlets.
+    outlet : int or str
+        Value in toids denoting an outlet (no downstream connection).
+        By default, 0. With string ids, toids equal to the
+        outlet value as a string (e.g. '0') are outlets.
+
+    Attributes
+    ----------
+    ids : 1D array
+        Sorted, unique node identifiers.
+    toindex : 1D array of ints
+        Index (position in ids) of the downstream node for each node;
+        -1 for outlets.
+
+    Examples
+    --------
+    >>> graph = RoutingGraph([1, 2, 3], [2, 4, 4])
+    >>> graph.find_path(1)
+    [1, 2, 4, 0]
+    >>> sorted(graph.get_all_upstream(4).tolist())
+    [1, 2, 3]
+    """
+    def __init__(self, fromids, toids, outlet=0):
+        fromids = np.atleast_1d(np.squeeze(np.array(fromids)))
+        toids = np.atleast_1d(np.squeeze(np.array(toids)))
+        if len(fromids) != len(toids):
+            raise ValueError("fromids and toids must be the same length")
+        self.outlet = outlet
+
+        # for any repeated fromids, keep the position of the first listing
+        # and the last connection listed (as with dict(zip()))
+        _, first = np.unique(fromids, return_index=True)
+        _, last = np.unique(fromids[::-1], return_index=True)
+        last = len(fromids) - 1 - last
+        order = np.argsort(first)
+        fromids, toids = fromids[first[order]], toids[last[order]]
+
+        # compare string ids to the outlet value as a string
+        # (for example, '0' for the default outlet value of 0)
+        if toids.dtype.kind in 'US':
+            is_outlet = toids == str(outlet)
+        else:
+            is_outlet = toids == outlet
+        self.ids = np.unique(np.concatenate([fromids, toids[~is_outlet]]))
+        nnodes = len(self.ids)
+        from_index = np.searchsorted(self.ids, fromids)
+
+        # nodes that were listed in fromids
+        # (as opposed to only appearing as a downstream connection)
+        self.listed = np.zeros(nnodes, dtype=bool)
+        self.listed[from_index] = True
+        # order in which each node was listed
+        # (nodes that weren't listed go last)
+        self.position = np.full(nnodes, len(fromids), dtype=np.int64)
+        self.position[from_index] = np.arange(len(fromids))
+
+        self.toindex = np.full(nnodes, -1, dtype=np.int64)
+        self.toindex[from_index[~is_outlet]] = \
+            np.searchsorted(self.ids, toids[~is_outlet])
+
+        # reverse (upstream) connections in CSR format;
+        # upstream nodes are ordered by their position in fromids
+        has_toid = self.toindex >= 0
+        upstream_nodes = np.flatnonzero(has_toid)
+        upstream_of = self.toindex[has_toid]
+        order = np.lexsort((self.position[upstream_nodes], upstream_of))
+        self.upstream_indices = upstream_nodes[order]
+        counts = np.bincount(upstream_of, minlength=nnodes)
+        self.upstream_offsets = np.zeros(nnodes + 1, dtype=np.int64)
+        self.upstream_offsets[1:] = np.cumsum(counts)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        i = np.searchsorted(self.ids, id)
+        return bool(i < len(self.ids) and self.ids[i] == id)
+
+    @classmethod
+    def from_dict(cls, routing, outlet=0):
+        """Create a RoutingGraph from a dictionary of
+        {fromid: toid} connections."""
+        return cls(list(routing.keys()), list(routing.values()),
+                   outlet=outlet)
+
+    @property
+    def toids(self):
+        """Downstream connection for each node in :attr:`RoutingGraph.ids`
+        (the outlet value for outlets)."""
+        toids = self.ids[self.toindex]
+        # avoid casting problems if ids are strings and outlet is an int
+        if toids.dtype.kind in 'US':
+            toids = toids.astype(object)
+        toids[self.toindex < 0] = self.outlet
+        return toids
+
+    @property
+    def outlets(self):
+        """Index positions of nodes with no downstream connection,
+        in the order they were listed."""
+        outlets = np.flatnonzero(self.toindex < 0)
+        return outlets[np.argsort(self.position[outlets], kind='stable')]
+
+    def get_index(self, ids):
+        """Get the node index (position in :attr:`RoutingGraph.ids`)
+        for one or more ids.
+
+        Raises
+        ------
+        KeyError
+            If any of the ids aren't in the graph.
+        """
+        scalar = np.isscalar(ids)
+        ids = np.atleast_1d(np.array(ids))
+        if len(ids) == 0:
+            return np.array([], dtype=np.int64)
+        if len(self.ids) == 0:
+            raise KeyError("ids not in routing graph: {}".format(ids))
+        index = np.searchsorted(self.ids, ids)
+        index[index == len(self.ids)] = 0
+        valid = self.ids[index] == ids
+        if not np.all(valid):
+            raise KeyError("ids not in routing graph: {}".format(ids[~valid]))
+        if scalar:
+            return int(index[0])
+        return index
+
+    def downstream(self, id):
+        """Get the downstream connection (toid) for id."""
+        i = self.toindex[self.get_index(id)]
+        return self.ids[i] if i >= 0 else self.outlet
+
+    def upstream_index(self, index):
+        """Get the index positions of nodes immediately upstream
+        of the nodes at positions index, as a single flat array
+        (grouped in the order of index)."""
+        index = np.atleast_1d(index)
+        starts = self.upstream_offsets[index]
+        counts = self.upstream_offsets[index + 1] - starts
+        total = counts.sum()
+        # positions in upstream_indices for each node in index,
+        # concatenated into a single flat array
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return self.upstream_indices[offsets + np.arange(total)]
+
+    def upstream(self, id):
+        """Get the ids immediately upstream of id (as a 1D array).
+        If id is the outlet value, ids that route to an outlet
+        are returned."""
+        if np.isscalar(id) and id == self.outlet and id not in self:
+            return self.ids[self.outlets]
+        return self.ids[self.upstream_index(self.get_index(id))]
+
+    def get_all_upstream(self, id):
+        """Get all ids upstream of id (as a 1D array),
+        by performing a breadth-first search of the upstream connections.
+        If id is the outlet value, all ids in the graph are returned.
+        """
+        if np.isscalar(id) and id == self.outlet and id not in self:
+            return self.ids.copy()
+        visited = np.zeros(len(self.ids), dtype=bool)
+        index = self.get_index(id)
+        frontier = self.upstream_index(index)
+        while len(frontier) > 0:
+            # skip nodes that have already been visited
+            # (only possible if routing is circular)
+            frontier = frontier[~visited[frontier]]
+            visited[frontier] = True
+            frontier = self.upstream_index(frontier)
+        return self.ids[visited]
+
+    def get_levels(self, start=None):
+        """Get the node indices at each level of the network,
+        going upstream from the outlets (level 0 routes to an outlet;
+        nodes in level 1 route to a node in level 0, etc.). Within each level,
+        nodes are grouped by their downstream connection, in the order of the
+        previous level. Nodes that don't route to an outlet
+        (because of circular routing) aren't included.
+
+        Parameters
+        ----------
+        start : 1D array of ints, optional
+            Node indices for level 0. By default, None,
+            in which case all of the :attr:`outlets` are used.
+
+        Returns
+        -------
+        levels : list of 1D arrays
+        """
+        levels = []
+        nextupsegs = self.outlets if start is None else np.asarray(start, dtype=np.int64)
+        for i in range(len(self.ids)):
+            if len(nextupsegs) == 0:
+                break
+            levels.append(nextupsegs)
+            nextupsegs = self.upstream_index(nextupsegs)
+        return levels
+
+    def get_topological_order(self, upstream_first=True):
+        """Get the node indices in topological order, so that each node
+        is listed before (upstream_first=True) or after its downstream connection.
+        Nodes that don't route to an outlet aren't included.
+        """
+        levels = self.get_levels()
+        if len(levels) == 0:
+            return np.array([], dtype=np.int64)
+        order = np.concatenate(levels)
+        if upstream_first:
+            return order[::-1]
+        return order
+
+    def accumulate(self, values, func=np.add):
+        """Accumulate values going downstream through the network,
+        in a single pass from the headwaters to the outlets,
+        so that the result at each node combines its value
+        with the results for all nodes upstream (e.g. an arbolate sum
+        with np.add, or a running minimum with np.minimum).
+
+        Parameters
+        ----------
+        values : 1D array
+            Value for each node in :attr:`RoutingGraph.ids`.
+        func : numpy.ufunc
+            Binary ufunc used to combine values. By default, np.add.
+
+        Returns
+        -------
+        accumulated : 1D array
+            Nodes with circular routing (that don't route to an outlet)
+            only include their own value.
+        """
+        accumulated = np.array(values, dtype=float)
+        for level in self.get_levels()[:0:-1]:
+            func.at(accumulated, self.toindex[level], accumulated[level])
+        return accumulated
+
+    def get_cycles(self):
+        """Find any circular routing in the network.
+
+        Nodes that aren't reached going upstream from the outlets
+        either are part of a cycle or route to one. Those that only route
+        to a cycle are peeled off by repeatedly removing the nodes with
+        no upstream connections (Kahn's algorithm), leaving only the cycles.
+
+        Returns
+        -------
+        cycles : list of 1D arrays
+            Node indices in each cycle, in routing order, starting
+            with the lowest index. An empty list if there are no cycles.
+        """
+        remaining = np.ones(len(self.ids), dtype=bool)
+        for level in self.get_levels():
+            remaining[level] = False
+        if not np.any(remaining):
+            return []
+
+        nodes = np.flatnonzero(remaining)
+        n_upstream = np.bincount(self.toindex[nodes], minlength=len(self.ids))
+        headwaters = nodes[n_upstream[nodes] == 0]
+        while len(headwaters) > 0:
+            remaining[headwaters] = False
+            toindex = self.toindex[headwaters]
+            np.subtract.at(n_upstream, toindex, 1)
+            toindex = np.unique(toindex)
+            headwaters = toindex[n_upstream[toindex] == 0]
+
+        cycles = []
+        for i in np.flatnonzero(remaining):
+            if not remaining[i]:
+                continue
+            cycle = [i]
+            j = self.toindex[i]
+            while j != i:
+                cycle.append(j)
+                j = self.toindex[j]
+            remaining[cycle] = False
+            cycles.append(np.array(cycle, dtype=np.int64))
+        return cycles
+
+    def get_next_in_subset(self, subset):
+        """Label every node in the network with the nearest node
+        at or downstream of it that is in a subset, in a single pass
+        over the network in topological order.
+
+        Parameters
+        ----------
+        subset : sequence
+            Node ids. Values that aren't in the graph are ignored.
+
+        Returns
+        -------
+        next_in_subset : 1D array of ints
+            Index of the first node in subset along the path from each node
+            (including the node itself); -1 where the path reaches an outlet
+            without encountering a node in subset.
+        """
+        subset = np.atleast_1d(np.array(subset))
+        in_subset = np.zeros(len(self.ids), dtype=bool)
+        subset = subset[np.isin(subset, self.ids)]
+        in_subset[np.searchsorted(self.ids, subset)] = True
+
+        next_in_subset = np.full(len(self.ids), -1, dtype=np.int64)
+        labeled = np.zeros(len(self.ids), dtype=bool)
+        # going upstream from the outlets, each node inherits
+        # the label of its downstream connection (already labeled)
+        for level in self.get_levels():
+            toindex = self.toindex[level]
+            downstream_label = np.where(toindex >= 0, next_in_subset[toindex], -1)
+            next_in_subset[level] = np.where(in_subset[level], level, downstream_label)
+            labeled[level] = True
+
+        # nodes with circular routing
+        for i in np.flatnonzero(~labeled):
+            j = i
+            for _ in range(len(self.ids)):
+                if in_subset[j]:
+                    next_in_subset[i] = j
+                    break
+                j = self.toindex[j]
+                if j < 0:
+                    break
+        return next_in_subset
+
+    def find_path(self, start, end=None, limit=None):
+        """Get a path through the routing network,
+        from a node to an outlet. Same as :func:`sfrmaker.routing.find_path`.
+
+        Parameters
+        ----------
+        start : int
+            Starting node id
+        end : int
+            Ending node id. By default, None, in which case
+            the path is traced to the outlet.
+        limit : int
+            Option to limit the length of the path returned.
+            By default, None (path is traced to the end routing number).
+
+        Returns
+        -------
+        path : list
+            List of ids along the routing path, including the start,
+            and end (or outlet value).
+        """
+        if end is None:
+            end = self.outlet
+        if limit is None:
+            limit = len(self.ids)
+        ids = self.ids.tolist()
+        toindex = self.toindex
+        path = [start]
+        i = self.get_index(start)
+        for _ in range(limit):
+            i = toindex[i]
+            if i < 0:
+                path.append(self.outlet)
+                break
+            path.append(ids[i])
+            if ids[i] == end:
+                break
+        return path
+
+    def to_dict(self, listed_only=False):
+        """Return the graph as a dictionary of {fromid: toid} connections.
+
+        Parameters
+        ----------
+        listed_only : bool
+            If True, only include ids that were listed as fromids
+            when the graph was created, in the order that they were listed.
+            Otherwise, ids that only appear as toids are included as outlets,
+            and the ids are sorted. By default, False.
+        """
+        ids = self.ids.tolist()
+        toids = self.toids.tolist()
+        if listed_only:
+            listed = np.flatnonzero(self.listed)
+            listed = listed[np.argsort(self.position[listed])]
+            return {ids[i]: toids[i] for i in listed}
+        return dict(zip(ids, toids))
+
+    def reverse_dict(self):
+        """Return the upstream connections as a dictionary of
+        {toid: [fromid1, fromid2,...]} connections. Ids routing to an
+        outlet are listed under the outlet value.
+        """
+        ids = self.ids.tolist()
+        indices = self.upstream_indices.tolist()
+        offsets = self.upstream_offsets
+        has_upstream = np.flatnonzero(np.diff(offsets) > 0)
+        graph_r = {ids[i]: [ids[u] for u in indices[offsets[i]:offsets[i + 1]]]
+                   for i in has_upstream}
+        outlets = self.outlets
+        if len(outlets) > 0:
+            graph_r[self.outlet] = [ids[i] for i in outlets]
+        return graph_r
+
+
+class PathIndex(Mapping):
+    """Index of routing paths from each node in a routing network
+    to its outlet. Paths are generated on demand from the downstream
+    connections in a :class:`RoutingGraph`, instead of being stored
+    for every node. Can be used like a dictionary of paths
+    (e.g. ``paths[id]``), or through :meth:`PathIndex.iter_path`, which
+    allows the traversal to be stopped early.
+
+    The number of connections between each node and its outlet
+    (:attr:`PathIndex.depth`) is computed once, in a single pass over the
+    network in topological order. Ancestor tables for
+    :meth:`PathIndex.get_kth_downstream` queries (the node 1, 2, 4, 8,...
+    connections downstream of each node) are only built when needed.
+
+    Parameters
+    ----------
+    graph : :class:`RoutingGraph` instance
+
+    Examples
+    --------
+    >>> paths = PathIndex(RoutingGraph([1, 2, 3], [2, 4, 4]))
+    >>> paths[1]
+    [1, 2, 4, 0]
+    >>> paths.get_kth_downstream(1, 2)
+    4
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.outlet = graph.outlet
+        self._ancestors = None
+
+        # number of connections between each node and its outlet
+        # (-1 for any nodes that don't route to an outlet)
+        self.depth = np.full(len(graph), -1, dtype=np.int64)
+        for i, level in enumerate(graph.get_levels()):
+            self.depth[level] = i
+
+    def __getitem__(self, id):
+        return list(self.iter_path(id))
+
+    def __iter__(self):
+        # ids listed in the routing, in the order they were listed
+        graph = self.graph
+        listed = np.flatnonzero(graph.listed)
+        listed = listed[np.argsort(graph.position[listed], kind='stable')]
+        return iter(graph.ids[listed].tolist())
+
+    def __len__(self):
+        return int(self.graph.listed.sum())
+
+    def iter_path(self, start):
+        """Generate the ids along the routing path from start to its outlet,
+        including start and the outlet value (as in :func:`find_path`).
+        """
+        ids = self.graph.ids
+        toindex = self.graph.toindex
+        i = self.graph.get_index(start)
+        # yield Python scalars (instead of numpy scalars), as in find_path
+        yield ids[i].item()
+        # limit the number of steps in case the routing is circular
+        for _ in range(len(ids)):
+            i = toindex[i]
+            if i < 0:
+                yield self.outlet
+                return
+            yield ids[i].item()
+
+    def _get_ancestors(self, nlevels):
+        """Get tables of the node indices 2**j connections downstream
+        of each node, for j in range(nlevels); -1 where the path
+        reaches an outlet first."""
+        if self._ancestors is None:
+            self._ancestors = [self.graph.toindex]
+        while len(self._ancestors) < nlevels:
+            previous = self._ancestors[-1]
+            self._ancestors.append(np.where(previous >= 0,
+                                            previous[previous], -1))
+        return self._ancestors
+
+    def get_kth_downstream(self, ids, k):
+        """Get the id k connections downstream of one or more ids,
+        or the outlet value if the path reaches an outlet in less than
+        k connections.
+
+        Parameters
+        ----------
+        ids : scalar or sequence
+            Starting ids.
+        k : int or sequence of ints
+            Number of connections downstream.
+
+        Returns
+        -------
+        kth_downstream : scalar or 1D array
+        """
+        scalar = np.isscalar(ids)
+        index = np.atleast_1d(self.graph.get_index(ids))
+        k = np.broadcast_to(np.atleast_1d(k), index.shape)
+        if np.any(k < 0):
+            raise ValueError("k must be >= 0")
+        nlevels = int(k.max()).bit_length() if len(k) > 0 else 0
+        for j, ancestors in enumerate(self._get_ancestors(nlevels)[:nlevels]):
+            step = ((k >> j) & 1).astype(bool) & (index >= 0)
+            index[step] = ancestors[index[step]]
+        result = self.graph.ids[index].astype(object)
+        result[index < 0] = self.outlet
+        if scalar:
+            return result[0]
+        return result
+
+
+class SubtreeIndex:
+    """Index of the upstream subtree of each node in a routing network,
+    based on a preorder (depth-first) numbering of the reversed
+    routing tree, in which each subtree occupies a contiguous
+    interval. Queries of whether one node is upstream of another,
+    or of all nodes upstream of a node, can then be answered
+    with an interval comparison or an array slice, instead of
+    a breadth-first search.
+
+    Parameters
+    ----------
+    graph : :class:`RoutingGraph` instance
+
+    Attributes
+    ----------
+    order : 1D array of ints
+        Node indices in preorder. The subtree of node i
+        (i and everything upstream of it) is
+        ``order[start[i]:end[i]]``.
+    start : 1D array of ints
+        Preorder position of each node (-1 for any nodes
+        that don't route to an outlet).
+    end : 1D array of ints
+        Position after the last node in each subtree.
+
+    Examples
+    --------
+    >>> index = SubtreeIndex(RoutingGraph([1, 2, 3], [2, 4, 4]))
+    >>> sorted(index.get_upstream(4).tolist())
+    [1, 2, 3]
+    >>> index.is_upstream(1, 4)
+    True
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        nnodes = len(graph)
+        levels = graph.get_levels()
+
+        # size of each subtree, accumulated from the headwaters down
+        size = np.zeros(nnodes, dtype=np.int64)
+        for level in levels:
+            size[level] = 1
+        for level in levels[:0:-1]:
+            np.add.at(size, graph.toindex[level], size[level])
+
+        # the preorder position of each node is the position of its
+        # downstream node, plus one, plus the sizes of any siblings
+        # ahead of it; each level is grouped by downstream node
+        # (in upstream_index), in the order of the previous level
+        self.start = np.full(nnodes, -1, dtype=np.int64)
+        for i, level in enumerate(levels):
+            sizes = size[level]
+            offsets = np.cumsum(sizes) - sizes
+            if i == 0:
+                self.start[level] = offsets
+                continue
+            toindex = graph.toindex[level]
+            is_first = np.ones(len(level), dtype=bool)
+            is_first[1:] = toindex[1:] != toindex[:-1]
+            group_start = np.maximum.accumulate(np.where(is_first, offsets, 0))
+            self.start[level] = self.start[toindex] + 1 + offsets - group_start
+        self.end = np.where(self.start >= 0, self.start + size, -1)
+        in_tree = self.start >= 0
+        self.order = np.empty(in_tree.sum(), dtype=np.int64)
+        self.order[self.start[in_tree]] = np.flatnonzero(in_tree)
+
+    def is_upstream(self, ids, downstream_ids):
+        """Whether ids are upstream of downstream_ids (elementwise;
+        ids aren't considered to be upstream of themselves).
+
+        Returns
+        -------
+        is_upstream : bool or 1D array of bools
+        """
+        scalar = np.isscalar(ids) and np.isscalar(downstream_ids)
+        start = self.start[self.graph.get_index(ids)]
+        i = self.graph.get_index(downstream_ids)
+        result = (start > self.start[i]) & (start < self.end[i]) & \
+                 (self.start[i] >= 0)
+        if scalar:
+            return bool(result)
+        return result
+
+    def get_upstream_index(self, index, include_self=False):
+        """Get the node indices upstream of the node at index."""
+        if self.start[index] < 0:
+            return np.array([], dtype=np.int64)
+        start = self.start[index] + (0 if include_self else 1)
+        return self.order[start:self.end[index]]
+
+    def get_upstream(self, id, include_self=False):
+        """Get all ids upstream of id (and id, if include_self=True)."""
+        index = self.get_upstream_index(self.graph.get_index(id),
+                                        include_self=include_self)
+        return self.graph.ids[index]
+
+    def get_previous_in_subset(self, subset, ids):
+        """Get the first ids upstream of (or equal to) ids that are in
+        subset, without going past any ids in subset.
+        Same as :func:`sfrmaker.routing.get_previous_ids_in_subset`.
+
+        Parameters
+        ----------
+        subset : sequence
+            Node ids. Values that aren't in the graph are ignored.
+        ids : scalar or sequence
+            Node ids to start from.
+
+        Returns
+        -------
+        previous_ids : set
+        """
+        # nearest subset member strictly downstream of each node
+        next_in_subset = self.graph.get_next_in_subset(subset)
+        toindex = self.graph.toindex
+        downstream_member = np.where(toindex >= 0, next_in_subset[toindex], -1)
+        in_subset = next_in_subset == np.arange(len(self.graph))
+
+        previous = set()
+        for i in np.atleast_1d(self.graph.get_index(ids)):
+            upstream = self.get_upstream_index(i, include_self=True)
+            upstream = upstream[in_subset[upstream]]
+            # exclude members with another member between them and i
+            member_below = downstream_member[upstream]
+            below_start = self.start[member_below]
+            in_between = (member_below >= 0) & \
+                         (below_start >= self.start[i]) & (below_start < self.end[i])
+            previous.update(self.graph.ids[upstream[~in_between]].tolist())
+        return previous
+
+
 def renumber_segments(nseg, outseg):
     """Renumber segments so that segment numbering is continuous, starts at 1, and always increases
         in the downstream direction. Experience suggests that this can substantially speed
@@ -239,39 +900,39 @@ def renumber_segments(nseg, outseg):
     r : dict
         Dictionary mapping old segment numbers (keys) to new segment numbers (values). r only
         contains entries for number that were remapped.
+
+    Notes
+    -----
+    Segments are numbered in a single breadth-first traversal of the
+    upstream connections, starting at the outlets (including segments
+    routing to lakes), so that the total work is proportional to the
+    number of segments. Negative outsegs (lakes) are left unchanged.
     """
-    if not isinstance(nseg, np.ndarray):
-        nseg = np.array(nseg)
-    if not isinstance(outseg, np.ndarray):
-        outseg = np.array(outseg)
-
-    def reassign_upsegs(r, nexts, upsegs):
-        nextupsegs = []
-        for u in upsegs:
-            r[u] = nexts if u > 0 else u  # handle lakes
-            nexts -= 1
-            nextupsegs += list(nseg[outseg == u])
-        return r, nexts, nextupsegs
+    nseg = np.atleast_1d(np.squeeze(np.array(nseg)))
+    outseg = np.atleast_1d(np.squeeze(np.array(outseg)))
 
     print('enforcing best segment numbering...')
     # enforce that all outsegs not listed in nseg are converted to 0
     # but leave lakes alone
     r = {0: 0}
-    r.update({o: 0 for o in outseg if o > 0 and o not in nseg})
-    outseg = np.array([o if o in nseg or o < 0 else 0 for o in outseg])
-
-    # if reach data are supplied, segment/outseg pairs may be listed more than once
-    if len(nseg) != len(np.unique(nseg)):
-        d = dict(zip(nseg, outseg))
-        nseg, outseg = np.array(list(d.keys())), np.array(list(d.values()))
-    ns = len(nseg)
-
-    nexts = ns
-    nextupsegs = nseg[outseg == 0]
-    for i in range(ns):
-        r, nexts, nextupsegs = reassign_upsegs(r, nexts, nextupsegs)
-        if len(nextupsegs) == 0:
-            break
+    not_listed = (outseg > 0) & ~np.isin(outseg, nseg)
+    r.update({o: 0 for o in outseg[not_listed]})
+    r.update({o: o for o in outseg[outseg < 0]})
+    outseg = np.where(not_listed, 0, outseg)
+
+    # segments that route to lakes are also
+    # starting points for the numbering
+    # (if reach data are supplied, segment/outseg pairs may be listed more than once;
+    # these are consolidated by RoutingGraph)
+    graph = RoutingGraph(nseg, np.where(outseg < 0, 0, outseg))
+    ns = len(graph)
+
+    # number the segments one level at a time in the upstream direction,
+    # starting at the outlets; segments at each level are listed in the
+    # order of their downstream connections at the previous level
+    order = graph.get_topological_order(upstream_first=False)
+    new_numbers = ns - np.arange(len(order))
+    r.update(zip(graph.ids[order], new_numbers.tolist()))
     return r
 
 
@@ -295,19 +956,21 @@ def get_next_id_in_subset(subset, routing, ids):
     ids : revised list of first values downstream of the values in ids (determined by routing)
         that are also in subset.
     """
-    subset = set(subset).union({0})
-    routing = routing.copy()
+    subset = np.array(list(set(subset).union({0})))
     if np.isscalar(ids):
         ids = [ids]
-    paths = [find_path(routing, i) for i in ids]
-    new_ids = []
-    for p in paths:
-        for id in p:
-            if id in subset:
-                new_ids.append(id)
-                break
-    assert len(new_ids) == len(ids)
-    return new_ids
+    ids = np.array(list(ids))
+    graph = RoutingGraph.from_dict(routing)
+    next_in_subset = graph.get_next_in_subset(subset)
+
+    # ids in subset that aren't in the routing map to themselves
+    new_ids = ids.astype(object)
+    lookup = np.isin(ids, graph.ids) | ~np.isin(ids, subset)
+    next_index = next_in_subset[graph.get_index(ids[lookup])]
+    next_ids = graph.ids[next_index].astype(object)
+    next_ids[next_index < 0] = 0
+    new_ids[lookup] = next_ids
+    return new_ids.tolist()
 
 
 def get_previous_ids_in_subset(subset, routing, ids):
@@ -330,23 +993,8 @@ def get_previous_ids_in_subset(subset, routing, ids):
     ids : revised list of first values upstream of the values in ids (determined by routing)
         that are also in subset.
     """
-    subset = set(subset).union({0})
-    routing = routing.copy()
-    if np.isscalar(ids):
-        ids = [ids]
-    else:
-        ids = ids.copy()
-    graph_r = make_reverse_graph(routing)
-
-    new_ids = set()
-    nextupsegs = ids
-    for i in range(len(graph_r)):
-        for upseg in nextupsegs:
-            if upseg in subset:
-                new_ids.add(upseg)
-        if len(new_ids) == len(nextupsegs):
-            break
-        nextupsegs = set(nextupsegs).difference(new_ids)
-        if len(nextupsegs) > 0:
-            nextupsegs = get_nextupsegs(graph_r, nextupsegs)
-    return new_ids
+    subset = np.array(list(set(subset)))
+    if not np.isscalar(ids):
+        ids = np.array(list(ids))
+    index = SubtreeIndex(RoutingGraph.from_dict(routing))
+    return index.get_previous_in_subset(subset, ids)
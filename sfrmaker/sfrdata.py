@@ -6,14 +6,17 @@ import yaml
 import numpy as np
 import pandas as pd
 import rasterio
-from rasterstats import zonal_stats
 from shapely.geometry import LineString
 from gisutils import df2shp, get_authority_crs
-from sfrmaker.routing import find_path, renumber_segments
+from sfrmaker.routing import renumber_segments, RoutingGraph, PathIndex, \
+    SubtreeIndex
 from sfrmaker.checks import valid_rnos, valid_nsegs, rno_nseg_routing_consistent
 from sfrmaker.elevations import smooth_elevations
 from sfrmaker.flows import add_to_perioddata, add_to_segment_data
-from sfrmaker.gis import export_reach_data, project
+from sfrmaker.gis import export_reach_data, project, get_buffers, get_centroids
+from sfrmaker.rasters import (cell_zonal_stats, tiled_zonal_stats, line_point_stats,
+                              get_geometry_hashes, ZonalStatsCache,
+                              get_raster_tiles, raster_mosaic)
 from sfrmaker.observations import write_gage_package, write_mf6_sfr_obsfile, add_observations
 from sfrmaker.units import convert_length_units, itmuni_values, lenuni_values
 from sfrmaker.utils import get_sfr_package_format, get_input_arguments, assign_layers, update
@@ -160,8 +163,12 @@ class SFRData(DataPackage):
         # routing
         self._segment_routing = None  # dictionary of routing connections
         self._rno_routing = None  # dictionary of rno routing connections
+        self._segment_routing_graph = None  # RoutingGraph of segment connections
+        self._rno_routing_graph = None  # RoutingGraph of rno connections
         self._paths = None  # routing sequence from each segment to outlet
         self._reach_paths = None  # routing sequence from each reach number to outlet
+        self._subtree_index = None  # segments upstream of each segment
+        self._reach_subtree_index = None  # reaches upstream of each reach
 
         if not self._valid_nsegs(increasing=enforce_increasing_nsegs):
             self.reset_segments()
@@ -244,14 +251,21 @@ class SFRData(DataPackage):
     def segment_routing(self):
         if self._segment_routing is None or self._routing_changed():
             sd = self.segment_data.groupby('per').get_group(0)
-            graph = dict(
-                zip(sd.nseg, sd.outseg))
-            outlets = set(graph.values()).difference(
-                set(graph.keys()))  # including lakes
-            graph.update({o: 0 for o in outlets})
+            # outsegs that aren't listed as segments (including lakes)
+            # are included as outlets
+            self._segment_routing_graph = RoutingGraph(sd.nseg, sd.outseg)
+            graph = self._segment_routing_graph.to_dict()
+            graph[0] = 0
             self._routing = graph
         return self._routing
 
+    @property
+    def segment_routing_graph(self):
+        """:class:`~sfrmaker.routing.RoutingGraph` representation
+        of :attr:`SFRData.segment_routing`."""
+        self.segment_routing
+        return self._segment_routing_graph
+
     @property
     def rno_routing(self):
         if self._rno_routing is None or self._routing_changed():
@@ -260,13 +274,40 @@ class SFRData(DataPackage):
             # (ireach values also checked and fixed if necesseary)
             self.set_outreaches()
             rd = self.reach_data
-            graph = dict(zip(rd.rno, rd.outreach))
-            outlets = set(graph.values()).difference(
-                set(graph.keys()))  # including lakes
-            graph.update({o: 0 for o in outlets})
+            # outreaches that aren't listed as reaches (including lakes)
+            # are included as outlets
+            self._rno_routing_graph = RoutingGraph(rd.rno, rd.outreach)
+            graph = self._rno_routing_graph.to_dict()
+            graph[0] = 0
             self._rno_routing = graph
         return self._rno_routing
 
+    @property
+    def rno_routing_graph(self):
+        """:class:`~sfrmaker.routing.RoutingGraph` representation
+        of :attr:`SFRData.rno_routing`."""
+        self.rno_routing
+        return self._rno_routing_graph
+
+    @property
+    def subtree_index(self):
+        """:class:`~sfrmaker.routing.SubtreeIndex` of the segments
+        upstream of each segment. Rebuilt when the routing changes."""
+        graph = self.segment_routing_graph
+        if self._subtree_index is None or self._subtree_index.graph is not graph:
+            self._subtree_index = SubtreeIndex(graph)
+        return self._subtree_index
+
+    @property
+    def reach_subtree_index(self):
+        """:class:`~sfrmaker.routing.SubtreeIndex` of the reaches
+        upstream of each reach. Rebuilt when the routing changes."""
+        graph = self.rno_routing_graph
+        if self._reach_subtree_index is None or \
+                self._reach_subtree_index.graph is not graph:
+            self._reach_subtree_index = SubtreeIndex(graph)
+        return self._reach_subtree_index
+
     @property
     def modflow_sfr2(self):
         """A `flopy.modflow.mfsfr2.ModflowSfr2` represenation of the sfr dataset."""
@@ -431,9 +472,9 @@ class SFRData(DataPackage):
 
     @property
     def reach_paths(self):
-        """Dict listing routing sequence for each segment
+        """Dict listing routing sequence for each reach
         in SFR network."""
-        if self._paths is None:
+        if self._reach_paths is None:
             self._set_reach_paths()
             return self._reach_paths
         if self._routing_changed():
@@ -441,12 +482,10 @@ class SFRData(DataPackage):
         return self._reach_paths
 
     def _set_paths(self):
-        routing = self.segment_routing
-        self._paths = {seg: find_path(routing, seg) for seg in routing.keys()}
+        self._paths = PathIndex(self.segment_routing_graph)
 
     def _set_reach_paths(self):
-        routing = self.rno_routing
-        self._reach_paths = {rno: find_path(routing, rno) for rno in routing.keys()}
+        self._reach_paths = PathIndex(self.rno_routing_graph)
 
     def _reset_routing(self):
         self.reset_reaches()
@@ -868,25 +907,60 @@ class SFRData(DataPackage):
     def sample_reach_elevations(self, dem,
                                 method='buffers',
                                 buffer_distance=100,
-                                smooth=True
+                                smooth=True,
+                                n_workers=None,
+                                cache_dir=None,
+                                stat='min',
+                                point_spacing=None
                                 ):
         """Computes zonal statistics on a raster for SFR reaches, using
-        either buffer polygons around the reach LineStrings, or the model
-        grid cell polygons containing each reach.
+        either buffer polygons around the reach LineStrings, the model
+        grid cell polygons containing each reach, or points along the
+        reach LineStrings. For structured grids with
+        known cell spacing, the 'cell polygons' method labels each DEM pixel
+        with the node number of the cell containing it instead of making
+        polygons (see :func:`sfrmaker.rasters.cell_zonal_stats`),
+        so that each cell is only sampled once.
 
         Parameters
         ----------
-        dem : path to valid raster dataset
+        dem : path to valid raster dataset, list of raster tiles, or folder of raster tiles
             Must be in same Coordinate Reference System as model grid.
-        method : str; 'buffers' or 'cell polygons'
+            Multiple DEM tiles are sampled through a virtual mosaic
+            (see :func:`sfrmaker.rasters.raster_mosaic`), so that only
+            the tiles overlapping each reach are read. The mosaic (VRT) file
+            is kept in ``cache_dir``, if specified; otherwise it is
+            written to a temporary folder.
+        method : str; 'buffers', 'cell polygons' or 'points'
             If 'buffers', buffers (with flat caps; cap_style=2 in LineString.buffer())
             will be created around the reach LineStrings (geometry column in reach_data).
+            If 'points', the DEM is sampled at points spaced ``point_spacing``
+            apart along the reach LineStrings (see
+            :func:`sfrmaker.rasters.line_point_stats`). This is much faster than
+            buffers when the DEM resolution is much finer than the reach lengths.
         buffer_distance : float
             Buffer distance to apply around reach LineStrings, in crs_units.
         smooth : bool
             Run sfrmaker.elevations.smooth_elevations on sampled elevations
             to ensure that they decrease monotonically in the downstream direction
             (default=True).
+        n_workers : int, optional
+            Number of processes for running zonal statistics on the
+            features in parallel, one DEM tile at a time
+            (see :func:`sfrmaker.rasters.tiled_zonal_stats`).
+            By default, None (no parallelization).
+        cache_dir : str, optional
+            Folder for caching the sampled elevations on disk
+            (see :class:`sfrmaker.rasters.ZonalStatsCache`). Elevations for
+            reaches with the same geometry and sampling settings, from an
+            unchanged DEM, are reused instead of being sampled again.
+            By default, None (no caching).
+        stat : str
+            Statistic of the sampled DEM values to use for each reach,
+            for example 'min', 'mean' or 'percentile_10'. By default, 'min'.
+        point_spacing : float, optional
+            Spacing between sampled points for the 'points' method,
+            in crs_units. By default, None (the DEM resolution).
 
         Returns
         -------
@@ -894,7 +968,8 @@ class SFRData(DataPackage):
         """
 
         # get the CRS and pixel size for the DEM
-        with rasterio.open(dem) as src:
+        # (from the first tile, if there are multiple DEM tiles)
+        with rasterio.open(get_raster_tiles(dem)[0]) as src:
             raster_crs = get_authority_crs(src.crs)
 
             # make sure buffer is large enough for DEM pixel size
@@ -905,27 +980,87 @@ class SFRData(DataPackage):
         if method == 'buffers':
             assert isinstance(self.reach_data.geometry[0], LineString), \
                 "Need LineString geometries in reach_data.geometry column to use buffer option."
-            features = [g.buffer(buffer_distance) for g in self.reach_data.geometry]
             txt = 'buffered LineStrings'
+        elif method == 'points':
+            assert isinstance(self.reach_data.geometry[0], LineString), \
+                "Need LineString geometries in reach_data.geometry column to use points option."
+            txt = 'points along LineStrings'
         elif method == 'cell polygons':
             assert self.grid is not None, \
                 "Need an attached sfrmaker.Grid instance to use cell polygons option."
-            features = self.grid.df.loc[self.reach_data.node, 'geometry'].tolist()
             txt = method
+        else:
+            raise ValueError('Unrecognized method: {}'.format(method))
+
+        # function used to sample the DEM, and the settings that affect the results
+        settings = {}
+        if method == 'points':
+            engine = 'line_point_stats'
+            settings['point_spacing'] = point_spacing
+        elif method == 'cell polygons' and \
+                isinstance(self.grid, sfrmaker.grid.StructuredGrid) and \
+                self.grid.edges is not None:
+            engine = 'cell_zonal_stats'
+        else:
+            engine = 'tiled_zonal_stats'
+            if method == 'buffers':
+                settings['buffer_distance'] = buffer_distance
+
+        # reuse any cached elevations; only sample reaches that aren't in the cache
+        elevs = np.full(len(self.reach_data), np.nan)
+        to_sample = np.ones(len(self.reach_data), dtype=bool)
+        if cache_dir is not None:
+            if method == 'cell polygons':
+                geoms = self.grid.get_cell_polygons(self.reach_data.node.values)
+            else:
+                geoms = self.reach_data.geometry.values
+            keys = get_geometry_hashes(geoms)
+            cache = ZonalStatsCache(cache_dir, dem, stats=[stat], method=method,
+                                    engine=engine, crs=self.crs, **settings)
+            cached, found = cache.get(keys)
+            elevs[found] = cached.loc[found, stat].values
+            to_sample = ~found
+            print('reusing cached elevations for {:,d} of {:,d} reaches in {}'.format(
+                found.sum(), len(found), cache.filename))
 
-        # to_crs features if they're not in the same crs
-        if raster_crs != self.crs:
-            features = project(features,
-                               self.crs,
-                               raster_crs)
-
-        print('running rasterstats.zonal_stats on {}...'.format(txt))
         t0 = time.time()
-        results = zonal_stats(features,
-                              dem,
-                              stats='min')
-        elevs = [r['min'] for r in results]
+        if to_sample.any():
+            rd = self.reach_data.loc[to_sample]
+            # sample multiple DEM tiles through a virtual mosaic
+            with raster_mosaic(dem, out_dir=cache_dir) as dem_path:
+                if engine == 'cell_zonal_stats':
+                    print('sampling {} on {} by node...'.format(dem_path, txt))
+                    results = cell_zonal_stats(dem_path, self.grid, rd.node.values,
+                                               stats=stat, crs=self.crs)
+                    sampled = results.loc[rd.node.values, stat].values
+                elif engine == 'line_point_stats':
+                    print('sampling {} at {}...'.format(dem_path, txt))
+                    results = line_point_stats(dem_path, rd.geometry.values, stats=stat,
+                                               spacing=point_spacing, crs=self.crs)
+                    sampled = results[stat].values
+                else:
+                    if method == 'buffers':
+                        features = get_buffers(rd.geometry, buffer_distance).tolist()
+                    else:
+                        features = self.grid.get_cell_polygons(rd.node.values).tolist()
+
+                    # to_crs features if they're not in the same crs
+                    if raster_crs != self.crs:
+                        features = project(features,
+                                           self.crs,
+                                           raster_crs)
+
+                    print('sampling {} on {}...'.format(dem_path, txt))
+                    results = tiled_zonal_stats(features,
+                                                dem_path,
+                                                stats=stat,
+                                                n_workers=n_workers)
+                    sampled = np.array([r[stat] for r in results], dtype=float)
+            elevs[to_sample] = sampled
+            if cache_dir is not None:
+                cache.update(keys[to_sample], pd.DataFrame({stat: sampled}))
         print("finished in {:.2f}s\n".format(time.time() - t0))
+        elevs = [v if np.isfinite(v) else None for v in elevs]
 
         if all(v is None for v in elevs):
             raise Exception('No {} intersected with {}. Check projections.'.format(txt, dem))
@@ -951,14 +1086,15 @@ class SFRData(DataPackage):
 
         Parameters
         ----------
-        filename : path to valid raster dataset
+        filename : path to valid raster dataset, list of raster tiles, or folder of raster tiles
             Must be in same Coordinate Reference System as model grid.
         elevation_units : str
             Elevation units for DEM ('feet' or 'meters'). If None, units
             are assumed to be same as model (default).
-        method : str; 'buffers' or 'cell polygons'
+        method : str; 'buffers', 'cell polygons' or 'points'
             If 'buffers', buffers (with flat caps; cap_style=2 in LineString.buffer())
             will be created around the reach LineStrings (geometry column in reach_data).
+            See :meth:`SFRData.sample_reach_elevations`.
         kwargs : keyword arguments to sfrdata.sample_reach_elevations
 
         Returns
@@ -1382,7 +1518,12 @@ class SFRData(DataPackage):
         for rno in reaches:
             # skip reaches that have already been considered
             if rno not in to_riv_reaches:
-                to_riv_reaches.update(set(self.reach_paths[rno]))
+                # everything downstream of a reach that was already
+                # considered is already included
+                for downstream_rno in self.reach_paths.iter_path(rno):
+                    if downstream_rno in to_riv_reaches:
+                        break
+                    to_riv_reaches.add(downstream_rno)
 
         # subset the RIV reaches from reach_data;
         # populate RIV input
@@ -1681,11 +1822,10 @@ class SFRData(DataPackage):
             filename = self.package_name + '_sfr_routing.shp'
         rd = self.reach_data[['node', 'iseg', 'ireach', 'rno', 'outreach']].copy()
         rd.sort_values(by='rno', inplace=True)
-        cellgeoms = self.grid.df.loc[rd.node.values, 'geometry']
+        cellgeoms = self.grid.get_cell_polygons(rd.node.values)
 
         # get the cell centers for each reach
-        x0 = [g.centroid.x for g in cellgeoms]
-        y0 = [g.centroid.y for g in cellgeoms]
+        x0, y0 = get_centroids(cellgeoms).T
         loc = dict(zip(rd.rno, zip(x0, y0)))
 
         # make lines of the reach connections between cell centers
@@ -1,2 +1,31 @@
+import numpy as np
+from sfrmaker.elevations import smooth_elevations
 
 
+def test_smooth_elevations():
+    fromids = [1, 2, 3, 4, 5, 6]
+    toids = [3, 3, 4, 0, 0, 7]  # 6 doesn't route to an outlet
+    elevations = [10., 8., 9., 5., 3., 1.]
+    result = smooth_elevations(fromids, toids, elevations)
+    assert result == {1: 10., 2: 8., 3: 8., 4: 5., 5: 3., 6: 1.}
+
+    # start and end elevations
+    start_elevations = [12., 11., 7., 6., 4., 2.]
+    elevdn, elevup = smooth_elevations(fromids, toids, elevations,
+                                       start_elevations=start_elevations)
+    assert elevdn == {1: 7., 2: 7., 3: 6., 4: 5., 5: 3., 6: 1.}
+    assert elevup == {1: 12., 2: 11., 3: 7., 4: 6., 5: 4., 6: 2.}
+    for fromid, toid in zip(fromids, toids):
+        assert elevdn[fromid] <= elevup[fromid]
+        assert elevup.get(toid, -np.inf) <= elevdn[fromid]
+
+    # segments at a confluence are processed in the order they're listed;
+    # each segment end is limited by the outseg start elevation,
+    # as reduced by the segments before it
+    elevdn, elevup = smooth_elevations([1, 2, 3], [3, 3, 0], [10., 8., 7.],
+                                       start_elevations=[12., 11., 9.])
+    assert elevdn[1] == 9.
+    elevdn, elevup = smooth_elevations([2, 1, 3], [3, 3, 0], [8., 10., 7.],
+                                       start_elevations=[11., 12., 9.])
+    assert elevdn[1] == 8.
+    assert elevup[3] == 8.
@@ -1,8 +1,14 @@
 import os
 import numpy as np
 import pytest
+import pandas as pd
+from shapely.geometry import LineString, Point, box
+import gisutils
 from gisutils import get_authority_crs
-from sfrmaker.gis import get_bbox
+from sfrmaker.gis import (get_bbox, intersect, intersect_rtree,
+                          intersect_strtree, get_transformer, project,
+                          geometry_array, get_lengths, get_centroids,
+                          get_buffers, get_bounds)
 
 
 def test_get_bbox(project_root_path):
@@ -12,14 +18,52 @@ def test_get_bbox(project_root_path):
     assert np.allclose(bbox, (-90.62442575352304, 46.37890212020774, -90.46249896050521, 46.458360301848685))
 
 
-@pytest.mark.skip(reason='still working on faster intersection method')
-@pytest.fixture(scope='module')
-def intersected(tylerforks_sfrmaker_grid_from_flopy, tylerforks_lines_from_NHDPlus):
-    #results = intersect()
-    pass
+def test_intersect(tylerforks_sfrmaker_grid_from_flopy, tylerforks_lines_from_NHDPlus):
+    grid = tylerforks_sfrmaker_grid_from_flopy
+    lines = tylerforks_lines_from_NHDPlus
+    lines.to_crs(grid.crs)
+    grid_polygons = grid.df.geometry.tolist()
+    stream_linework = lines.df.geometry.tolist()
 
+    line_inds, cell_inds = intersect_strtree(grid_polygons, stream_linework,
+                                             index=grid.spatial_index)
+    assert line_inds.dtype == cell_inds.dtype == int
+    assert np.all(np.diff(line_inds) >= 0)
 
-@pytest.mark.skip(reason='still working on faster intersection method')
-def test_intersect():
-    from rtree import index
-    pass
\ No newline at end of file
+    # results should be the same as the brute force method
+    expected = intersect(grid_polygons, stream_linework)
+    results = intersect_rtree(grid_polygons, stream_linework)
+    assert len(results) == len(expected)
+    assert results == [list(inds) for inds in expected]
+    assert len(line_inds) == sum(len(inds) for inds in expected)
+
+
+def test_project():
+    geoms = [Point(-90, 45), LineString([(-90, 45), (-89.9, 45.1)]),
+             Point(-90, 45, 10)]
+    results = project(geoms, 4269, 5070)
+    expected = gisutils.project(geoms, 4269, 5070)
+    assert isinstance(results, list)
+    assert all(g1.equals_exact(g2, 1e-6) for g1, g2 in zip(results, expected))
+    assert results[2].has_z
+    # single geometries and coordinates
+    assert project(geoms[0], 4269, 5070).equals_exact(expected[0], 1e-6)
+    assert np.allclose(project((-90, 45), 4269, 5070), expected[0].coords[0])
+    x, y = project([(-90, 45), (-89.9, 45.1)], 4269, 5070)
+    assert np.allclose(list(zip(x, y)), expected[1].coords)
+    # transformers are reused for equivalent CRS
+    assert get_transformer(4269, 5070) is get_transformer('epsg:4269', get_authority_crs(5070))
+
+
+@pytest.mark.parametrize('container', [list, np.array, pd.Series])
+def test_vectorized_geometry_properties(container):
+    geoms = [LineString([(0, 0), (2, 0)]), box(0, 0, 2, 4), LineString()]
+    geoms = container(geoms) if container is not np.array \
+        else geometry_array(geoms)
+    assert np.allclose(get_lengths(geoms), [2, 12, 0])
+    assert np.allclose(get_centroids(geoms[:2]), [(1, 0), (1, 2)])
+    buffers = get_buffers(geoms[:2], 1, cap_style=2, join_style=2)
+    assert np.allclose([g.area for g in buffers], [4, 24])
+    bounds = get_bounds(geoms)
+    assert np.allclose(bounds[:2], [(0, 0, 2, 0), (0, 0, 2, 4)])
+    assert np.all(np.isnan(bounds[2]))
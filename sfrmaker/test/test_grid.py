@@ -2,12 +2,16 @@
 from rasterio import Affine
 
 import flopy
+import numpy as np
+import pandas as pd
 import pytest
+from shapely.geometry import Polygon, box
+from shapely.ops import unary_union
 import sfrmaker
 
 fm = flopy.modflow
-from ..gis import get_authority_crs
-from ..grid import StructuredGrid
+from ..gis import dissolve_cells, get_authority_crs
+from ..grid import Grid, StructuredGrid
 from ..units import convert_length_units
 
 
@@ -34,6 +38,75 @@ def test_structuredgrid_from_flopy_mg():
     assert grd2.crs == get_authority_crs(26715)
 
 
+@pytest.mark.parametrize('angrot', (0, 20))
+def test_structuredgrid_from_modelgrid_lazy(tylerforks_model_grid, tylerforks_active_area_shapefile,
+                                            angrot):
+    mg = tylerforks_model_grid
+    mg.set_coord_info(angrot=angrot)
+    grid = StructuredGrid.from_modelgrid(mg, active_area=tylerforks_active_area_shapefile)
+    lazy_grid = StructuredGrid.from_modelgrid(mg, active_area=tylerforks_active_area_shapefile,
+                                              lazy_polygons=True)
+    assert 'geometry' not in lazy_grid.df.columns
+    assert lazy_grid == grid
+    # polygons should be the same as the ones from flopy
+    i, j = np.indices((mg.nrow, mg.ncol))
+    expected = [Polygon(v) for v in mg._cell_vert_list(i.ravel(), j.ravel())]
+    assert all(g1.equals_exact(g2, 0) for g1, g2 in zip(grid.df.geometry, expected))
+    nodes = [0, 1000, grid.size - 1]
+    for polygons in grid.get_cell_polygons(nodes), lazy_grid.get_cell_polygons(nodes):
+        assert all(g1.equals_exact(expected[n], 0) for g1, n in zip(polygons, nodes))
+
+
+@pytest.mark.parametrize('angrot', (0, 20))
+def test_structuredgrid_from_modelgrid_lazy_nonuniform(angrot, monkeypatch):
+    delr = np.array([50.] * 10 + [100.] * 10 + [25.] * 20)
+    delc = np.array([100.] * 10 + [40.] * 25)
+    mg = flopy.discretization.StructuredGrid(delr=delr, delc=delc,
+                                             xoff=682688, yoff=5139052, angrot=angrot,
+                                             proj4='epsg:26715')
+    # irregular active area with a hole, extending past the edge of the grid
+    x0, y0 = mg.xcellcenters.mean(), mg.ycellcenters.mean()
+    theta = np.linspace(0, 2 * np.pi, 50, endpoint=False)
+    radius = 700 + 250 * np.sin(5 * theta)
+    active_area = Polygon(np.column_stack([x0 + radius * np.cos(theta),
+                                           y0 + radius * np.sin(theta)]),
+                          [box(x0 - 120, y0 - 80, x0 + 100, y0 + 150).exterior.coords])
+    grid = StructuredGrid.from_modelgrid(mg, active_area=active_area, crs=26715)
+    assert not grid.uniform
+    rasterized = grid.isfr.copy()
+    assert 0 < rasterized.sum() < rasterized.size
+    # rasterized isfr should be the same as from intersecting the cell polygons,
+    # except for any cells that only have slivers of the active area
+    Grid._set_isfr_from_active_area(grid)
+    different = np.flatnonzero((rasterized != grid.isfr).ravel())
+    polygons = grid.get_cell_polygons(different)
+    assert all(p.intersection(active_area).area < 0.01 * p.area for p in polygons)
+
+    # the lazy grid shouldn't make any cell polygons
+    def get_cell_polygons(self, nodes=None):
+        raise AssertionError('cell polygons were made')
+    monkeypatch.setattr(StructuredGrid, 'get_cell_polygons', get_cell_polygons)
+    lazy_grid = StructuredGrid.from_modelgrid(mg, active_area=active_area, crs=26715,
+                                              lazy_polygons=True)
+    assert np.array_equal(lazy_grid.isfr, rasterized)
+
+
+@pytest.mark.parametrize('angrot', (0, 20))
+def test_set_isfr_from_active_area(tylerforks_model_grid, tylerforks_active_area_shapefile,
+                                   angrot):
+    mg = tylerforks_model_grid
+    mg.set_coord_info(angrot=angrot)
+    grid = StructuredGrid.from_modelgrid(mg, active_area=tylerforks_active_area_shapefile)
+    assert grid.uniform
+    # cell centers should be in the right places
+    assert np.allclose(grid.transform * (0.5, 0.5), grid.df.geometry[0].centroid.coords[0])
+    # rasterized isfr should be the same as from intersecting the cell polygons
+    rasterized = grid.isfr.copy()
+    Grid._set_isfr_from_active_area(grid)
+    assert rasterized.sum() > 0
+    assert np.array_equal(rasterized, grid.isfr)
+
+
 def test_grid_epsg(shellmound_sfrmaker_grid):
     assert shellmound_sfrmaker_grid.crs.srs == 'EPSG:5070'
 
@@ -74,4 +147,30 @@ def test_unstructuredgrid_from_shapfile(tyler_forks_grid_shapefile,
                                         tylerforks_sfrmaker_grid_from_flopy):
     # TODO: test creating unstructured grid from same shapefile
     # with no row or column information passed
-    pass
\ No newline at end of file
+    pass
+
+
+def test_unstructuredgrid_active_area_from_isfr():
+    nrow = ncol = 30
+    i, j = np.indices((nrow, ncol))
+    df = pd.DataFrame({'node': np.arange(nrow * ncol),
+                       'geometry': [box(jj, -ii - 1, jj + 1, -ii)
+                                    for ii, jj in zip(i.ravel(), j.ravel())]})
+    # ring of active cells with an island in the middle
+    r = np.hypot(i - nrow / 2, j - ncol / 2)
+    isfr = ((r > 5) & (r < 12)) | (r < 2)
+    df['isfr'] = isfr.ravel().astype(int)
+    grid = sfrmaker.UnstructuredGrid.from_dataframe(df, crs=5070)
+    expected = unary_union(df.loc[isfr.ravel(), 'geometry'])
+    assert grid.active_area.equals(expected)
+    assert len(grid.active_area.geoms) == 2
+    # result is cached
+    active_area = grid.active_area
+    grid.create_active_area_polygon_from_isfr()
+    assert grid.active_area is active_area
+
+
+def test_dissolve_cells():
+    # larger cell bordering two smaller cells (without a shared vertex)
+    cells = [box(0, 0, 2, 2), box(2, 0, 3, 1), box(2, 1, 3, 2)]
+    assert dissolve_cells(cells).equals(box(0, 0, 3, 2))
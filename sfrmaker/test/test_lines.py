@@ -1,6 +1,12 @@
+import numpy as np
+import flopy
+import pandas as pd
 import pytest
+from gisutils import shp2df
+from shapely.geometry import LineString, box
 import sfrmaker
 from sfrmaker.checks import is_to_one
+from sfrmaker.gis import read_polygon_feature
 from sfrmaker.nhdplus_utils import load_nhdplus_v2, get_prj_file
 
 
@@ -53,3 +59,119 @@ def test_write_shapefile(tylerforks_lines_from_NHDPlus, test_data_path):
     outshp = test_data_path / 'lines.shp'
     lines.write_shapefile(outshp)
     assert outshp.exists()
+
+
+def test_to_sfr_computed_asums(test_data_path, shellmound_grid, shellmound_model):
+    """Widths estimated from arbolate sums computed from the
+    LineString lengths, for hydrography without an asum2 column."""
+    flowlines_file = '{}/shellmound/flowlines.shp'.format(test_data_path)
+    df = shp2df(flowlines_file).drop(['width1', 'width2'], axis=1)
+    lns = sfrmaker.Lines.from_dataframe(df, id_column='COMID',
+                                        routing_column='tocomid',
+                                        up_elevation_column='elevupsmo',
+                                        dn_elevation_column='elevdnsmo',
+                                        attr_length_units='feet',
+                                        attr_height_units='feet',
+                                        prjfile=flowlines_file[:-4] + '.prj')
+    sfrdata = lns.to_sfr(grid=shellmound_grid, model=shellmound_model)
+    # arbolate sums include the line lengths (in meters)
+    # and the arbolate sums of any lines routing to them
+    lengths = dict(zip(lns.df.id, [g.length for g in lns.df.geometry]))
+    asum2 = dict(zip(lns.df.id, lns.df.asum2))
+    upstream_asums = {}
+    for id, toid in lns.routing.items():
+        if toid != 0:
+            upstream_asums[toid] = upstream_asums.get(toid, 0) + asum2[id]
+    for id in lns.df.id:
+        assert np.allclose(asum2[id], lengths[id] + upstream_asums.get(id, 0))
+    assert np.all(lns.df.width2 > 0)
+    assert np.all(sfrdata.reach_data.width > 0)
+
+
+@pytest.mark.parametrize('angrot,uniform', ((0, True), (30, True), (-17.5, False)))
+def test_intersect_grid_walk(tylerforks_lines_from_NHDPlus, angrot, uniform):
+    nrow, ncol = 60, 80
+    delr, delc = np.ones(ncol) * 250., np.ones(nrow) * 250.
+    if not uniform:
+        delr = np.random.RandomState(0).uniform(100, 400, ncol)
+        delc = np.random.RandomState(1).uniform(100, 400, nrow)
+    mg = flopy.discretization.StructuredGrid(delr=delr, delc=delc,
+                                             xoff=680000, yoff=5132000, angrot=angrot,
+                                             proj4='epsg:26715')
+    grid = sfrmaker.StructuredGrid.from_modelgrid(mg)
+    lines = tylerforks_lines_from_NHDPlus
+    expected = lines.intersect(grid, method='strtree')
+    results = lines.intersect(grid, method='grid walk')
+
+    # reaches should be the same as those from intersecting the cell polygons
+    cols = ['iseg', 'ireach', 'node', 'line_id']
+    assert np.array_equal(results[cols].values, expected[cols].values)
+    for g1, g2 in zip(results.geometry, expected.geometry):
+        assert np.allclose(g1.length, g2.length)
+        assert g1.hausdorff_distance(g2) < 1e-6
+
+
+def test_routing_one_to_one():
+    df = pd.DataFrame({'id': [5, 3, 9, 7], 'toid': [3, 9, 0, 0],
+                       'elevup': [100.] * 4, 'elevdn': [90.] * 4,
+                       'geometry': [LineString([(0, 0), (1, 1)])] * 4})
+    lines = sfrmaker.Lines(df, crs=26715)
+    # routing is in the same order as the flowlines
+    assert list(lines.routing.items()) == [(5, 3), (3, 9), (9, 0), (7, 0)]
+    # ids listed more than once can't have different toids
+    df['id'] = [5, 3, 3, 9]
+    df['toid'] = [3, 9, 7, 0]
+    with pytest.raises(AssertionError):
+        sfrmaker.Lines(df, crs=26715)
+
+
+def test_intersect_line_along_cell_edge():
+    # 90 m line running along the edge between rows 4 and 5 of a 10 x 10 m grid
+    mg = flopy.discretization.StructuredGrid(delr=np.ones(10) * 10., delc=np.ones(10) * 10.,
+                                             xoff=0, yoff=0, proj4='epsg:26715')
+    grid = sfrmaker.StructuredGrid.from_modelgrid(mg)
+    df = pd.DataFrame({'id': [1], 'toid': [0], 'elevup': [100.], 'elevdn': [90.],
+                       'name': ['stream'],
+                       'geometry': [LineString([(5, 50), (95, 50)])]})
+    lines = sfrmaker.Lines(df, crs=26715)
+    # the default grid walk assigns the line to the cells below the edge
+    results = lines.intersect(grid)
+    assert results.node.tolist() == list(range(50, 60))
+    assert np.allclose(sum(g.length for g in results.geometry), 90)
+    # intersecting the cell polygons makes reaches on both sides of the edge
+    results = lines.intersect(grid, method='strtree')
+    assert sorted(results.node.tolist()) == list(range(40, 60))
+    assert np.allclose(sum(g.length for g in results.geometry), 180)
+
+
+@pytest.mark.parametrize('method', ('grid walk', 'strtree'))
+def test_intersect_n_workers(tylerforks_lines_from_NHDPlus, tylerforks_sfrmaker_grid_from_flopy,
+                             method):
+    grid = tylerforks_sfrmaker_grid_from_flopy
+    lines = tylerforks_lines_from_NHDPlus
+    expected = lines.intersect(grid, method=method)
+    results = lines.intersect(grid, method=method, n_workers=2)
+    cols = ['node', 'rno', 'ireach', 'iseg', 'line_id', 'name']
+    pd.testing.assert_frame_equal(results[cols], expected[cols], check_dtype=False)
+    assert all(g1.equals(g2) for g1, g2 in zip(results.geometry, expected.geometry))
+
+
+def test_cull(tylerforks_lines_from_NHDPlus, tylerforks_active_area_shapefile):
+    lines = tylerforks_lines_from_NHDPlus
+    active_area = read_polygon_feature(tylerforks_active_area_shapefile, lines.crs)
+    culled = lines.cull(active_area)
+    assert 0 < len(culled) < len(lines.df)
+    # lines inside of the active area are unchanged; the others are clipped to it
+    for line_id, g in zip(culled.id, culled.geometry):
+        original = lines.df.loc[lines.df.id == line_id, 'geometry'].values[0]
+        assert active_area.buffer(1).contains(g)
+        if active_area.contains(original):
+            assert g.equals(original)
+        else:
+            assert np.allclose(g.length, original.intersection(active_area).length)
+    lines.cull(active_area, inplace=True)
+    assert len(lines.df) == len(culled)
+
+    # no lines in the feature
+    with pytest.raises(ValueError, match='No lines in active area'):
+        lines.cull(box(0, 0, 1, 1))
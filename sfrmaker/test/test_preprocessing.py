@@ -14,8 +14,12 @@ from sfrmaker.preprocessing import (get_flowline_routing,
                                     cull_flowlines, 
                                     preprocess_nhdplus, 
                                     clip_flowlines_to_polygon, 
-                                    edit_flowlines
+                                    edit_flowlines,
+                                    fix_invalid_asums,
+                                    recompute_asums_for_minor_distribs,
+                                    select_primary_distributaries
                                     )
+from sfrmaker.routing import make_graph
 
 
 @pytest.fixture(scope='module')
@@ -200,7 +204,9 @@ def test_preprocess_nhdplus_no_zonal_stats(culled_flowlines, preprocessed_flowli
 
 
 @pytest.mark.timeout(30)  # projection issues will cause zonal stats to hang
-def test_preprocess_nhdplus_no_narwidth(test_data_path, culled_flowlines, outfolder):
+@pytest.mark.parametrize('n_workers', (None, 2))
+def test_preprocess_nhdplus_no_narwidth(test_data_path, culled_flowlines, outfolder,
+                                        n_workers):
     kwargs = culled_flowlines.copy()
     kwargs['demfile'] = os.path.join(test_data_path, 'meras_100m_dem.tif')
     kwargs['narwidth_shapefile'] = None
@@ -210,9 +216,30 @@ def test_preprocess_nhdplus_no_narwidth(test_data_path, culled_flowlines, outfol
     kwargs['logger'] = None
     kwargs['outfolder'] = outfolder
     kwargs['project_epsg'] = 5070
+    kwargs['n_workers'] = n_workers
     preprocess_nhdplus(**kwargs)
 
 
+def test_preprocess_nhdplus_cache(test_data_path, culled_flowlines, outfolder, tmpdir):
+    kwargs = culled_flowlines.copy()
+    kwargs['demfile'] = os.path.join(test_data_path, 'meras_100m_dem.tif')
+    kwargs['asum_thresh'] = 20.
+    kwargs['logger'] = None
+    kwargs['outfolder'] = outfolder
+    kwargs['project_epsg'] = 5070
+    kwargs['cache_dir'] = str(tmpdir.join('cache'))
+    results = preprocess_nhdplus(**kwargs)
+    cache_files = os.listdir(kwargs['cache_dir'])
+    assert len(cache_files) == 1
+
+    # the second run reuses the cached zonal statistics
+    cache_file = os.path.join(kwargs['cache_dir'], cache_files[0])
+    modified = os.path.getmtime(cache_file)
+    results2 = preprocess_nhdplus(**kwargs)
+    assert os.path.getmtime(cache_file) == modified
+    pd.testing.assert_frame_equal(results, results2)
+
+
 def test_clip_flowlines(preprocessed_flowlines, test_data_path):
     clipped = clip_flowlines_to_polygon(preprocessed_flowlines,
                                         os.path.join(test_data_path, 'active_area.shp'),
@@ -257,4 +284,41 @@ def test_get_flowline_routing(datapath, project_root_path):
     df2 = get_flowline_routing(PlusFlow=plusflow_files)
     pd.testing.assert_frame_equal(df2.loc[df2['FROMCOMID'].isin(df['FROMCOMID'])].head(),
                                   df.head())
-    os.chdir(wd)
\ No newline at end of file
+    os.chdir(wd)
+
+
+def test_recompute_asums():
+    # 5 is a minor distributary; 3 and 4 are confluences
+    graph = {1: 3, 2: 3, 3: 4, 4: 0, 5: 6, 6: 7, 7: 4}
+    graph_r = make_graph(list(graph.values()), list(graph.keys()))
+    fl_lengths = {k: 1. for k in graph}
+    results = recompute_asums_for_minor_distribs({5}, fl_lengths, graph, graph_r)
+    assert results == {5: 1., 6: 2., 7: 3.}
+
+    # break in asum continuity at 3;
+    # increase at 3 is carried downstream to 4
+    asums = {1: 2., 2: 10., 3: 4., 4: 20., 5: 1., 6: 2., 7: 3.}
+    results = fix_invalid_asums(asums, fl_lengths, graph)
+    assert results == {1: 2., 2: 10., 3: 11., 4: 27., 5: 1., 6: 2., 7: 3.}
+    # the order of asums doesn't matter
+    reversed_asums = dict(reversed(list(asums.items())))
+    assert fix_invalid_asums(reversed_asums, fl_lengths, graph) == results
+
+
+def test_select_primary_distributaries():
+    fromcomids = [1, 1, 2, 2, 3, 3, 4, 5, 5, 6, 6]
+    tocomids = [2, 3, 4, 5, 6, 7, 0, 6, 8, 7, 9]
+    # 8 isn't in the dataset; 9 has a nan elevation
+    elevations = pd.Series([10., 9., 5., 5.001, 4., 2., 1., 0.5],
+                           index=[2, 3, 4, 5, 6, 7, 9, 10])
+    elevations[9] = np.nan
+    divergence = pd.Series([2, 1, 2, 1, 1, 1, 2, 0], index=elevations.index)
+    tocomids, minor = select_primary_distributaries(fromcomids, tocomids,
+                                                    elevations, divergence,
+                                                    known_connections={3: 6})
+    # 1: lowest elevation; 2: same elevations, so main stem
+    # 3: known connection; 5: only one connection in the dataset
+    # 6: nan elevation, so main stem
+    assert tocomids == {1: 3, 2: 5, 3: 6, 4: 0, 5: 6, 6: 7}
+    assert minor == {2, 4, 7, 9}
+
@@ -0,0 +1,360 @@
+from pathlib import Path
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+import pytest
+import flopy
+import rasterio
+from rasterio import Affine
+from rasterstats import zonal_stats
+import sfrmaker
+from shapely.geometry import LineString
+from sfrmaker.rasters import (cell_zonal_stats, tiled_zonal_stats,
+                              densify_lines, line_point_stats,
+                              GroupedStats, parse_stats,
+                              get_geometry_hashes, ZonalStatsCache,
+                              get_raster_tiles, get_tile_index,
+                              build_raster_mosaic, raster_mosaic)
+
+
+@pytest.fixture(scope='module')
+def rotated_grid():
+    mg = flopy.discretization.StructuredGrid(delr=np.array([100.] * 6 + [150.] * 6),
+                                             delc=np.ones(10) * 100.,
+                                             xoff=682688, yoff=5139052, angrot=20,
+                                             proj4='epsg:26715')
+    return sfrmaker.StructuredGrid.from_modelgrid(mg=mg, crs=26715)
+
+
+@pytest.fixture(scope='module')
+def synthetic_dem(rotated_grid, tmpdir_factory):
+    xmin, ymin, xmax, ymax = rotated_grid.bounds
+    res = 7.3
+    width = int((xmax - xmin) / res) + 10
+    height = int((ymax - ymin) / res) + 10
+    transform = Affine(res, 0, xmin - 5 * res, 0, -res, ymax + 5 * res)
+    data = np.random.RandomState(0).uniform(300, 400, size=(height, width)).astype(np.float32)
+    data[:20, :20] = -9999
+    filename = str(tmpdir_factory.mktemp('rasters').join('dem.tif'))
+    with rasterio.open(filename, 'w', driver='GTiff', width=width, height=height,
+                       count=1, dtype='float32', crs='epsg:26715', transform=transform,
+                       nodata=-9999) as dst:
+        dst.write(data, 1)
+    return filename
+
+
+def test_parse_stats():
+    assert parse_stats('min percentile_10') == ['min', 'percentile_10']
+    with pytest.raises(ValueError):
+        parse_stats(['mode'])
+    with pytest.raises(ValueError):
+        parse_stats(['percentile_110'])
+
+
+def test_grouped_stats():
+    values = np.random.RandomState(1).uniform(size=100)
+    labels = np.arange(100) % 3
+    stats = GroupedStats(4, ['min', 'max', 'mean', 'std', 'count', 'median', 'percentile_10'])
+    # add the values in two blocks
+    stats.add(labels[:37], values[:37])
+    stats.add(labels[37:], values[37:])
+    results = stats.results()
+    for label in range(3):
+        group = values[labels == label]
+        assert np.allclose(results['min'][label], group.min())
+        assert np.allclose(results['max'][label], group.max())
+        assert np.allclose(results['mean'][label], group.mean())
+        assert np.allclose(results['std'][label], group.std())
+        assert results['count'][label] == len(group)
+        assert np.allclose(results['median'][label], np.median(group))
+        assert np.allclose(results['percentile_10'][label], np.percentile(group, 10))
+    assert np.isnan(results['min'][3])
+    assert results['count'][3] == 0
+
+
+def test_grouped_stats_std_precision():
+    # DEM-scale values with a small spread, added in many blocks
+    values = 5000 + np.random.RandomState(1).uniform(0, 0.01, size=10000)
+    labels = np.arange(10000) % 2
+    stats = GroupedStats(2, ['mean', 'std'])
+    for block in np.array_split(np.arange(10000), 37):
+        stats.add(labels[block], values[block])
+    results = stats.results()
+    for label in range(2):
+        group = values[labels == label]
+        assert np.allclose(results['std'][label], np.std(group), rtol=1e-9, atol=0)
+        assert np.allclose(results['mean'][label], np.mean(group), rtol=1e-12, atol=0)
+
+
+def test_cell_zonal_stats(rotated_grid, synthetic_dem):
+    grid = rotated_grid
+    # repeated nodes are only sampled once
+    nodes = [0, 5, 5, 17, 64, 119, 64]
+    stats = ['min', 'mean', 'count', 'percentile_10']
+    results = cell_zonal_stats(synthetic_dem, grid, nodes, stats=stats,
+                               max_pixels=1000)
+    assert results.index.tolist() == sorted(set(nodes))
+    polygons = grid.get_cell_polygons(results.index.values)
+    expected = zonal_stats(list(polygons), synthetic_dem, stats=stats)
+    for stat in stats:
+        assert np.allclose(results[stat], [r[stat] for r in expected])
+
+
+def test_cell_zonal_stats_different_crs(rotated_grid, synthetic_dem, tmpdir):
+    # smooth DEM (a sloping plane), in the grid CRS and another CRS
+    from rasterio.warp import calculate_default_transform, reproject, Resampling
+    dem = str(tmpdir.join('plane.tif'))
+    dem_5070 = str(tmpdir.join('plane_5070.tif'))
+    with rasterio.open(synthetic_dem) as src:
+        kwargs = src.meta.copy()
+        rows, cols = np.indices((src.height, src.width))
+        data = (300 + 0.01 * cols + 0.02 * rows).astype(np.float32)
+        with rasterio.open(dem, 'w', **kwargs) as dst:
+            dst.write(data, 1)
+        transform, width, height = calculate_default_transform(
+            src.crs, 'epsg:5070', src.width, src.height, *src.bounds)
+        kwargs.update(crs='epsg:5070', transform=transform, width=width, height=height)
+        with rasterio.open(dem_5070, 'w', **kwargs) as dst:
+            reproject(data, rasterio.band(dst, 1), src_transform=src.transform,
+                      src_crs=src.crs, resampling=Resampling.bilinear)
+    nodes = np.arange(30, 60)
+    results = cell_zonal_stats(dem_5070, rotated_grid, nodes, stats='mean')
+    expected = cell_zonal_stats(dem, rotated_grid, nodes, stats='mean')
+    assert np.allclose(results['mean'], expected['mean'], atol=0.05)
+
+
+@pytest.mark.parametrize('n_workers', (None, 2))
+def test_tiled_zonal_stats(synthetic_dem, n_workers):
+    with rasterio.open(synthetic_dem) as src:
+        l, b, r, t = src.bounds
+    rs = np.random.RandomState(2)
+    features = []
+    # include buffers that extend past the edges of the raster
+    for i in range(50):
+        x0, y0 = rs.uniform(l - 200, r + 100), rs.uniform(b - 200, t + 100)
+        dx, dy = rs.uniform(-300, 300, size=2)
+        features.append(LineString([(x0, y0), (x0 + dx, y0 + dy)]).buffer(20, cap_style=2))
+    stats = ['min', 'mean', 'std', 'count', 'percentile_10']
+    results = tiled_zonal_stats(features, synthetic_dem, stats=stats,
+                                n_workers=n_workers, tile_size=64)
+    expected = zonal_stats(features, synthetic_dem, stats=stats)
+    assert results == expected
+
+
+def test_zonal_stats_cache(synthetic_dem, tmpdir):
+    features = [LineString([(682700, 5139100), (682800, 5139200)]).buffer(10),
+                LineString([(682800, 5139200), (682900, 5139200)]).buffer(10)]
+    keys = get_geometry_hashes(features)
+    assert len(set(keys)) == 2
+    assert np.array_equal(keys, get_geometry_hashes([f for f in features]))
+    stats = ['min', 'percentile_10']
+    cache_dir = str(tmpdir.join('cache'))
+    cache = ZonalStatsCache(cache_dir, synthetic_dem, stats, buffer_distance=10)
+    cached, found = cache.get(keys)
+    assert not found.any()
+    results = zonal_stats(features, synthetic_dem, stats=stats)
+    cache.update(keys[:1], results[:1])
+    # the cache file is written in place of a temporary file
+    assert [f.name for f in Path(cache_dir).iterdir()] == [cache.filename.name]
+
+    # a new cache instance reads the cached results from disk
+    cache = ZonalStatsCache(cache_dir, synthetic_dem, stats, buffer_distance=10)
+    cached, found = cache.get(keys)
+    assert found.tolist() == [True, False]
+    assert cached.loc[0, 'min'] == results[0]['min']
+    assert cached.loc[0, 'percentile_10'] == results[0]['percentile_10']
+    assert np.isnan(cached.loc[1, 'min'])
+
+    # different settings use a different cache
+    cache2 = ZonalStatsCache(cache_dir, synthetic_dem, stats, buffer_distance=20)
+    assert not cache2.get(keys)[1].any()
+
+
+def test_sample_reach_elevations_cache(rotated_grid, synthetic_dem, tmpdir):
+    x0, y0 = rotated_grid.xul, rotated_grid.yul
+    df = pd.DataFrame({'id': [1, 2], 'toid': [2, 0],
+                       'elevup': [400., 350.], 'elevdn': [350., 300.], 'name': ['', ''],
+                       'width1': [5., 5.], 'width2': [5., 5.],
+                       'geometry': [LineString([(x0 + 200, y0 - 200), (x0 + 500, y0 - 400)]),
+                                    LineString([(x0 + 500, y0 - 400), (x0 + 900, y0 - 500)])]})
+    sfrdata = sfrmaker.Lines(df, crs=26715).to_sfr(grid=rotated_grid)
+    cache_dir = Path(tmpdir.join('cache'))
+
+    def sample(method, **kwargs):
+        """Sample elevations; return the number of new cache files."""
+        nfiles = len(list(cache_dir.glob('*.csv'))) if cache_dir.exists() else 0
+        sfrdata.sample_reach_elevations(synthetic_dem, method=method, smooth=False,
+                                        cache_dir=str(cache_dir), **kwargs)
+        return len(list(cache_dir.glob('*.csv'))) - nfiles
+
+    # each method is only keyed to the settings that it uses
+    assert sample('buffers', buffer_distance=20) == 1
+    assert sample('buffers', buffer_distance=20, point_spacing=5) == 0
+    assert sample('buffers', buffer_distance=30) == 1
+    assert sample('points', point_spacing=5) == 1
+    assert sample('points', point_spacing=5, buffer_distance=50) == 0
+    assert sample('cell polygons') == 1
+    assert sample('cell polygons', buffer_distance=50, point_spacing=10) == 0
+
+
+def test_densify_lines():
+    lines = [LineString([(0, 0), (10, 0)]), LineString([(0, 0), (0, 2.5)]),
+             LineString()]
+    x, y, line_index = densify_lines(lines, spacing=1)
+    assert line_index.tolist() == [0] * 11 + [1] * 4 + [2]
+    assert np.allclose(x[:11], np.arange(11))
+    assert np.allclose(y[11:15], [0, 2.5 / 3, 5 / 3, 2.5])
+    assert np.isnan(x[-1])
+
+
+def test_line_point_stats(synthetic_dem):
+    with rasterio.open(synthetic_dem) as src:
+        l, b, r, t = src.bounds
+    lines = [LineString([(l + 100, b + 100), (l + 300, b + 250)]),
+             LineString([(l + 400, t - 50), (l + 410, t - 300), (l + 600, t - 310)]),
+             # line partially outside of the raster
+             LineString([(r - 30, b + 200), (r + 500, b + 200)])]
+    stats = ['min', 'mean', 'count', 'percentile_10']
+    results = line_point_stats(synthetic_dem, lines, stats=stats, tile_size=16)
+    x, y, line_index = densify_lines(lines, spacing=7.3)
+    with rasterio.open(synthetic_dem) as src:
+        values = np.array([v[0] for v in src.sample(zip(x, y), masked=True)], dtype=float)
+        inside = (x > l) & (x < r) & (y > b) & (y < t)
+    for i, line in enumerate(lines):
+        expected = values[(line_index == i) & inside]
+        assert results.loc[i, 'count'] == len(expected)
+        assert np.allclose(results.loc[i, 'min'], expected.min())
+        assert np.allclose(results.loc[i, 'mean'], expected.mean())
+        assert np.allclose(results.loc[i, 'percentile_10'], np.percentile(expected, 10))
+
+
+def test_line_point_stats_different_crs(synthetic_dem, tmpdir):
+    # smooth DEM (a sloping plane), in the CRS of the lines
+    # and in geographic coordinates
+    from rasterio.warp import calculate_default_transform, reproject, Resampling
+    dem = str(tmpdir.join('plane.tif'))
+    dem_4269 = str(tmpdir.join('plane_4269.tif'))
+    with rasterio.open(synthetic_dem) as src:
+        kwargs = src.meta.copy()
+        rows, cols = np.indices((src.height, src.width))
+        data = (300 + 0.01 * cols + 0.02 * rows).astype(np.float32)
+        with rasterio.open(dem, 'w', **kwargs) as dst:
+            dst.write(data, 1)
+        transform, width, height = calculate_default_transform(
+            src.crs, 'epsg:4269', src.width, src.height, *src.bounds)
+        kwargs.update(crs='epsg:4269', transform=transform, width=width, height=height)
+        with rasterio.open(dem_4269, 'w', **kwargs) as dst:
+            reproject(data, rasterio.band(dst, 1), src_transform=src.transform,
+                      src_crs=src.crs, resampling=Resampling.bilinear)
+        l, b, r, t = src.bounds
+    lines = [LineString([(l + 100, b + 100), (l + 400, b + 500)]),
+             LineString([(l + 300, t - 100), (r - 100, t - 150)])]
+    stats = ['mean', 'count']
+    results = line_point_stats(dem_4269, lines, stats=stats, crs=26715)
+    expected = line_point_stats(dem, lines, stats=stats, crs=26715)
+    # the default point spacing is the DEM resolution, in the units of the lines
+    lengths = np.array([line.length for line in lines])
+    assert np.allclose(results['count'], lengths / 7.3, rtol=0.2)
+    assert np.allclose(results['mean'], expected['mean'], atol=0.05)
+
+
+@pytest.fixture(scope='module')
+def dem_tiles(synthetic_dem, tmpdir_factory):
+    """Split the synthetic DEM into 3 x 2 tiles, with some overlap."""
+    from rasterio.windows import Window
+    folder = tmpdir_factory.mktemp('dem_tiles')
+    tiles = []
+    with rasterio.open(synthetic_dem) as src:
+        kwargs = src.meta.copy()
+        col_offs = [0, src.width // 3 - 5, 2 * src.width // 3]
+        row_offs = [0, src.height // 2]
+        for i, row_off in enumerate(row_offs):
+            for j, col_off in enumerate(col_offs):
+                width = src.width - col_off if j == 2 else col_offs[j + 1] - col_off + 5
+                height = src.height - row_off if i == 1 else row_offs[1] - row_off
+                window = Window(col_off, row_off, width, height)
+                kwargs.update(width=width, height=height,
+                              transform=src.window_transform(window))
+                filename = str(folder.join('tile_{}{}.tif'.format(i, j)))
+                with rasterio.open(filename, 'w', **kwargs) as dst:
+                    dst.write(src.read(1, window=window), 1)
+                tiles.append(filename)
+    return tiles
+
+
+def test_build_raster_mosaic(synthetic_dem, dem_tiles, tmpdir):
+    folder = str(Path(dem_tiles[0]).parent)
+    assert get_raster_tiles(folder) == sorted(dem_tiles)
+    assert get_raster_tiles(synthetic_dem) == [synthetic_dem]
+    assert build_raster_mosaic(synthetic_dem) == synthetic_dem
+    index = get_tile_index(dem_tiles)
+    assert len(index) == 6
+    assert index['right'].max() > index['left'].min()
+
+    with pytest.raises(ValueError):
+        build_raster_mosaic(folder)
+    out_dir = str(tmpdir.join('mosaics'))
+    vrt_file = build_raster_mosaic(folder, out_dir=out_dir)
+    # the mosaic is reused if the tiles haven't changed
+    assert build_raster_mosaic(dem_tiles[::-1], out_dir=out_dir) != vrt_file
+    assert build_raster_mosaic(folder, out_dir=out_dir) == vrt_file
+    assert sorted(f.suffix for f in Path(out_dir).iterdir()) == ['.vrt', '.vrt']
+    with rasterio.open(vrt_file) as mosaic, rasterio.open(synthetic_dem) as src:
+        assert mosaic.bounds == src.bounds
+        assert mosaic.crs == src.crs
+        assert mosaic.nodata == src.nodata
+        assert np.array_equal(mosaic.read(1), src.read(1))
+        # the GeoTransform and nodata values are written as plain numbers
+        root = ET.parse(vrt_file).getroot()
+        geotransform = root.find('GeoTransform').text
+        assert tuple(float(v) for v in geotransform.split(',')) == src.transform.to_gdal()
+        assert float(root.find('VRTRasterBand/NoDataValue').text) == src.nodata
+        assert all(float(e.text) == src.nodata for e in root.iter('NODATA'))
+
+    # without an output folder, the mosaic is written to a temporary folder
+    with raster_mosaic(folder) as vrt_file:
+        with rasterio.open(vrt_file) as mosaic:
+            assert mosaic.bounds == src.bounds
+    assert not Path(vrt_file).parent.exists()
+    with raster_mosaic(synthetic_dem) as raster:
+        assert raster == synthetic_dem
+
+    # tiles in different CRSs can't be mosaicked
+    with rasterio.open(dem_tiles[0]) as src:
+        kwargs = src.meta.copy()
+        kwargs['crs'] = 'epsg:5070'
+        data = src.read(1)
+    tile_5070 = str(tmpdir.join('tile_5070.tif'))
+    with rasterio.open(tile_5070, 'w', **kwargs) as dst:
+        dst.write(data, 1)
+    with pytest.raises(ValueError):
+        build_raster_mosaic([dem_tiles[1], tile_5070], out_dir=str(tmpdir))
+
+
+def test_sampling_dem_tiles(rotated_grid, synthetic_dem, dem_tiles, tmpdir):
+    """Sampling DEM tiles should give the same results as the
+    DEM that they were split from."""
+    rs = np.random.RandomState(2)
+    xmin, ymin, xmax, ymax = rotated_grid.bounds
+    lines = []
+    for i in range(20):
+        x0, y0 = rs.uniform(xmin, xmax), rs.uniform(ymin, ymax)
+        dx, dy = rs.uniform(-300, 300, size=2)
+        lines.append(LineString([(x0, y0), (x0 + dx, y0 + dy)]))
+    features = [line.buffer(20, cap_style=2) for line in lines]
+    mosaic = build_raster_mosaic(dem_tiles, out_dir=str(tmpdir))
+    stats = ['min', 'mean', 'count']
+    assert tiled_zonal_stats(features, mosaic, stats=stats, tile_size=64) == \
+           zonal_stats(features, synthetic_dem, stats=stats)
+    results = line_point_stats(mosaic, lines, stats=stats, tile_size=16)
+    expected = line_point_stats(synthetic_dem, lines, stats=stats, tile_size=16)
+    assert results.equals(expected)
+    nodes = np.arange(0, 120, 7)
+    results = cell_zonal_stats(mosaic, rotated_grid, nodes, stats=stats)
+    expected = cell_zonal_stats(synthetic_dem, rotated_grid, nodes, stats=stats)
+    assert results.equals(expected)
+
+    # the cache is keyed to the tile files
+    cache = ZonalStatsCache(str(tmpdir), dem_tiles, stats)
+    assert cache.filename != ZonalStatsCache(str(tmpdir), dem_tiles[:-1], stats).filename
+
@@ -0,0 +1,18 @@
+import numpy as np
+from shapely.geometry import LineString, box
+from sfrmaker.reaches import create_reaches
+
+
+def test_create_reaches():
+    # 3 x 3 grid of unit cells, numbered left to right, top to bottom
+    grid_geoms = [box(j, 2 - i, j + 1, 3 - i) for i in range(3) for j in range(3)]
+    # line that runs diagonally through the corners shared by cells 6, 4 and 2,
+    # then hooks back down and to the left, re-entering cell 4
+    part = LineString([(0.5, 0.5), (2.5, 2.5), (2.5, 1.25), (1.75, 1.25)])
+    segment_nodes = list(range(9))
+    geoms, nodes = create_reaches(part, segment_nodes, grid_geoms)
+    assert nodes == [6, 4, 2, 5, 4]
+    assert np.allclose([g.length for g in geoms],
+                       [np.sqrt(.5), np.sqrt(2), np.sqrt(.5) + .5, 1.25, .25])
+    assert np.allclose(geoms[0].coords[0], part.coords[0])
+    assert np.allclose(geoms[-1].coords[-1], part.coords[-1])
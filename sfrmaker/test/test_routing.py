@@ -1,5 +1,7 @@
 import numpy as np
-from sfrmaker.routing import make_graph, get_upsegs
+import pytest
+from sfrmaker.routing import make_graph, get_upsegs, RoutingGraph, PathIndex, \
+    SubtreeIndex
 
 from ..checks import routing_is_circular, valid_nsegs
 from ..routing import (get_next_id_in_subset, renumber_segments, find_path,
@@ -42,6 +44,22 @@ def test_get_next_id_in_subset(shellmound_sfrdata):
     assert set(result) == {0, seq[-1]}
     assert len(result) == len(range(nlines + 2))
 
+    # ids in subset that aren't in the routing are returned as-is
+    assert get_next_id_in_subset([1000], routing, [1000]) == [1000]
+
+
+def test_routing_graph_next_in_subset():
+    graph = RoutingGraph([1, 2, 3, 4, 5, 6, 7], [2, 3, 0, 3, 6, 7, 5])
+    next_in_subset = graph.get_next_in_subset([2, 6, 8])
+    result = dict(zip(graph.ids, next_in_subset))
+    assert graph.ids[result[1]] == 2
+    assert graph.ids[result[2]] == 2
+    assert result[3] == -1
+    assert result[4] == -1
+    # circular routing
+    assert graph.ids[result[5]] == 6
+    assert graph.ids[result[7]] == 6
+
 
 def test_get_previous_ids_in_subset():
     routing = {17955471: 17957799,
@@ -91,6 +109,21 @@ def test_renumber_segments():
     assert valid_nsegs(nseg1, outseg1)
 
 
+
+def test_renumber_segments_lakes():
+    nseg = [5, 10, 20, 30, 40]
+    outseg = [10, 0, 30, -1, 50]  # segment 30 routes to a lake; 50 isn't a segment
+    r = renumber_segments(nseg, outseg)
+    assert r[-1] == -1
+    assert r[50] == 0
+    nseg2 = [r[s] for s in nseg]
+    outseg2 = [r[s] for s in outseg]
+    assert sorted(nseg2) == [1, 2, 3, 4, 5]
+    assert outseg2[nseg.index(30)] == -1
+    for s, o in zip(nseg2, outseg2):
+        if o > 0:
+            assert o > s
+
 def test_get_upsegs(sfr_test_numbering):
     rd, sd = sfr_test_numbering
     graph = dict(zip(sd.nseg, sd.outseg))
@@ -112,3 +145,103 @@ def test_find_path():
     path = find_path(routing, start=1)
     assert path[0] == 1
     assert path[-1] == 0
+
+
+def test_routing_graph(sfr_test_numbering):
+    rd, sd = sfr_test_numbering
+    routing = dict(zip(sd.nseg, sd.outseg))
+    graph = RoutingGraph.from_dict(routing)
+    assert graph.to_dict() == routing
+    graph_r = make_graph(list(routing.values()), list(routing.keys()))
+    for s in sd.nseg:
+        assert set(graph.upstream(s)) == graph_r.get(s, set())
+        assert set(graph.get_all_upstream(s)) == get_upsegs(graph_r, s)
+        assert graph.find_path(s) == find_path(routing, s)
+        assert graph.downstream(s) == routing[s]
+    assert set(graph.upstream(0)) == graph_r[0]
+    graph_r = make_graph(list(routing.values()), list(routing.keys()))
+    assert {k: set(v) for k, v in graph.reverse_dict().items()} == graph_r
+
+
+def test_routing_graph_outlets():
+    # toids that aren't listed as fromids are outlets
+    graph = RoutingGraph([1, 2, 3, 5], [2, 4, 4, -1])
+    assert graph.to_dict() == {-1: 0, 1: 2, 2: 4, 3: 4, 4: 0, 5: -1}
+    assert graph.to_dict(listed_only=True) == {1: 2, 2: 4, 3: 4, 5: -1}
+    assert set(graph.upstream(0)) == {-1, 4}
+    assert 5 in graph
+    assert 6 not in graph
+    with pytest.raises(KeyError):
+        graph.get_index(6)
+
+    # levels upstream of the outlets, or of other starting nodes
+    levels = graph.get_levels()
+    assert [graph.ids[level].tolist() for level in levels] == [[-1, 4], [5, 2, 3], [1]]
+    levels = graph.get_levels(start=graph.get_index([2]))
+    assert [graph.ids[level].tolist() for level in levels] == [[2], [1]]
+
+    # ids are listed in the order they were given
+    graph = RoutingGraph([5, 3, 9], [3, 9, 0])
+    assert list(graph.to_dict(listed_only=True).items()) == [(5, 3), (3, 9), (9, 0)]
+
+    # string ids, with the default outlet value of 0
+    graph = RoutingGraph(['a', 'b', 'c'], ['b', 'c', '0'])
+    assert graph.find_path('a') == ['a', 'b', 'c', 0]
+
+    # empty graph
+    graph = RoutingGraph([], [])
+    with pytest.raises(KeyError):
+        graph.get_index(1)
+    with pytest.raises(KeyError):
+        graph.find_path(1)
+
+
+def test_path_index(sfr_test_numbering):
+    rd, sd = sfr_test_numbering
+    routing = dict(zip(sd.nseg, sd.outseg))
+    paths = PathIndex(RoutingGraph.from_dict(routing))
+    assert list(paths) == list(routing.keys())
+    assert {k: v for k, v in paths.items()} == \
+           {s: find_path(routing, s) for s in routing}
+    for s in sd.nseg:
+        path = paths[s]
+        assert paths.depth[paths.graph.get_index(s)] == len(path) - 2
+        for k in range(len(path) + 2):
+            expected = path[min(k, len(path) - 1)]
+            assert paths.get_kth_downstream(s, k) == expected
+    kth = paths.get_kth_downstream(sd.nseg.values, 3)
+    assert kth.tolist() == [find_path(routing, s, limit=3)[-1] for s in sd.nseg]
+
+    # early termination of a path
+    path = paths.iter_path(1)
+    assert next(path) == 1
+    assert next(path) == routing[1]
+
+    # paths contain Python ints
+    paths = PathIndex(RoutingGraph.from_dict({1: 2, 2: 4, 3: 4, 4: 0}))
+    assert [type(v) for v in paths[1]] == [int, int, int, int]
+
+
+def test_subtree_index(sfr_test_numbering):
+    rd, sd = sfr_test_numbering
+    routing = dict(zip(sd.nseg, sd.outseg))
+    graph_r = make_graph(list(routing.values()), list(routing.keys()))
+    index = SubtreeIndex(RoutingGraph.from_dict(routing))
+    # every node appears once in the preorder
+    assert sorted(index.order) == list(range(len(index.graph)))
+    for s in sd.nseg:
+        upsegs = get_upsegs(graph_r, s)
+        assert set(index.get_upstream(s).tolist()) == upsegs
+        assert set(index.get_upstream(s, include_self=True).tolist()) == \
+               upsegs.union({s})
+        is_upstream = index.is_upstream(sd.nseg.values, s)
+        assert set(sd.nseg.values[is_upstream]) == upsegs
+        assert not index.is_upstream(s, s)
+
+
+def test_routing_is_circular():
+    fromid = [1, 2, 3, 4, 5, 6, 7, 8, 9]
+    toid = [2, 3, 1, 1, 5, 0, 8, 7, 6]
+    cycles = routing_is_circular(fromid, toid)
+    assert cycles == [[1, 2, 3], [5], [7, 8]]
+    assert not routing_is_circular([1, 2, 3], [2, 0, 0])
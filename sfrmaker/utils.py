@@ -7,7 +7,7 @@ import pprint
 import numpy as np
 import flopy
 import sfrmaker
-from sfrmaker.routing import get_upsegs, make_graph
+from sfrmaker.routing import RoutingGraph
 from sfrmaker.units import convert_length_units
 
 unit_conversion = {'feetmeters': 0.3048,
@@ -152,21 +152,26 @@ def arbolate_sum(segment, lengths, routing, starting_asums=None):
     -------
     asum : float or dict
         Arbolate sums for each segment.
+
+    Notes
+    -----
+    Arbolate sums for all segments are computed in a single pass
+    through the routing network, from the headwaters to the outlets
+    (see :meth:`sfrmaker.routing.RoutingGraph.accumulate`).
     """
     if np.isscalar(segment):
         segment = [segment]
-    graph_r = make_graph(list(routing.values()), list(routing.keys()))
-
-    asum = {}
-    for s in segment:
-        upsegs = get_upsegs(graph_r, s)
-        lnupsegs = [lengths[us] for us in upsegs]
-        upstream_starting_asums = [0.]
-        segment_starting_asum = 0.
-        if starting_asums is not None:
-            upstream_starting_asums = [starting_asums.get(us, 0.) for us in upsegs]
-            segment_starting_asum = starting_asums.get(s, 0.)
-        asum[s] = np.sum(lnupsegs) + lengths[s] + np.sum(upstream_starting_asums) + segment_starting_asum
+    graph = RoutingGraph.from_dict(routing)
+    # lengths for nodes that are only listed as downstream connections
+    # (or the outlet) are only needed if arbolate sums are requested for them
+    values = np.array([lengths[id] if listed and id != graph.outlet
+                       else lengths.get(id, 0.)
+                       for id, listed in zip(graph.ids.tolist(), graph.listed)],
+                      dtype=float)
+    if starting_asums is not None:
+        values += np.array([starting_asums.get(id, 0.) for id in graph.ids.tolist()])
+    accumulated = graph.accumulate(values)
+    asum = dict(zip(segment, accumulated[graph.get_index(np.array(segment))]))
     return asum
 
 